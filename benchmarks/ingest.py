@@ -0,0 +1,191 @@
+"""
+End-to-end ingest benchmark: synthetic chat -> ingestion pipeline (resolver, user cache, register_vote, vote insert)
+-> websocket fanout to fake clients, on a fresh SQLite (WAL) database or a scratch MySQL database.
+Reports votes/s, ingest-to-broadcast latency (chat message handed to the pipeline until the first client got
+its vote) and the number of database queries.
+
+    python -m benchmarks.ingest --messages 20000 --clients 100 [--rate 500] [--tick-ms 100] [--schema 2]
+    python -m benchmarks.ingest --replay chat.jsonl --speed 10
+    python -m benchmarks.ingest --backend mysql --mysql-db livevote_bench  # compare with the sqlite default
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import tempfile
+import time
+from collections import deque
+from typing import AsyncIterator
+
+from chat_source import ChatSource, ReplaySource, SyntheticSource
+from metrics import STAGE_SECONDS
+from models import create_database, db, use_database, BaseModel
+from resolver import resolver
+
+
+class QueryCounter(logging.Handler):
+    """Counts the statements peewee logs at debug level, for any backend"""
+
+    def __init__(self) -> None:
+        super().__init__(logging.DEBUG)
+        self.queries = 0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.queries += 1
+
+    def install(self) -> 'QueryCounter':
+        logger = logging.getLogger('peewee')
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False  # counted, not printed
+        logger.addHandler(self)
+        return self
+
+
+class TimedSource(ChatSource):
+    """Notes the time every vote is handed to the pipeline, messages that are no vote are not timed"""
+
+    def __init__(self, source: ChatSource) -> None:
+        self.source = source
+        self.handed_over: deque[float] = deque()
+
+    async def items(self) -> AsyncIterator:
+        async for item in self.source:
+            if resolver.resolve(item.message) is not None:
+                self.handed_over.append(time.perf_counter())
+            yield item
+
+
+class FakeClient:
+    """Websocket connection that only counts what it receives"""
+
+    def __init__(self, path: str = '/', on_message=None) -> None:
+        self.request = type('Request', (), {'path': path})()
+        self.remote_address = ('benchmark', 0)
+        self.on_message = on_message
+        self.frames = 0
+        self.bytes = 0
+        self._closed = asyncio.Event()
+
+    async def send(self, message: bytes, text: bool = False) -> None:
+        self.frames += 1
+        self.bytes += len(message)
+        if self.on_message is not None:
+            self.on_message(message)
+
+    async def wait_closed(self) -> None:
+        await self._closed.wait()
+
+    async def close(self, code: int = 1000, reason: str = '') -> None:
+        self._closed.set()
+
+
+async def run(args: argparse.Namespace, counter: QueryCounter) -> dict:
+    from scoreboard import scoreboard
+    from ticker import UpdateCoalescer
+    from web_socket import WebsocketClient
+
+    server = WebsocketClient(game=None)
+    if args.tick_ms:
+        server.coalescer = UpdateCoalescer(server.broadcaster.broadcast, args.tick_ms / 1000)
+    if args.replay:
+        source = TimedSource(ReplaySource(args.replay, speed=args.speed))
+    else:
+        source = TimedSource(SyntheticSource(rate=args.rate, count=args.messages, users=args.users, noise=args.noise,
+                                             burst_every=args.burst_every, seed=args.seed))
+    latencies = []
+    received = 0
+
+    def on_message(message: bytes) -> None:
+        # reports arrive in chat order, one vote per timed message
+        nonlocal received
+        report = json.loads(message)
+        votes = {'update': 1, 'tick': report.get('vote_count', 0)}.get(report.get('type'), 0)
+        now = time.perf_counter()
+        for _ in range(votes):
+            latencies.append(now - source.handed_over.popleft())
+        received += votes
+
+    clients = [FakeClient(on_message=on_message)]
+    clients += [FakeClient(f'/?schema={args.schema}&encoding={args.encoding}') for _ in range(args.clients - 1)]
+    handlers = [asyncio.create_task(server.handler(client)) for client in clients]
+    while any(client.frames == 0 for client in clients):  # initial status report
+        await asyncio.sleep(0.01)
+
+    tasks = [asyncio.create_task(server.pipeline.run()), asyncio.create_task(scoreboard.flush_periodically())]
+    if server.coalescer is not None:
+        tasks.append(asyncio.create_task(server.coalescer.run()))
+    counter.queries = 0
+    frames = [client.frames for client in clients]
+    start = time.perf_counter()
+    await server.chat_watcher(source)
+    deadline = time.perf_counter() + 60
+    stats = server.pipeline.stats
+    while (stats.votes + stats.ignored + stats.failed < stats.received or received < stats.votes) \
+            and time.perf_counter() < deadline:
+        await asyncio.sleep(0.005)
+    elapsed = time.perf_counter() - start
+    queries = counter.queries
+
+    for task in tasks + handlers:
+        task.cancel()
+    for client in clients:
+        await client.close()
+    latencies.sort()
+    return {
+        'backend': type(db.obj).__name__,
+        'votes': received,
+        'seconds': elapsed,
+        'votes_per_second': received / elapsed,
+        'latency_p50_ms': statistics.median(latencies) * 1000 if latencies else None,
+        'latency_p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000 if latencies else None,
+        'latency_max_ms': latencies[-1] * 1000 if latencies else None,
+        'queries': queries,
+        'queries_per_vote': queries / received if received else None,
+        'frames_per_client': (sum(c.frames for c in clients) - sum(frames)) / len(clients),
+        'bytes_per_client': sum(c.bytes for c in clients[1:]) / max(len(clients) - 1, 1),
+        'stage_avg_ms': {stage: 1000 * total / count for (stage,), (count, total) in STAGE_SECONDS.totals().items()},
+        'pipeline': server.pipeline.stats.to_dict(server.pipeline.queue.qsize()),
+        'user_cache': scoreboard.users.stats(),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=20000, help='synthetic chat messages')
+    parser.add_argument('--noise', type=float, default=0.1, help='share of synthetic messages that are no vote')
+    parser.add_argument('--rate', type=float, default=0, help='messages per second, 0 for unthrottled')
+    parser.add_argument('--users', type=int, default=5000, help='distinct chat authors')
+    parser.add_argument('--clients', type=int, default=100, help='fake websocket clients')
+    parser.add_argument('--schema', type=int, default=1, help='wire schema of all clients but the measuring one')
+    parser.add_argument('--encoding', default='json', help='wire encoding of all clients but the measuring one')
+    parser.add_argument('--tick-ms', type=int, default=0, help='merge updates into ticks, 0 for one update per vote')
+    parser.add_argument('--burst-every', type=float, default=0, help='seconds between chat bursts')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--replay', help='recorded chat to replay instead of synthetic chat (see chat_source)')
+    parser.add_argument('--speed', type=float, default=0, help='replay time lapse factor, 0 for unthrottled')
+    parser.add_argument('--backend', default='sqlite', choices=['sqlite', 'mysql'])
+    parser.add_argument('--db', help='SQLite file, a temporary file by default')
+    parser.add_argument('--mysql-db', help='scratch MySQL database of the configured server, its tables are dropped')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.backend == 'mysql':
+        if not args.mysql_db:
+            parser.error('--mysql-db is required, the benchmark starts from empty tables')
+        use_database(create_database('mysql', args.mysql_db))
+        with db:
+            db.drop_tables(BaseModel.__subclasses__())
+    else:
+        path = args.db or os.path.join(tempfile.mkdtemp(prefix='livevote-bench-'), 'livevote.db')
+        use_database(create_database('sqlite', path))
+
+    from game import Game
+    with Game():
+        result = asyncio.run(run(args, QueryCounter().install()))
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Serialization cost and size of a vote update report per wire format, against the original
+model_to_dict + to_dict + json.dumps path. Needs no database, all instances are built in memory.
+
+    python -m benchmarks.wire [iterations]
+"""
+import datetime
+import json
+import sys
+import timeit
+
+from playhouse.shortcuts import model_to_dict
+
+from game import gen_vote_report
+from models import to_dict, Country, CountryCache, Event, User, Vote
+from wire import Report, WireFormat, msgpack
+
+
+def sample_vote() -> tuple[Vote, list[Event]]:
+    now = datetime.datetime.now()
+    user = User(user_id='UCx8Y2pNZt0Nq4lJ9wJ4fQbw', channel_url='https://www.youtube.com/channel/UCx8Y2pNZt0Nq4lJ9wJ4fQbw',
+                username='Zoë 🇩🇪', image_url='https://yt4.ggpht.com/ytc/AIdro_k0n1x3G2aY9=s64-c-k-c0x00ffffff-no-rj',
+                is_mod=False, leveling=12.5, total_votes=41, total_points=4350, latest_vote=now)
+    country = Country(alpha2='DE', alpha3='DEU', name='Germany', cache=CountryCache(alpha2='DE', votes=9800, points=999_950))
+    vote = Vote(vote_id=123456, user=user, country=country, vote_count=1, points=112, timestamp=now)
+    event = Event(event_id=321, type='country_points', user=user, country=country, milestone=1_000_000, timestamp=now)
+    return vote, [event]
+
+def legacy(vote: Vote, events: list[Event]) -> bytes:
+    vote_dict = model_to_dict(vote, max_depth=1)
+    vote_dict['user'] = model_to_dict(vote.user, recurse=False)
+    vote_dict['country']['cache'] = model_to_dict(vote.country.cache)
+    report = to_dict({'type': 'update', 'vote': vote_dict, 'events': [model_to_dict(event) for event in events]})
+    return json.dumps(report, ensure_ascii=False).encode('utf-8')
+
+def main(iterations: int = 20000) -> None:
+    vote, events = sample_vote()
+    cases = {'legacy v1/json': lambda: legacy(vote, events)}
+    formats = [WireFormat(1, 'json'), WireFormat(2, 'json')]
+    if msgpack is not None:
+        formats += [WireFormat(1, 'msgpack'), WireFormat(2, 'msgpack')]
+    for wire_format in formats:
+        cases[f'v{wire_format.schema}/{wire_format.encoding}'] = \
+            lambda f=wire_format: Report(gen_vote_report(vote, events)).encode(f)
+
+    print(f'{"format":<16}{"us/report":>12}{"bytes":>8}')
+    for name, case in cases.items():
+        seconds = min(timeit.repeat(case, number=iterations, repeat=3))
+        print(f'{name:<16}{seconds / iterations * 1e6:>12.1f}{len(case()):>8}')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
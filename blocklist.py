@@ -0,0 +1,74 @@
+import datetime
+import heapq
+import threading
+import time
+
+from models import User
+
+
+class Blocklist:
+    """
+    Blocked users in memory, so checking a vote needs no database access: a dict lookup for users that are not
+    blocked. Blocks are removed by `expire` in the order they end, using a heap of end times.
+    The database (User.blocked_until) stays the source of truth, the blocklist is loaded from it on startup.
+    """
+
+    def __init__(self) -> None:
+        self._until: dict[str, float] = {}  # user_id -> end of the block (unix time)
+        self._heap: list[tuple[float, str]] = []  # (end, user_id), one per blocked user
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._until)
+
+    def load(self) -> None:
+        """(Re)loads the blocks that have not ended yet"""
+        now = datetime.datetime.now()
+        query = User.select(User.user_id, User.blocked_until).where(User.blocked_until >= now)
+        with self._lock:
+            self._until = {user_id: until.timestamp() for user_id, until in query.tuples()}
+            self._heap = [(until, user_id) for user_id, until in self._until.items()]
+            heapq.heapify(self._heap)
+
+    def set(self, user_id: str, blocked_until: datetime.datetime | None) -> None:
+        """Applies a (removed) block that was already stored"""
+        with self._lock:
+            previous = self._until.pop(user_id, None)
+            if previous is not None and (previous, user_id) in self._heap:
+                # its old end would stay in the heap until it passed, blocks change rarely enough to rebuild it
+                self._heap.remove((previous, user_id))
+                heapq.heapify(self._heap)
+            if blocked_until is None:
+                return
+            until = blocked_until.timestamp()
+            self._until[user_id] = until
+            heapq.heappush(self._heap, (until, user_id))
+
+    def blocked(self, user_id: str, now: float = None) -> bool:
+        until = self._until.get(user_id)
+        if until is None:
+            return False
+        now = time.time() if now is None else now
+        if now <= until:
+            return True
+        self.expire(now)
+        return False
+
+    def expire(self, now: float = None) -> list[str]:
+        """
+        Removes the blocks that have ended.
+        :return: the users that are no longer blocked
+        """
+
+        now = time.time() if now is None else now
+        expired = []
+        with self._lock:
+            while self._heap and self._heap[0][0] < now:
+                until, user_id = heapq.heappop(self._heap)
+                if self._until.get(user_id) == until:  # skips entries of blocks that changed meanwhile
+                    del self._until[user_id]
+                    expired.append(user_id)
+        return expired
+
+
+blocklist = Blocklist()
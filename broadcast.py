@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+
+from websockets.exceptions import ConnectionClosed
+
+from config import CLIENT_BUFFER_SIZE, CLIENT_MAX_LAG
+from metrics import REPORTS, STAGE_SECONDS
+from wire import DEFAULT_FORMAT, Report, WireFormat
+
+log = logging.getLogger(__name__)
+
+
+class ClientChannel:
+    """
+    Bounded outbound buffer of one websocket client, drained by its own sender task.
+    When the buffer is full the oldest message is dropped, a client that stays behind for longer than
+    `max_lag` seconds is disconnected.
+    A channel created with `start=False` only queues messages until `start` is called, e.g. to send a new client
+    its status report before any update.
+    """
+
+    def __init__(self, websocket, buffer_size: int = CLIENT_BUFFER_SIZE, max_lag: float = CLIENT_MAX_LAG,
+                 wire_format: WireFormat = DEFAULT_FORMAT, start: bool = True) -> None:
+        self.websocket = websocket
+        self.wire_format = wire_format
+        self.max_lag = max_lag
+        self.buffer: deque[tuple[float, bytes]] = deque(maxlen=buffer_size)
+        self.sent = 0
+        self.dropped = 0
+        self.max_send_seconds = 0.0  # slowest single send
+        self._closing = False
+        self._ready = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        if start:
+            self.start()
+
+    @property
+    def lag(self) -> float:
+        """Age of the oldest unsent message in seconds"""
+        return time.monotonic() - self.buffer[0][0] if self.buffer else 0.0
+
+    def offer(self, message: bytes, replace: bool = False) -> None:
+        """
+        Queues a message without waiting for the client.
+        :param message: report encoded in the wire format of this client
+        :param replace: drop everything still queued, for full status reports that supersede older updates
+        """
+
+        if self._closing:
+            return
+        if self.lag > self.max_lag:  # also catches a client stuck in a single send
+            self._disconnect()
+            return
+        if replace:
+            self.dropped += len(self.buffer)
+            self.buffer.clear()
+        elif len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1  # deque drops the oldest message
+        self.buffer.append((time.monotonic(), message))
+        self._ready.set()
+
+    async def _sender(self) -> None:
+        try:
+            while True:
+                await self._ready.wait()
+                self._ready.clear()
+                while self.buffer and not self._closing:
+                    if self.lag > self.max_lag:
+                        self._disconnect()
+                        return
+                    _, message = self.buffer.popleft()
+                    start = time.monotonic()
+                    await self.websocket.send(message, text=self.wire_format.text)
+                    self.max_send_seconds = max(self.max_send_seconds, time.monotonic() - start)
+                    self.sent += 1
+        except ConnectionClosed:
+            pass
+
+    def _disconnect(self) -> None:
+        self._closing = True
+        log.warning('Disconnecting client %s, %.1f seconds behind', self.websocket.remote_address, self.lag)
+        self.buffer.clear()
+        asyncio.create_task(self.websocket.close(1013, 'too slow'))
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._sender())
+
+    def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            'queued': len(self.buffer),
+            'lag_seconds': self.lag,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'max_send_seconds': self.max_send_seconds,
+        }
+
+
+class Broadcaster:
+    """
+    Fans reports out to all connected websocket clients. Each report is encoded once per wire format in use
+    and queued for every client, so a slow client never delays the others.
+    """
+
+    def __init__(self, buffer_size: int = CLIENT_BUFFER_SIZE, max_lag: float = CLIENT_MAX_LAG) -> None:
+        self.buffer_size = buffer_size
+        self.max_lag = max_lag
+        self.channels: dict[object, ClientChannel] = {}
+
+    def __len__(self) -> int:
+        return len(self.channels)
+
+    def register(self, websocket, wire_format: WireFormat = DEFAULT_FORMAT, start: bool = True) -> ClientChannel:
+        """:param start: start sending right away, otherwise messages are queued until ClientChannel.start"""
+        channel = self.channels[websocket] = ClientChannel(websocket, self.buffer_size, self.max_lag, wire_format,
+                                                           start)
+        return channel
+
+    def unregister(self, websocket) -> None:
+        channel = self.channels.pop(websocket, None)
+        if channel is not None:
+            channel.close()
+
+    def broadcast(self, report: Report, replace: bool = False) -> None:
+        start = time.perf_counter()
+        for channel in self.channels.values():
+            channel.offer(report.encode(channel.wire_format), replace)
+        STAGE_SECONDS.observe(time.perf_counter() - start, 'broadcast')
+        REPORTS.inc(1, report.type)
+
+    def stats(self) -> dict:
+        channels = [channel.stats() for channel in self.channels.values()]
+        return {
+            'clients': len(channels),
+            'queued': sum(c['queued'] for c in channels),
+            'dropped': sum(c['dropped'] for c in channels),
+            'max_lag_seconds': max((c['lag_seconds'] for c in channels), default=0.0),
+            'formats': {f'v{f.schema}/{f.encoding}': n for f, n in
+                        Counter(channel.wire_format for channel in self.channels.values()).items()},
+        }
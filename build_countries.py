@@ -0,0 +1,46 @@
+"""
+Build step for the static country table loaded at startup (models/countries.json).
+Run again after upgrading pycountry, country_converter or countryinfo:
+
+    python build_countries.py
+"""
+import json
+import logging
+
+import country_converter
+import pycountry
+from countryinfo import CountryInfo
+
+from models.country import COUNTRY_TABLE_PATH
+
+
+def build_country_table() -> list[dict]:
+    rows = []
+    for country in pycountry.countries:
+        # Attempt to get continent/region via countryinfo
+        continent = None
+        try:
+            continent = CountryInfo(country.name).info().get('region')
+        except Exception:
+            pass
+        # Use the most natural/common country name
+        name = country_converter.convert(names=country.name, to='name_short')
+        # other spellings chat messages are matched against
+        names = [getattr(country, key, None) for key in ('name', 'common_name', 'official_name')]
+        rows.append({
+            'alpha2': country.alpha_2,
+            'alpha3': country.alpha_3,
+            'name': name,
+            'continent': continent,
+            'names': list(dict.fromkeys(n for n in names if n and n != name)),
+        })
+    return sorted(rows, key=lambda row: row['alpha2'])
+
+
+if __name__ == '__main__':
+    logging.getLogger('country_converter').setLevel(logging.ERROR)  # "not found" warnings
+    table = build_country_table()
+    with open(COUNTRY_TABLE_PATH, 'w', encoding='utf-8') as f:
+        # one country per line, keeps the file compact and diffs readable
+        f.write('[\n' + ',\n'.join(json.dumps(row, ensure_ascii=False) for row in table) + '\n]\n')
+    print(f'Wrote {len(table)} countries to {COUNTRY_TABLE_PATH}')
@@ -1,8 +1,14 @@
-import pycountry
-from peewee import fn
+import datetime
+import logging
 
-from models import db, Vote, CountryCache, Country
-from models.country import get_country_data
+from peewee import fn, chunked
+
+from config import FLUSH_BATCH_SIZE
+from models import db, upsert, bulk_update, Vote, CountryCache, Country, User, UserCountry
+from models.country import load_country_table
+from models.settings import get_setting, set_setting
+
+log = logging.getLogger(__name__)
 
 
 """def apply_to_cache(vote: Vote) -> None:
@@ -12,54 +18,196 @@ from models.country import get_country_data
     cache.save()"""
 
 def preset_countries() -> None:
-    for country in pycountry.countries:
-        # Use get_country_data to retrieve enriched info (alpha2, alpha3, name, continent, etc)
-        info = get_country_data(country.alpha_2)
-        if not info:
-            continue  # skip if info could not be found
-        # Create CountryCache if not exists
-        cache, _ = CountryCache.get_or_create(
-            alpha2=info['alpha2'],
-            defaults={'votes': 0, 'points': 0}
-        )
-        # Prepare defaults, only use keys that exist in the Country model
-        defaults = {
-            'alpha3': info.get('alpha3'),
-            'name': info.get('name'),
-            'cache': cache
-        }
+    """
+    Loads the precomputed country table (see build_countries.py) into the database with bulk upserts.
+    Existing caches keep their counters, names and alpha3 codes are refreshed.
+    """
+
+    table = load_country_table()
+    with db.atomic():
+        CountryCache.insert_many(
+            [{'alpha2': info['alpha2'], 'votes': 0, 'points': 0} for info in table]
+        ).on_conflict_ignore().execute()
+        # Prepare rows, only use keys that exist in the Country model
+        fields = [Country.alpha2, Country.alpha3, Country.name, Country.cache]
         # Optionally include continent if it's a column in Country
-        if hasattr(Country, 'continent') and info.get('continent'):
-            defaults['continent'] = info.get('continent')
-        # Create Country if not exists
-        country_obj, _ = Country.get_or_create(
-            alpha2=info['alpha2'],
-            defaults=defaults
-        )
-
-def recalc_cache() -> None:
+        if hasattr(Country, 'continent'):
+            fields.append(Country.continent)
+        rows = [{**info, 'cache': info['alpha2']} for info in table]
+        upsert(
+            Country.insert_many([{field.name: row.get(field.name) for field in fields} for row in rows]),
+            conflict_target=[Country.alpha2],
+            preserve=fields[1:]
+        ).execute()
+
+# Setting holding the highest vote_id whose votes are included in the stored country and user counters
+RECALC_CHECKPOINT = 'recalc_checkpoint'
+
+USER_COUNTERS = [User.leveling, User.total_votes, User.total_points]
+COUNTRY_COUNTERS = [CountryCache.votes, CountryCache.points]
+
+
+def get_checkpoint() -> int | None:
+    value = get_setting(RECALC_CHECKPOINT)
+    return int(value) if value is not None else None
+
+def set_checkpoint(vote_id: int) -> None:
+    set_setting(RECALC_CHECKPOINT, str(vote_id))
+
+def recalc_cache(verify: bool = False) -> dict:
+    """
+    Brings the country and user counters up to date with the Vote table.
+    Only votes newer than the stored checkpoint are aggregated, unless `verify` is set or no checkpoint exists yet,
+    in which case all counters are rebuilt from the full vote history and differences are reported.
+    :param verify: rebuild everything and report drift
+    :return: summary of the recalculation
+    """
+
     with db.atomic():
-        if CountryCache.table_exists():
-            # Set all votes and points to 0 instead of deleting
-            CountryCache.update(votes=0, points=0).execute()
-        if not Vote.table_exists():
-            return  # exit if vote table is empty
-        # For each country, sum votes and points
-        query = (Vote
-                 .select(Vote.country,
-                         fn.COUNT(Vote.vote_id).alias('vote_count'),
-                         fn.SUM(Vote.points).alias('points_sum'))
-                 .where(Vote.redacted == False)
-                 .group_by(Vote.country))
-        for row in query:
-            # Try to update existing cache entry, else create
-            updated = (CountryCache
-                       .update(votes=row.vote_count, points=row.points_sum or 0)
-                       .where(CountryCache.alpha2 == row.country.alpha2)
-                       .execute())
-            if not updated:
-                CountryCache.create(
-                    alpha2=row.country.alpha2,
-                    votes=row.vote_count,
-                    points=row.points_sum or 0
-                )
\ No newline at end of file
+        checkpoint = get_checkpoint()
+        if verify or checkpoint is None:
+            summary = _rebuild_counters()
+        else:
+            summary = _apply_new_votes(checkpoint)
+        set_checkpoint(summary['checkpoint'])
+    return summary
+
+def _apply_new_votes(checkpoint: int) -> dict:
+    """Adds the votes after the checkpoint to the stored counters"""
+    last_vote_id = Vote.select(fn.MAX(Vote.vote_id)).where(Vote.vote_id > checkpoint).scalar()
+    summary = {'mode': 'incremental', 'votes': 0, 'checkpoint': checkpoint, 'drift': []}
+    if last_vote_id is None:
+        return summary
+    new_votes = (Vote.vote_id > checkpoint) & (Vote.vote_id <= last_vote_id) & (Vote.redacted == False)
+
+    country_rows = list(
+        Vote.select(Vote.country.alias('alpha2'),
+                    fn.SUM(Vote.vote_count).alias('votes'),
+                    fn.SUM(Vote.points).alias('points'))
+        .where(new_votes)
+        .group_by(Vote.country)
+        .dicts()
+    )
+    user_rows = list(
+        Vote.select(Vote.user.alias('user_id'),
+                    fn.SUM(Vote.xp_gain).alias('leveling'),
+                    fn.SUM(Vote.vote_count).alias('total_votes'),
+                    fn.SUM(Vote.points).alias('total_points'),
+                    fn.MAX(Vote.timestamp).alias('latest_vote'))
+        .where(new_votes)
+        .group_by(Vote.user)
+        .dicts()
+    )
+    for batch in chunked(country_rows, FLUSH_BATCH_SIZE):
+        bulk_update(CountryCache.alpha2, batch, COUNTRY_COUNTERS, increment=True)
+    for batch in chunked(user_rows, FLUSH_BATCH_SIZE):
+        bulk_update(User.user_id, batch, USER_COUNTERS, increment=True)
+        bulk_update(User.user_id, batch, [User.latest_vote])
+    user_country_rows = list(
+        Vote.select(Vote.user, Vote.country,
+                    fn.SUM(Vote.vote_count).alias('votes'),
+                    fn.SUM(Vote.points).alias('points'))
+        .where(new_votes)
+        .group_by(Vote.user, Vote.country)
+        .dicts()
+    )
+    for batch in chunked(user_country_rows, FLUSH_BATCH_SIZE):
+        upsert(
+            UserCountry.insert_many(batch),
+            conflict_target=[UserCountry.user, UserCountry.country],
+            increment=[UserCountry.votes, UserCountry.points]
+        ).execute()
+
+    summary['votes'] = int(sum(row['votes'] for row in country_rows))
+    summary['checkpoint'] = last_vote_id
+    return summary
+
+def _rebuild_counters() -> dict:
+    """
+    Recomputes country, user and user per country counters in a single pass over all votes,
+    grouped by user and country. Only rows that differ from the stored values are written.
+    """
+
+    last_vote_id = Vote.select(fn.MAX(Vote.vote_id)).scalar()
+    countries: dict[str, dict] = {}
+    users: dict[str, dict] = {}
+    user_countries: dict[tuple[str, str], tuple[int, int]] = {}
+    query = (Vote
+             .select(Vote.user, Vote.country,
+                     fn.SUM(Vote.vote_count).alias('votes'),
+                     fn.SUM(Vote.points).alias('points'),
+                     fn.SUM(Vote.xp_gain).alias('xp'),
+                     fn.MAX(Vote.timestamp).alias('latest_vote'))
+             .where((Vote.redacted == False) & (Vote.vote_id <= (last_vote_id or 0)))
+             .group_by(Vote.user, Vote.country)
+             .tuples())
+    for user_id, alpha2, votes, points, xp, latest_vote in query:
+        user_countries[(user_id, alpha2)] = (int(votes or 0), int(points or 0))
+        country = countries.setdefault(alpha2, {'alpha2': alpha2, 'votes': 0, 'points': 0})
+        country['votes'] += int(votes or 0)
+        country['points'] += int(points or 0)
+        user = users.setdefault(user_id, {'user_id': user_id, 'leveling': 0.0, 'total_votes': 0.0,
+                                          'total_points': 0.0, 'latest_vote': None})
+        user['leveling'] += float(xp or 0)
+        user['total_votes'] += float(votes or 0)
+        user['total_points'] += float(points or 0)
+        if isinstance(latest_vote, str):  # SQLite returns aggregated datetimes as text
+            latest_vote = datetime.datetime.fromisoformat(latest_vote)
+        if user['latest_vote'] is None or (latest_vote and latest_vote > user['latest_vote']):
+            user['latest_vote'] = latest_vote
+
+    drift = []
+    drifted_countries = []
+    for cc in CountryCache.select():
+        expected = countries.pop(cc.alpha2, None) or {'alpha2': cc.alpha2, 'votes': 0, 'points': 0}
+        changed = [field.name for field in COUNTRY_COUNTERS if (getattr(cc, field.name) or 0) != expected[field.name]]
+        drift.extend(('country', cc.alpha2, name, getattr(cc, name), expected[name]) for name in changed)
+        if changed:
+            drifted_countries.append(expected)
+    if countries:  # votes for countries without a cache row
+        drift.extend(('country', alpha2, 'votes', None, row['votes']) for alpha2, row in countries.items())
+        CountryCache.insert_many(list(countries.values())).execute()
+
+    drifted_users = []
+    for user in User.select(User.user_id, *USER_COUNTERS):
+        expected = users.get(user.user_id) or {'user_id': user.user_id, 'leveling': 0.0, 'total_votes': 0.0,
+                                               'total_points': 0.0, 'latest_vote': None}
+        changed = [field.name for field in USER_COUNTERS
+                   if abs((getattr(user, field.name) or 0) - expected[field.name]) > 1e-6]
+        drift.extend(('user', user.user_id, name, getattr(user, name), expected[name]) for name in changed)
+        if changed:
+            drifted_users.append(expected)
+
+    drifted_user_countries = []
+    for uc in UserCountry.select(UserCountry.user, UserCountry.country, UserCountry.votes, UserCountry.points):
+        stored = (uc.votes, uc.points)
+        expected = user_countries.pop((uc.user_id, uc.country_id), (0, 0))
+        if stored != expected:
+            drift.append(('user_country', (uc.user_id, uc.country_id), 'votes, points', stored, expected))
+            drifted_user_countries.append({'user': uc.user_id, 'country': uc.country_id,
+                                           'votes': expected[0], 'points': expected[1]})
+    for (user_id, alpha2), expected in user_countries.items():  # pairs without a row
+        drift.append(('user_country', (user_id, alpha2), 'votes, points', None, expected))
+        drifted_user_countries.append({'user': user_id, 'country': alpha2, 'votes': expected[0], 'points': expected[1]})
+
+    for batch in chunked(drifted_countries, FLUSH_BATCH_SIZE):
+        bulk_update(CountryCache.alpha2, batch, COUNTRY_COUNTERS)
+    for batch in chunked(drifted_users, FLUSH_BATCH_SIZE):
+        bulk_update(User.user_id, batch, USER_COUNTERS + [User.latest_vote])
+    for batch in chunked(drifted_user_countries, FLUSH_BATCH_SIZE):
+        upsert(
+            UserCountry.insert_many(batch),
+            conflict_target=[UserCountry.user, UserCountry.country],
+            preserve=[UserCountry.votes, UserCountry.points]
+        ).execute()
+
+    for kind, key, field, stored, expected in drift[:20]:
+        log.warning('Drift in %s %s: %s was %s, should be %s', kind, key, field, stored, expected)
+    if len(drift) > 20:
+        log.warning('... and %d more drifted counters', len(drift) - 20)
+    return {
+        'mode': 'full',
+        'votes': int(sum(row['total_votes'] for row in users.values())),
+        'checkpoint': last_vote_id or 0,
+        'drift': drift,
+    }
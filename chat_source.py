@@ -0,0 +1,416 @@
+"""
+Sources of chat messages for the ingestion pipeline.
+A source is an async iterable of chat items with the attributes of pytchat items that are used here:
+id, message, timestamp (epoch ms) and author (channelId, name, channelUrl, imageUrl, isChatModerator).
+"""
+import abc
+import asyncio
+import itertools
+import json
+import logging
+import queue
+import random
+import threading
+import time
+from typing import AsyncIterator, Awaitable, Callable
+
+from config import CHAT_POLL_MIN, CHAT_POLL_MAX, CHAT_POLL_TARGET, CHAT_RESTART_MIN, CHAT_RESTART_MAX
+from metrics import CHAT_LAG_SECONDS, CHAT_POLL_ITEMS, CHAT_POLL_SECONDS
+from models.country import load_country_table
+from resolver import flag_emoji
+
+log = logging.getLogger(__name__)
+
+
+class ChatAuthor:
+    __slots__ = ('channelId', 'name', 'channelUrl', 'imageUrl', 'isChatModerator')
+
+    def __init__(self, channelId: str, name: str, channelUrl: str = '', imageUrl: str = '',
+                 isChatModerator: bool = False) -> None:
+        self.channelId = channelId
+        self.name = name
+        self.channelUrl = channelUrl
+        self.imageUrl = imageUrl
+        self.isChatModerator = isChatModerator
+
+
+class ChatItem:
+    __slots__ = ('id', 'message', 'timestamp', 'author')
+
+    def __init__(self, id: str, message: str, timestamp: int, author: ChatAuthor) -> None:
+        self.id = id
+        self.message = message
+        self.timestamp = timestamp
+        self.author = author
+
+
+def item_to_dict(item) -> dict:
+    """JSON line of a recording, see ReplaySource"""
+    author = item.author
+    return {
+        'id': item.id,
+        'message': item.message,
+        'timestamp': int(item.timestamp),
+        'author': {
+            'channelId': author.channelId,
+            'name': str(author.name),
+            'channelUrl': str(author.channelUrl),
+            'imageUrl': str(author.imageUrl),
+            'isChatModerator': bool(author.isChatModerator),
+        },
+    }
+
+def item_from_dict(data: dict) -> ChatItem:
+    return ChatItem(data['id'], data['message'], data['timestamp'], ChatAuthor(**data['author']))
+
+
+class ChatSource(abc.ABC):
+    """Interface of chat sources, iterate it with `async for item in source`"""
+
+    name = 'chat'
+
+    def __aiter__(self) -> AsyncIterator:
+        return self.items()
+
+    @abc.abstractmethod
+    def items(self) -> AsyncIterator:
+        """The chat items, usually an async generator"""
+
+    def stats(self) -> dict:
+        return {}
+
+
+class PytchatSource(ChatSource):
+    """
+    Live chat of a YouTube stream. Restarts the pytchat session whenever it dies, never ends.
+    Restarts back off exponentially from `min_backoff` up to `max_backoff` seconds while sessions keep dying,
+    `state` tells whether the chat is live.
+    pytchat blocks while it fetches and parses, so it is polled by a producer thread, which hands the items of
+    each poll to the event loop through a bounded queue (a full queue holds the producer back).
+    The poll interval follows the observed message rate, aiming at `target_items` per poll between
+    `min_interval` and `max_interval`: quiet chats are polled rarely, busy chats often.
+    """
+
+    def __init__(self, video_id: str, min_interval: float = CHAT_POLL_MIN, max_interval: float = CHAT_POLL_MAX,
+                 target_items: int = CHAT_POLL_TARGET, max_pending: int = 100,
+                 min_backoff: float = CHAT_RESTART_MIN, max_backoff: float = CHAT_RESTART_MAX) -> None:
+        self.video_id = video_id
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_items = target_items
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.name = f'youtube:{video_id}'
+        self.state = 'stopped'  # connecting, live, restarting, stopped
+        self.errors = 0
+        self.last_error: str | None = None
+        self.interval = min_interval  # current poll interval
+        self.rate = 0.0  # messages per second, smoothed over the last polls
+        self.sessions = 0
+        self.polls = 0
+        self.items_total = 0
+        self.poll_seconds = 0.0  # total time spent in pytchat
+        self.max_poll_seconds = 0.0
+        self.lag_seconds = 0.0  # total time polled items waited for the event loop
+        self.max_lag_seconds = 0.0
+        self._polls: queue.Queue[tuple[float, list]] = queue.Queue(maxsize=max_pending)
+        self._stop: threading.Event | None = None  # of the current producer thread
+
+    async def items(self) -> AsyncIterator:
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        # a new event per producer, the producer of a previous iteration may still be winding down
+        stop = self._stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(loop, ready, stop), name=f'pytchat-{self.video_id}',
+                                    daemon=True)
+        producer.start()
+        try:
+            while True:
+                await ready.wait()
+                ready.clear()  # set again by any poll queued from now on
+                while True:
+                    try:
+                        polled_at, items = self._polls.get_nowait()
+                    except queue.Empty:
+                        break
+                    lag = time.monotonic() - polled_at
+                    self.lag_seconds += lag
+                    self.max_lag_seconds = max(self.max_lag_seconds, lag)
+                    CHAT_LAG_SECONDS.observe(lag)
+                    for c in items:
+                        yield c
+        finally:
+            stop.set()
+
+    def _produce(self, loop: asyncio.AbstractEventLoop, ready: asyncio.Event, stop: threading.Event) -> None:
+        import pytchat
+
+        backoff = self.min_backoff
+        while not stop.is_set():
+            started = time.monotonic()
+            try:
+                self.state = 'connecting'
+                log.info("Creating new pytchat session for %s...", self.video_id)
+                # signal handlers can only be installed by the main thread
+                chat = pytchat.create(video_id=self.video_id, interruptable=False)
+                self.sessions += 1
+                self.state = 'live'
+                last = time.monotonic()
+                while chat.is_alive() and not stop.is_set():
+                    start = time.monotonic()
+                    items = list(chat.get().sync_items())
+                    now = time.monotonic()
+                    self._record_poll(now - start, len(items), now - last)
+                    last = now
+                    if items and not self._hand_over(now, items, loop, ready, stop):
+                        break
+                    stop.wait(self.interval)
+                chat.terminate()
+                reason = 'Chat session is no longer alive'
+            except Exception as e:
+                self.errors += 1
+                self.last_error = str(e)
+                reason = f'Exception in chat producer: {e}'
+            if stop.is_set():
+                break
+            if time.monotonic() - started >= self.max_backoff:
+                backoff = self.min_backoff  # the session was healthy for a while
+            self.state = 'restarting'
+            log.warning("%s (%s), restarting in %.0f seconds...", reason, self.video_id, backoff)
+            stop.wait(backoff)
+            backoff = min(2 * backoff, self.max_backoff)
+        if self._stop is stop:  # not restarted meanwhile
+            self.state = 'stopped'
+
+    def _hand_over(self, polled_at: float, items: list, loop: asyncio.AbstractEventLoop, ready: asyncio.Event,
+                   stop: threading.Event) -> bool:
+        """Queues the items of a poll for the event loop, False once the source was closed"""
+        while not stop.is_set():
+            try:
+                self._polls.put((polled_at, items), timeout=1)
+                break
+            except queue.Full:
+                continue
+        try:
+            loop.call_soon_threadsafe(ready.set)
+        except RuntimeError:  # event loop closed
+            stop.set()
+            return False
+        return not stop.is_set()
+
+    def _record_poll(self, seconds: float, count: int, elapsed: float) -> None:
+        """Updates the statistics and adapts the poll interval to the message rate"""
+        self.polls += 1
+        self.items_total += count
+        self.poll_seconds += seconds
+        self.max_poll_seconds = max(self.max_poll_seconds, seconds)
+        CHAT_POLL_SECONDS.observe(seconds)
+        CHAT_POLL_ITEMS.observe(count)
+        rate = count / elapsed if elapsed > 0 else 0.0
+        self.rate = rate if self.polls == 1 else 0.7 * self.rate + 0.3 * rate
+        interval = self.target_items / self.rate if self.rate > 0 else self.max_interval
+        self.interval = min(self.max_interval, max(self.min_interval, interval))
+
+    def stats(self) -> dict:
+        handed_over = self.polls - self._polls.qsize()
+        return {
+            'state': self.state,
+            'sessions': self.sessions,
+            'errors': self.errors,
+            'last_error': self.last_error,
+            'polls': self.polls,
+            'items': self.items_total,
+            'avg_items_per_poll': self.items_total / self.polls if self.polls else 0,
+            'avg_poll_ms': 1000 * self.poll_seconds / self.polls if self.polls else 0,
+            'max_poll_ms': 1000 * self.max_poll_seconds,
+            'interval': self.interval,
+            'rate': self.rate,
+            'pending_polls': self._polls.qsize(),
+            'avg_lag_ms': 1000 * self.lag_seconds / handed_over if handed_over > 0 else 0,
+            'max_lag_ms': 1000 * self.max_lag_seconds,
+        }
+
+
+class SyntheticSource(ChatSource):
+    """
+    Generated chat for load tests. Countries and users are drawn from Zipf distributions, so a few countries and
+    users get most votes like in a real stream. Votes are written as alpha2 codes, flags or country names.
+    :param rate: messages per second, 0 for as fast as the consumer takes them
+    :param count: messages in total, None for no end
+    :param countries: alpha2 codes that are voted for, all countries by default
+    :param users: number of distinct authors
+    :param country_skew: Zipf exponent of the country popularity
+    :param user_skew: Zipf exponent of the user activity
+    :param noise: share of messages that are no vote
+    :param burst_every: seconds between bursts, 0 for none
+    :param burst_length: seconds a burst lasts
+    :param burst_factor: rate multiplier during a burst
+    :param seed: random seed, runs with the same seed produce the same chat
+    """
+
+    name = 'synthetic'
+
+    def __init__(self, rate: float = 100, count: int | None = 10000, countries: list[str] = None, users: int = 1000,
+                 country_skew: float = 1.1, user_skew: float = 1.2, noise: float = 0.1, burst_every: float = 0,
+                 burst_length: float = 1, burst_factor: float = 10, seed: int = 0) -> None:
+        self.rate = rate
+        self.count = count
+        table = {row['alpha2']: row for row in load_country_table()}
+        self.countries = [table[alpha2] for alpha2 in countries] if countries else list(table.values())
+        self.users = users
+        self.noise = noise
+        self.burst_every = burst_every
+        self.burst_length = burst_length
+        self.burst_factor = burst_factor
+        self.random = random.Random(seed)
+        self._country_weights = list(itertools.accumulate(1 / k ** country_skew for k in range(1, len(self.countries) + 1)))
+        self._user_weights = list(itertools.accumulate(1 / k ** user_skew for k in range(1, users + 1)))
+        self.random.shuffle(self.countries)  # popularity independent of the alphabet
+
+    def message(self, n: int) -> ChatItem:
+        rnd = self.random
+        user = rnd.choices(range(self.users), cum_weights=self._user_weights)[0]
+        if rnd.random() < self.noise:
+            message = rnd.choice(['hello!', 'great stream', 'lol', '???', 'where is this?'])
+        else:
+            country = rnd.choices(self.countries, cum_weights=self._country_weights)[0]
+            message = rnd.choice([country['alpha2'], flag_emoji(country['alpha2']), country['name']])
+        author = ChatAuthor(f'UCsynthetic{user:08d}', f'user{user}', f'https://www.youtube.com/channel/UCsynthetic{user:08d}',
+                            f'https://yt3.ggpht.com/synthetic/{user}', isChatModerator=user == 0)
+        return ChatItem(f'synthetic-{n}', message, int(time.time() * 1000), author)
+
+    def current_rate(self, elapsed: float) -> float:
+        if self.burst_every and elapsed % self.burst_every < self.burst_length:
+            return self.rate * self.burst_factor
+        return self.rate
+
+    async def items(self) -> AsyncIterator:
+        start = last = time.monotonic()
+        due = 0.0  # messages owed according to the rate
+        for n in itertools.count(1) if self.count is None else range(1, self.count + 1):
+            if self.rate:
+                while due < 1:
+                    await asyncio.sleep(0.005)
+                    now = time.monotonic()
+                    due += self.current_rate(now - start) * (now - last)
+                    last = now
+                due -= 1
+            elif n % 100 == 0:
+                await asyncio.sleep(0)  # let the consumers run
+            yield self.message(n)
+
+
+class ReplaySource(ChatSource):
+    """
+    Replays a recording (JSON lines, see RecordingSource) with the original pauses between messages.
+    :param speed: time lapse factor, 0 for as fast as the consumer takes them
+    """
+
+    def __init__(self, path: str, speed: float = 1.0) -> None:
+        self.path = path
+        self.speed = speed
+        self.name = f'replay:{path}'
+
+    async def items(self) -> AsyncIterator:
+        previous = None
+        with open(self.path, encoding='utf-8') as f:
+            for n, line in enumerate(f):
+                if not line.strip():
+                    continue
+                item = item_from_dict(json.loads(line))
+                if self.speed and previous is not None and item.timestamp > previous:
+                    await asyncio.sleep((item.timestamp - previous) / 1000 / self.speed)
+                elif n % 100 == 0:
+                    await asyncio.sleep(0)
+                previous = item.timestamp
+                yield item
+
+
+class RecordingSource(ChatSource):
+    """Passes the items of another source through and appends them to a recording for ReplaySource"""
+
+    def __init__(self, source: ChatSource, path: str) -> None:
+        self.source = source
+        self.path = path
+        self.name = source.name
+
+    async def items(self) -> AsyncIterator:
+        with open(self.path, 'a', encoding='utf-8') as f:
+            async for item in self.source:
+                f.write(json.dumps(item_to_dict(item), ensure_ascii=False) + '\n')
+                f.flush()
+                yield item
+
+
+class ChatWatcher:
+    """
+    Feeds one chat source into the ingestion pipeline, with its own health state and throughput counters.
+    Every source runs in its own watcher task, so a dead or slow source only holds back its own watcher.
+    A failing source is restarted with exponential backoff, a source that ends (recordings) finishes its watcher.
+    :param put: queues an item for ingestion, returns whether it was queued (False for duplicates)
+    """
+
+    def __init__(self, source: ChatSource, put: Callable[[object], Awaitable[bool]],
+                 min_backoff: float = CHAT_RESTART_MIN, max_backoff: float = CHAT_RESTART_MAX) -> None:
+        self.source = source
+        self.put = put
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.state = 'idle'  # running, backoff, finished
+        self.items = 0  # items received from the source
+        self.queued = 0  # items handed to the pipeline
+        self.duplicates = 0
+        self.errors = 0
+        self.restarts = 0
+        self.last_error: str | None = None
+        self.last_item_at: float | None = None
+        self.started = time.monotonic()
+
+    async def run(self) -> None:
+        backoff = self.min_backoff
+        while True:
+            started = time.monotonic()
+            self.state = 'running'
+            try:
+                async for item in self.source:
+                    self.items += 1
+                    self.last_item_at = time.monotonic()
+                    if await self.put(item):
+                        self.queued += 1
+                    else:
+                        self.duplicates += 1
+                self.state = 'finished'
+                return
+            except Exception as e:
+                self.errors += 1
+                self.last_error = str(e)
+                if time.monotonic() - started >= self.max_backoff:
+                    backoff = self.min_backoff
+                self.state = 'backoff'
+                log.error("Exception in chat watcher of %s: %s. Restarting in %.0f seconds...",
+                          self.source.name, e, backoff)
+                await asyncio.sleep(backoff)
+                backoff = min(2 * backoff, self.max_backoff)
+                self.restarts += 1
+
+    @property
+    def healthy(self) -> bool:
+        """Running, and the source itself (if it tells) is live"""
+        return self.state in ('running', 'finished') and self.source.stats().get('state', 'live') == 'live'
+
+    def stats(self) -> dict:
+        uptime = time.monotonic() - self.started
+        return {
+            'source': self.source.name,
+            'state': self.state,
+            'healthy': self.healthy,
+            'items': self.items,
+            'queued': self.queued,
+            'duplicates': self.duplicates,
+            'items_per_second': self.items / uptime if uptime else 0,
+            'seconds_since_item': time.monotonic() - self.last_item_at if self.last_item_at is not None else None,
+            'errors': self.errors,
+            'restarts': self.restarts,
+            'last_error': self.last_error,
+            'details': self.source.stats(),
+        }
@@ -1,9 +1,46 @@
 import asyncio
+import datetime
 import json
 
+from blocklist import blocklist
+from db_executor import db_executor
 from game import Game
-from models.user import block_user
-from web_socket import gen_status_report
+from models import User
+from models.user import block_user, get_user
+from moderation import redact_votes
+from scoreboard import scoreboard
+from snapshot import status_snapshot
+from windows import parse_duration
+
+
+def _block_user(user_name: str, block_duration_seconds: int | bool = None) -> User | None:
+    """:return: the updated user, None if the user does not exist"""
+    user = block_user(user_name=user_name, block_duration_seconds=block_duration_seconds)
+    if user is not None:
+        # votes are checked against the blocklist, rankings against the cached instance of the user
+        scoreboard.set_blocked(user.user_id, user.blocked_until)
+        blocklist.set(user.user_id, user.blocked_until)
+        status_snapshot.invalidate()  # the user ranking hides blocked users
+    return user
+
+def _redact_votes(param: str) -> int | None:
+    """
+    Redacts the votes of a user, all of them or those of a trailing duration: `spammer` or `spammer 30m`
+    :return: number of redacted votes, None if the user does not exist
+    """
+
+    user_name, since = param, None
+    if ' ' in param:
+        name, duration = param.rsplit(maxsplit=1)
+        try:
+            since = datetime.datetime.now() - datetime.timedelta(seconds=parse_duration(duration))
+            user_name = name
+        except ValueError:
+            pass  # part of the name
+    user = get_user(user_name=user_name)
+    if user is None:
+        return None
+    return redact_votes(user, since)
 
 
 class CLIClient:
@@ -24,20 +61,20 @@ class CLIClient:
             cmd = cmd.lower()
 
             if cmd == 'status':
-                print(json.dumps(gen_status_report(), indent=2))
+                print(json.dumps(await db_executor.run(status_snapshot.report), indent=2))
             elif cmd == 'block':
-                success = block_user(user_name=param)
-                if not success:
-                    print('Unsuccessful block, or faulty request.')
+                user = await db_executor.run(_block_user, param)
+                print('User not found!' if user is None else f'Blocked {user.username} until {user.blocked_until}.')
             elif cmd == 'unblock':
-                success = block_user(user_name=param, block_duration_seconds=False)
-                if not success:
-                    print('Unsuccessful at reverting user block, or faulty request.')
+                user = await db_executor.run(_block_user, param, block_duration_seconds=False)
+                print('User not found!' if user is None else f'Unblocked {user.username}.')
+            elif cmd == 'redact':
+                count = await db_executor.run(_redact_votes, param, timeout=None)
+                print('User not found!' if count is None else f'Redacted {count} votes.')
             elif cmd == 'quit':
                 print("Shutting down...")
                 for client in list(self.clients):
                     await client.close()
-                asyncio.get_event_loop().stop()
-                break
+                break  # ends main.main
             else:
                 print(f"Unknown command: {cmd}")
@@ -0,0 +1,120 @@
+import os
+
+from dotenv import dotenv_values
+
+# Runtime settings, read from .env with environment variables taking precedence
+env = {**dotenv_values(), **os.environ}
+
+
+def get_float(key: str, default: float) -> float:
+    value = env.get(key)
+    return float(value) if value not in (None, '') else default
+
+
+def get_int(key: str, default: int) -> int:
+    value = env.get(key)
+    return int(value) if value not in (None, '') else default
+
+
+# "mysql", or "sqlite" for a local database file without a server (single box deployments, tests, benchmarks)
+DB_BACKEND = (env.get('DB_BACKEND') or 'mysql').lower()
+# database file of the sqlite backend
+DB_PATH = env.get('DB_PATH') or 'livevote.db'
+# server, database and credentials of the mysql backend
+DB_HOST = env.get('DB_HOST') or 'localhost'
+DB_PORT = get_int('DB_PORT', 3306)
+DB_NAME = env.get('DB_NAME') or 'livevote'
+DB_USER = env.get('DB_USER')
+DB_PASSWD = env.get('DB_PASSWD') or ''
+# connections used by the worker threads of db_executor, plus one for setup and shutdown on the main thread
+DB_POOL_SIZE = get_int('DB_POOL_SIZE', 4)
+# seconds a single query may take before the connection gives up on it
+DB_QUERY_TIMEOUT = get_int('DB_QUERY_TIMEOUT', 10)
+
+# seconds between two write-behind flushes of the scoreboard
+FLUSH_INTERVAL = get_float('FLUSH_INTERVAL', 2.0)
+# maximum rows per upsert statement when flushing
+FLUSH_BATCH_SIZE = get_int('FLUSH_BATCH_SIZE', 500)
+
+# maximum number of chat messages processed together in one batch
+INGEST_BATCH_SIZE = get_int('INGEST_BATCH_SIZE', 200)
+# seconds a batch waits for more messages before it is processed anyway
+INGEST_MAX_LATENCY = get_float('INGEST_MAX_LATENCY', 0.05)
+# pending chat messages before the chat watcher is slowed down
+INGEST_QUEUE_SIZE = get_int('INGEST_QUEUE_SIZE', 10000)
+
+# rebuild all counters from the full vote history on startup and report drift, instead of only adding new votes
+RECALC_VERIFY = env.get('RECALC_VERIFY', '').lower() in ('1', 'true', 'yes')
+
+# JSON object mapping extra country names (lower case) to alpha2 codes
+COUNTRY_ALIASES_PATH = env.get('COUNTRY_ALIASES_PATH') or os.path.join(os.path.dirname(__file__), 'country_aliases.json')
+
+# users kept in memory by the user cache (profiles and counters)
+USER_CACHE_SIZE = get_int('USER_CACHE_SIZE', 50000)
+
+# messages buffered per websocket client before the oldest updates are dropped
+CLIENT_BUFFER_SIZE = get_int('CLIENT_BUFFER_SIZE', 256)
+# seconds a client may stay behind (oldest unsent message) before it is disconnected
+CLIENT_MAX_LAG = get_float('CLIENT_MAX_LAG', 15.0)
+
+# milliseconds between merged update frames, 0 sends one update per vote
+TICK_MS = get_int('TICK_MS', 0)
+# latest votes carried by one merged frame, older votes of the same tick only count towards the country deltas
+TICK_MAX_VOTES = get_int('TICK_MAX_VOTES', 50)
+
+# YouTube stream whose chat is watched
+VIDEO_ID = env.get('VIDEO_ID') or 'hTwVzwT4Yno'
+# YouTube streams whose chats all count towards the same game, comma separated (e.g. regional restreams)
+VIDEO_IDS = [video_id.strip() for video_id in (env.get('VIDEO_IDS') or VIDEO_ID).split(',') if video_id.strip()]
+
+# logging level of the server (DEBUG, INFO, WARNING, ...)
+LOG_LEVEL = (env.get('LOG_LEVEL') or 'INFO').upper()
+# only every n-th vote is logged (at DEBUG level), logging each one would slow busy chats down
+LOG_SAMPLE_EVERY = get_int('LOG_SAMPLE_EVERY', 100)
+
+# latest votes and events kept in memory for status reports
+RECENT_SIZE = get_int('RECENT_SIZE', 20)
+
+# append-only journal of accepted votes, with snapshots of the counters next to it (JOURNAL_PATH.snapshot),
+# so startup replays the journal instead of aggregating the vote table; empty to disable
+JOURNAL_PATH = env.get('JOURNAL_PATH') or ''
+# seconds between two syncs of the journal to disk, votes of this period can be lost with the machine
+JOURNAL_FSYNC_INTERVAL = get_float('JOURNAL_FSYNC_INTERVAL', 0.2)
+# seconds between two snapshots, bounds the part of the journal replayed on startup
+JOURNAL_SNAPSHOT_INTERVAL = get_float('JOURNAL_SNAPSHOT_INTERVAL', 300.0)
+
+# sliding windows of the "hot right now" rankings in status reports, comma separated durations (s, m, h, d)
+LEADERBOARD_WINDOWS = env.get('LEADERBOARD_WINDOWS', '5m,1h,1d')
+# time buckets per window, votes expire one bucket at a time (5s buckets for a 5m window)
+WINDOW_BUCKETS = get_int('WINDOW_BUCKETS', 60)
+# countries and users per windowed ranking
+WINDOW_TOP = get_int('WINDOW_TOP', 10)
+
+# chat item ids remembered to drop items delivered twice, e.g. after a chat session restart
+DEDUPE_SIZE = get_int('DEDUPE_SIZE', 100000)
+# seconds a chat item id is remembered
+DEDUPE_TTL = get_float('DEDUPE_TTL', 3600.0)
+
+# seconds between two polls of the YouTube chat, adapted to the message rate within these bounds
+CHAT_POLL_MIN = get_float('CHAT_POLL_MIN', 0.1)
+CHAT_POLL_MAX = get_float('CHAT_POLL_MAX', 2.0)
+# chat messages per poll the poll interval aims at
+CHAT_POLL_TARGET = get_int('CHAT_POLL_TARGET', 20)
+# seconds before a dead chat session or failed chat source is restarted, doubled while it keeps failing
+CHAT_RESTART_MIN = get_float('CHAT_RESTART_MIN', 2.0)
+CHAT_RESTART_MAX = get_float('CHAT_RESTART_MAX', 60.0)
+
+# websocket fanout worker processes, 0 serves clients from the main process (see fanout.py)
+FANOUT_WORKERS = get_int('FANOUT_WORKERS', 0)
+# Unix socket the main process publishes reports on, in a directory only writable by this user;
+# empty for a new private directory per run (in $XDG_RUNTIME_DIR if set)
+FANOUT_SOCKET = env.get('FANOUT_SOCKET') or ''
+# unsent bytes per worker before it is disconnected and has to start over
+FANOUT_MAX_BUFFER = get_int('FANOUT_MAX_BUFFER', 64 * 1024 * 1024)
+# port of /metrics of the main process when the workers serve the websocket port
+FANOUT_METRICS_PORT = get_int('FANOUT_METRICS_PORT', 6790)
+
+# milestone events, comma separated type:subject.metric[@window]:base[:minimum] (see milestones.py), firing at the
+# powers of base from minimum on. Subjects and metrics: user.level, user.points, user.votes, country.points,
+# country.votes, windowed (@ a LEADERBOARD_WINDOWS name) only points and votes; e.g. country_votes:country.votes:10:100
+MILESTONE_RULES = env.get('MILESTONE_RULES', 'user_level_up:user.level:10,country_points:country.points:10:1000')
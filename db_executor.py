@@ -0,0 +1,54 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from config import DB_POOL_SIZE, DB_QUERY_TIMEOUT
+from models import db
+
+
+class DBExecutor:
+    """
+    Runs blocking peewee work on a pool of worker threads, so the event loop keeps serving websockets.
+    Every worker checks a connection out of the pool for the duration of one call.
+    """
+
+    def __init__(self, workers: int = DB_POOL_SIZE, timeout: float = DB_QUERY_TIMEOUT) -> None:
+        self.workers = workers
+        self.timeout = timeout
+        self.busy = 0  # calls currently running on a worker
+        self._busy_lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='db')
+
+    def _call(self, func: Callable, args: tuple, kwargs: dict) -> Any:
+        with self._busy_lock:
+            self.busy += 1
+        db.connect(reuse_if_open=True)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            db.close()  # returns the connection to the pool
+            with self._busy_lock:
+                self.busy -= 1
+
+    async def run(self, func: Callable, *args, timeout: float | None = ..., **kwargs) -> Any:
+        """
+        Awaits `func(*args, **kwargs)` executed on a database worker.
+        :param timeout: seconds to wait for the result, defaults to the executor timeout, None waits forever.
+        A timed out call keeps running on its worker until the connection's read timeout aborts its query.
+        """
+
+        if timeout is ...:
+            timeout = self.timeout
+        future = asyncio.get_running_loop().run_in_executor(
+            self._pool, functools.partial(self._call, func, args, kwargs)
+        )
+        return await asyncio.wait_for(future, timeout)
+
+    def shutdown(self) -> None:
+        """Waits for running calls to finish"""
+        self._pool.shutdown(wait=True)
+
+
+db_executor = DBExecutor()
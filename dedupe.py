@@ -0,0 +1,48 @@
+import time
+from collections import OrderedDict
+from typing import Hashable
+
+from config import DEDUPE_SIZE, DEDUPE_TTL
+
+
+class SeenIds:
+    """
+    Ids seen within the last `ttl` seconds, at most `max_size` of them, e.g. of chat items that a restarted chat
+    session may deliver again. Ids are kept in the order they were first seen, so expired ids are always at the
+    front: checking and adding an id costs O(1), expiring costs O(1) per expired id.
+    """
+
+    def __init__(self, max_size: int = DEDUPE_SIZE, ttl: float = DEDUPE_TTL) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._seen: OrderedDict[Hashable, float] = OrderedDict()  # id -> time it was first seen
+        self.duplicates = 0
+        self.evicted = 0  # forgotten before they expired, because of `max_size`
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def __contains__(self, id: Hashable) -> bool:
+        return id in self._seen
+
+    def add(self, id: Hashable, now: float = None) -> bool:
+        """
+        Remembers an id.
+        :return: whether it is new, False for an id seen within the last `ttl` seconds
+        """
+
+        now = time.monotonic() if now is None else now
+        seen = self._seen
+        while seen:
+            oldest, seen_at = next(iter(seen.items()))
+            if now - seen_at < self.ttl:
+                break
+            del seen[oldest]
+        if id in seen:
+            self.duplicates += 1
+            return False
+        seen[id] = now
+        if len(seen) > self.max_size:
+            seen.popitem(last=False)
+            self.evicted += 1
+        return True
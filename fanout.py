@@ -0,0 +1,285 @@
+"""
+Websocket fanout in separate worker processes, so subscriber capacity scales with cores (FANOUT_WORKERS > 0).
+The main process ingests and scores votes as usual, but publishes its reports over a Unix socket instead of
+sending them to clients. Every worker process subscribes to the socket, serves websockets on the same port
+(SO_REUSEPORT, the kernel spreads connections over the workers) and fans the reports out to its own clients.
+Workers never touch the database: new clients get the latest status snapshot, which the main process
+publishes whenever it changed.
+
+Reports are sent already encoded, in every wire format a worker subscribed to, so workers only pass bytes on and
+never decode anything. A frame is a header (size of the rest, kind, report type, number of formats) followed by
+one part per format (format, size, encoded report). Kinds: report for all clients, replace for status reports
+that supersede queued updates, status to only refresh the snapshot for new clients. Workers subscribe to a wire
+format by sending its number as a single byte, whenever their first client of that format connects.
+The socket lives in a directory only accessible to its owner.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import shutil
+import stat
+import struct
+import tempfile
+import time
+
+import websockets
+
+import metrics
+from broadcast import Broadcaster
+from config import CHAT_RESTART_MIN, CHAT_RESTART_MAX, FANOUT_MAX_BUFFER, FANOUT_SOCKET, LOG_LEVEL
+from wire import DEFAULT_FORMAT, ENCODINGS, SCHEMAS, Report, WireFormat
+
+log = logging.getLogger(__name__)
+
+FRAME = struct.Struct('>IBBB')  # size of the parts, kind, report type, number of parts
+PART = struct.Struct('>BI')  # format, size of the encoded report
+REPORT, REPLACE, STATUS = range(3)  # kinds
+TYPES = ('update', 'tick', 'status')
+FORMATS = tuple(WireFormat(schema, encoding) for schema in SCHEMAS for encoding in ENCODINGS)
+_FORMAT_IDS = {wire_format: n for n, wire_format in enumerate(FORMATS)}
+_TYPE_IDS = {type: n for n, type in enumerate(TYPES)}
+
+
+def _frame(kind: int, report: Report, formats: set[WireFormat]) -> bytes:
+    parts = []
+    for wire_format in formats:
+        data = report.encode(wire_format)  # cached, once per format no matter how many workers
+        parts.append(PART.pack(_FORMAT_IDS[wire_format], len(data)))
+        parts.append(data)
+    body = b''.join(parts)
+    return FRAME.pack(len(body), kind, _TYPE_IDS[report.type], len(formats)) + body
+
+def socket_path(path: str = FANOUT_SOCKET) -> tuple[str, str | None]:
+    """
+    The socket path to use, in a new private directory (in $XDG_RUNTIME_DIR if set) unless one is configured.
+    A configured socket must be in a directory no one else can write to, or it could be replaced by someone else.
+    :return: socket path, created directory to remove afterwards or None
+    """
+
+    if not path:
+        directory = tempfile.mkdtemp(prefix='livevote-', dir=os.environ.get('XDG_RUNTIME_DIR'))  # mode 0700
+        return os.path.join(directory, 'fanout.sock'), directory
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.stat(directory)
+    if info.st_uid != os.getuid() or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise ValueError(f'FANOUT_SOCKET must be in a directory only writable by this user, not {directory}')
+    return path, None
+
+
+class EncodedReport:
+    """A report as received by a worker, in the wire formats it subscribed to. Used like wire.Report."""
+
+    __slots__ = ('type', 'encoded')
+
+    def __init__(self, type: str, encoded: dict[WireFormat, bytes]) -> None:
+        self.type = type
+        self.encoded = encoded
+
+    def encode(self, wire_format: WireFormat = DEFAULT_FORMAT) -> bytes:
+        return self.encoded[wire_format]
+
+
+class FanoutPublisher:
+    """
+    Publishing side, used by the main process in place of a broadcast.Broadcaster.
+    Frames are written without waiting for the workers. A worker whose unsent frames exceed `max_buffer`
+    bytes is disconnected, it reconnects and starts over from the latest status snapshot.
+    """
+
+    def __init__(self, path: str = FANOUT_SOCKET, max_buffer: int = FANOUT_MAX_BUFFER) -> None:
+        self.configured_path = path
+        self.path: str | None = None  # known once started
+        self.max_buffer = max_buffer
+        self.workers: set[asyncio.StreamWriter] = set()
+        self.formats: set[WireFormat] = {DEFAULT_FORMAT}  # subscribed by any worker
+        self.status: Report | None = None  # latest status snapshot, sent to workers when they connect
+        self.published = 0
+        self.bytes = 0
+        self.dropped_workers = 0
+        self._server: asyncio.AbstractServer | None = None
+        self._directory: str | None = None
+
+    def __len__(self) -> int:
+        return len(self.workers)
+
+    async def start(self) -> None:
+        self.path, self._directory = socket_path(self.configured_path)
+        if os.path.exists(self.path):
+            os.remove(self.path)  # left over from a previous run
+        self._server = await asyncio.start_unix_server(self._connected, self.path)
+        os.chmod(self.path, 0o600)
+
+    async def _connected(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        log.info('Fanout worker connected (%d workers)', len(self.workers) + 1)
+        self.workers.add(writer)
+        if self.status is not None:
+            writer.write(_frame(STATUS, self.status, self.formats))
+        try:
+            # workers only ever send the numbers of the wire formats they need
+            while data := await reader.read(256):
+                formats = {FORMATS[n] for n in data if n < len(FORMATS)} - self.formats
+                if formats:
+                    self.formats |= formats
+                    log.info('Fanout workers subscribed to %s', ', '.join(f'v{f.schema}/{f.encoding}' for f in formats))
+                    if self.status is not None:
+                        self._publish(STATUS, self.status)  # new clients of these formats wait for it
+        finally:
+            self.workers.discard(writer)
+            writer.close()
+
+    def _publish(self, kind: int, report: Report) -> None:
+        if not self.workers:
+            return
+        frame = _frame(kind, report, self.formats)
+        for writer in list(self.workers):
+            if writer.transport.get_write_buffer_size() > self.max_buffer:
+                log.warning('Disconnecting fanout worker, %d bytes behind', writer.transport.get_write_buffer_size())
+                self.workers.discard(writer)
+                writer.transport.abort()
+                self.dropped_workers += 1
+                continue
+            writer.write(frame)
+        self.published += 1
+        self.bytes += len(frame)
+
+    def broadcast(self, report: Report, replace: bool = False) -> None:
+        """Same interface as Broadcaster.broadcast, for all clients of all workers"""
+        start = time.perf_counter()
+        if report.type == 'status':
+            self.status = report
+        self._publish(REPLACE if replace else REPORT, report)
+        metrics.STAGE_SECONDS.observe(time.perf_counter() - start, 'broadcast')
+        metrics.REPORTS.inc(1, report.type)
+
+    def publish_status(self, report: Report) -> None:
+        """Refreshes the status snapshot that workers send to new clients, without sending it to anyone else"""
+        if report is not self.status:
+            self.status = report
+            self._publish(STATUS, report)
+
+    def stats(self) -> dict:
+        return {
+            'workers': len(self.workers),
+            'published': self.published,
+            'bytes': self.bytes,
+            'buffered_bytes': sum(writer.transport.get_write_buffer_size() for writer in self.workers),
+            'dropped_workers': self.dropped_workers,
+        }
+
+    def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+        for writer in self.workers:
+            writer.close()
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+
+
+class FanoutWorker:
+    """Subscribing side, serves the websocket clients of one worker process"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.broadcaster = Broadcaster()
+        self.status: EncodedReport | None = None
+        self.formats: set[WireFormat] = {DEFAULT_FORMAT}  # subscribed
+        self._status_changed = asyncio.Condition()
+        self._writer: asyncio.StreamWriter | None = None
+        self._parent = os.getppid()
+        self.received = 0
+        self.reconnects = 0
+        metrics.Callback('livevote_clients', 'Connected websocket clients of this worker',
+                         lambda: len(self.broadcaster))
+        metrics.Callback('livevote_client_dropped_messages', 'Messages dropped for slow connected clients',
+                         lambda: self.broadcaster.stats()['dropped'])
+        metrics.Callback('livevote_fanout_received_total', 'Frames received from the main process',
+                         lambda: self.received, type='counter')
+
+    def _subscribe(self, wire_format: WireFormat) -> None:
+        if wire_format not in self.formats:
+            self.formats.add(wire_format)
+            if self._writer is not None:
+                self._writer.write(bytes([_FORMAT_IDS[wire_format]]))
+
+    async def handler(self, websocket) -> None:
+        # e.g. ws://host:6789/?schema=2&encoding=msgpack, see wire.py
+        wire_format = WireFormat.from_path(websocket.request.path)
+        self._subscribe(wire_format)
+        async with self._status_changed:
+            # every frame after this status carries the format as well
+            await self._status_changed.wait_for(lambda: self.status is not None and wire_format in self.status.encoded)
+        channel = self.broadcaster.register(websocket, wire_format)
+        try:
+            channel.offer(self.status.encode(wire_format), replace=True)
+            await websocket.wait_closed()
+        finally:
+            self.broadcaster.unregister(websocket)
+
+    async def _read(self, reader: asyncio.StreamReader) -> tuple[int, EncodedReport]:
+        size, kind, type, count = FRAME.unpack(await reader.readexactly(FRAME.size))
+        body = await reader.readexactly(size)
+        encoded = {}
+        offset = 0
+        for _ in range(count):
+            wire_format, length = PART.unpack_from(body, offset)
+            offset += PART.size
+            encoded[FORMATS[wire_format]] = body[offset:offset + length]
+            offset += length
+        return kind, EncodedReport(TYPES[type], encoded)
+
+    async def subscribe(self) -> None:
+        """Receives the published reports, reconnecting with backoff while the main process is unavailable"""
+        backoff = CHAT_RESTART_MIN
+        while True:
+            if os.getppid() != self._parent:
+                log.warning('Main process is gone, stopping')
+                return
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except OSError as e:
+                log.warning('Could not connect to %s: %s. Retrying in %.0f seconds...', self.path, e, backoff)
+                await asyncio.sleep(backoff)
+                backoff = min(2 * backoff, CHAT_RESTART_MAX)
+                continue
+            backoff = CHAT_RESTART_MIN
+            self._writer = writer
+            writer.write(bytes(_FORMAT_IDS[wire_format] for wire_format in self.formats))
+            try:
+                while True:
+                    kind, report = await self._read(reader)
+                    self.received += 1
+                    if report.type == 'status':
+                        async with self._status_changed:
+                            self.status = report
+                            self._status_changed.notify_all()
+                    if kind != STATUS:
+                        self.broadcaster.broadcast(report, replace=kind == REPLACE)
+            except (asyncio.IncompleteReadError, ConnectionError, IndexError, struct.error) as e:
+                log.warning('Lost the connection to the main process: %s. Reconnecting...', e)
+                self.reconnects += 1
+            finally:
+                self._writer = None
+                writer.close()
+
+    async def run(self, host: str, port: int) -> None:
+        server = await websockets.serve(self.handler, host, port, reuse_port=True,
+                                        process_request=metrics.process_request)
+        await self.subscribe()
+        server.close()
+
+
+def run_worker(path: str, host: str, port: int) -> None:
+    """Entry point of a worker process"""
+    logging.basicConfig(level=LOG_LEVEL, format=f'%(asctime)s %(levelname)s worker-{os.getpid()} %(name)s: %(message)s')
+    asyncio.run(FanoutWorker(path).run(host, port))
+
+def start_workers(count: int, host: str, port: int, path: str) -> list[multiprocessing.Process]:
+    """Starts fanout worker processes, which end with the main process"""
+    context = multiprocessing.get_context('spawn')  # fresh interpreters, nothing inherited from the main process
+    workers = [context.Process(target=run_worker, args=(path, host, port), name=f'fanout-{n}', daemon=True)
+               for n in range(count)]
+    for worker in workers:
+        worker.start()
+    return workers
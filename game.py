@@ -1,11 +1,24 @@
-from playhouse.shortcuts import model_to_dict
-
-from cache import preset_countries, recalc_cache
+import logging
+import signal
+import sys
+import time
+
+import wire
+
+from blocklist import blocklist
+from cache import get_checkpoint, preset_countries, recalc_cache
+from config import RECALC_VERIFY, WINDOW_TOP
+from db_executor import db_executor
+from journal import journal
+from migrate import run_migrations
+from milestones import milestones
 from models import *
-from models.country import rank_countries
-from models.event import get_latest_events, _compute_power_milestones
 from models.user import rank_users
-from models.vote import get_latest_votes
+from recent import recent
+from resolver import resolver
+from scoreboard import scoreboard
+
+log = logging.getLogger(__name__)
 
 
 class Game:
@@ -22,132 +35,135 @@ class Game:
         db.connect(reuse_if_open=True)
 
         # Setup environment
-        print('Preseting countries...')
+        log.info('Creating tables...')
+        new_aggregates = not UserCountry.table_exists()  # needs to be filled from the existing votes
+        db.create_tables([Setting, CountryCache, Event, User, Country, UserCountry, Vote], safe=True)
+        run_migrations()
+        log.info('Preseting countries...')
         preset_countries()
-        print('Recalculating caches...')
-        recalc_cache()  # refreshing caches...
-        print('Creating tables...')
-        db.create_tables([Setting, CountryCache, Event, User, Country, Vote], safe=True)
-        print('Setup done!')
+        if not self._restore_from_journal(verify=RECALC_VERIFY or new_aggregates):
+            log.info('Recalculating caches...')
+            summary = recalc_cache(verify=RECALC_VERIFY or new_aggregates)  # refreshing caches...
+            log.info("Recalculated caches (%s): %s votes up to vote %s, %d drifted counters",
+                     summary['mode'], summary['votes'], summary['checkpoint'], len(summary['drift']))
+            log.info('Loading scoreboard...')
+            scoreboard.load()
+            if journal.is_open:
+                scoreboard.snapshot()  # replays start here
+        recent.load()
+        resolver.load()
+        blocklist.load()
+        # turn SIGTERM into a regular exit, so pending counters are flushed by __exit__
+        self._previous_sigterm = signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        log.info('Setup done!')
 
         return self
 
+    def _restore_from_journal(self, verify: bool) -> bool:
+        """
+        Rebuilds the scoreboard from the latest journal snapshot and the journal records after it, if the journal
+        holds every stored vote. Opens the journal if it is enabled.
+        :param verify: only open the journal, counters are rebuilt from the vote table
+        :return: whether the scoreboard was restored, otherwise it still needs to be loaded
+        """
+
+        if not journal.enabled:
+            return False
+        log.info('Reading vote journal...')
+        start = time.perf_counter()
+        recovery = journal.recover()
+        last_vote_id = Vote.select(fn.MAX(Vote.vote_id)).scalar() or 0
+        if journal.last_vote_id > last_vote_id:
+            # vote ids would be reused, e.g. the database was reset
+            log.warning('Vote journal is ahead of the database (vote %d, stored %d), starting a new journal',
+                        journal.last_vote_id, last_vote_id)
+            journal.reset()
+            return False
+        if verify or recovery is None:
+            return False
+        if journal.last_vote_id < last_vote_id:
+            # unsynced records lost with the machine, or no journal yet when these votes were stored
+            log.warning('Vote journal ends at vote %d, but votes up to %d are stored, recalculating instead',
+                        journal.last_vote_id, last_vote_id)
+            return False
+        checkpoint = get_checkpoint() or 0
+        scoreboard.restore(recovery, journal.records(journal.find(checkpoint)))
+        log.info('Restored scoreboard from the vote journal in %.2fs: %d records replayed, %d votes after the '
+                 'stored checkpoint %d', time.perf_counter() - start, recovery.replayed,
+                 last_vote_id - checkpoint, checkpoint)
+        scoreboard.flush()
+        return True
+
     def __exit__(self, typ, val, tb):
-        if not db.is_closed():
-            db.close()
+        signal.signal(signal.SIGTERM, self._previous_sigterm)
+        try:
+            db_executor.shutdown()  # let running batches finish first
+            log.info('Flushing scoreboard...')
+            scoreboard.flush()
+            if journal.is_open:
+                scoreboard.snapshot()  # nothing to replay on the next start
+        finally:
+            journal.close()
+            if not db.is_closed():
+                db.close()
         return False
 
     @property
     def country_data(self) -> dict:
         return {
-            cc.alpha2: {'votes': cc.votes, 'points': cc.points}
-            for cc in CountryCache.select()
+            alpha2: {'votes': cs.votes, 'points': cs.points}
+            for alpha2, cs in scoreboard.countries.items()
         }
 
     @staticmethod
     def get_country(alpha2: str) -> dict[str, int] | None:
-        try:
-            cc = CountryCache.get(CountryCache.alpha2 == alpha2)
-            return {'votes': cc.votes, 'points': cc.points}
-        except CountryCache.DoesNotExist:
+        cs = scoreboard.countries.get(alpha2)
+        if cs is None:
             return None
+        return {'votes': cs.votes, 'points': cs.points}
 
     def __getitem__(self, item_id):
         return self.get_country(item_id)
 
 def register_vote(vote: Vote) -> list[Event]:
     """
-    Main function to register a vote. Create all Votes directly from the model, then simply call this function.
+    Main function to register a vote. Create all Votes directly from the model, then call this function before
+    storing them, so redactions are stored along with the vote (see ingest.IngestPipeline).
+    Counters are only updated in memory, the scoreboard writes them to the database in the background.
     :param vote:
-    :return:
+    :return: milestone events of the vote, with ids but not stored yet (see ingest.IngestPipeline)
     """
 
-    created_events: list[Event] = []
-    if vote.user.blocked_until is not None:
-        if not (datetime.datetime.now() > vote.user.blocked_until):  # block has expired
-            vote.redacted = True
-            vote.save()
-        else:
-            vote.user.blocked_until = None
-            vote.user.save()
+    if blocklist.blocked(vote.user_id):
+        vote.redacted = True
+    elif vote.user.blocked_until is not None:  # block has expired
+        vote.user.blocked_until = None
+        vote.user.save(only=[User.blocked_until])
 
     # ignore redacted votes
     if vote.redacted:
-        return created_events
-    user = vote.user  # User instance (peewee ForeignKey -> model instance)
-    country = vote.country  # Country instance
-    cache = country.cache  # CountryCache instance (where votes/points are stored)
-
-    # read old values
-    old_user_level = float(user.leveling or 0)
-    old_user_total_votes = float(user.total_votes or 0)
-    old_user_total_points = float(user.total_points or 0)
-    old_country_votes = int(cache.votes or 0)
-    old_country_points = int(cache.points or 0)
-
-    # compute new values
-    new_user_level = old_user_level + float(vote.xp_gain or 0)
-    new_user_total_votes = old_user_total_votes + float(vote.vote_count or 0)
-    new_user_total_points = old_user_total_points + float(vote.points or 0)
-    new_country_votes = old_country_votes + int(vote.vote_count or 0)
-    new_country_points = old_country_points + int(vote.points or 0)
-
-    """print(old_user_level, new_user_level)
-    print(old_user_total_votes, new_user_total_votes)
-    print(old_user_total_points, new_user_total_points)
-    print(new_country_votes, new_country_votes)
-    print(new_country_points, new_country_points)"""
-
-    # Wrap updates + event creation in transaction to avoid partial updates
-    with db.atomic():
-        user.latest_vote = vote.timestamp
-        # persist updated counters
-        user.leveling = new_user_level
-        user.total_votes = new_user_total_votes
-        user.total_points = new_user_total_points
-        user.save()
-        cache.votes = new_country_votes
-        cache.points = new_country_points
-        cache.save()
-
-        # --- USER LEVEL MILESTONES ---
-        # example sequence: 10, 100, 1000, ... => base=10, start_power=1
-        user_milestones = _compute_power_milestones(old_user_level, new_user_level, base=10)
-        for m in user_milestones:
-            ev = Event.create(
-                type="user_level_up",
-                user=user,
-                country=None,
-                milestone=m
-            )
-            created_events.append(ev)
-
-        # --- COUNTRY POINTS MILESTONES ---
-        # example: 1_000_000, 10_000_000, ... => base=10, start_power=6
-        country_point_milestones = _compute_power_milestones(old_country_points, new_country_points, base=10, minimum=1000)
-        for m in country_point_milestones:
-            ev = Event.create(
-                type="country_points",
-                user=user,
-                country=country,
-                milestone=m
-            )
-            created_events.append(ev)
-
-        # --- COUNTRY VOTES MILESTONES ---
-        # example: 100, 1000, 10000, ... => base=10, start_power=2
-        """country_vote_milestones = self._compute_power_milestones(old_country_votes, new_country_votes, base=10)
-        for m in country_vote_milestones:
-            ev = Event.create(
-                type="country_votes",
-                user=user,
-                country=country,
-                milestone=m
-            )
-            created_events.append(ev)"""
-
-    return created_events
+        return []
+    user, country_score = scoreboard.apply_vote(vote)  # counters are only updated in memory
+    # user levels, country points, ... see milestones.py
+    return milestones.check_vote(vote, user, country_score)
+
 
+def _user_dict(user: User) -> dict:
+    # the cached instance holds the current counters, instances loaded elsewhere may be outdated
+    return wire.user_dict(scoreboard.users.get(user.user_id) or user)
+
+def _country_dict(country: Country) -> dict:
+    # counters come from the scoreboard, the rows in the database may not be flushed yet
+    score = scoreboard.country(country.alpha2)
+    return wire.country_dict(country, score.votes, score.points)
+
+def _vote_dict(vote: Vote) -> dict:
+    return wire.vote_dict(vote, _user_dict(vote.user), _country_dict(vote.country))
+
+def _event_dict(event: Event) -> dict:
+    return wire.event_dict(event,
+                           _user_dict(event.user) if event.user_id else None,
+                           _country_dict(event.country) if event.country_id else None)
 
 def gen_status_report() -> dict:
     """
@@ -155,23 +171,47 @@ def gen_status_report() -> dict:
     :return:
     """
 
+    # read from memory and the stored counters without flushing, so building it never waits for the write lock
+    top_users = scoreboard.top_users()
+    top_countries = scoreboard.top_user_countries([user.user_id for user in top_users])
     return to_dict({
         'type': 'status',
-        'country_ranking': rank_countries(),
-        'user_ranking': rank_users(),
-        'latest_votes': get_latest_votes(),
-        'latest_events': get_latest_events()
+        'country_ranking': [
+            wire.country_dict(country, score.votes, score.points) for country, score in scoreboard.top_countries()
+        ],
+        'user_ranking': rank_users(top_users, top_countries),
+        'latest_votes': [_vote_dict(vote) for vote in recent.votes()],
+        'latest_events': [_event_dict(event) for event in recent.events()],
+        'windows': {name: _window_dict(name, seconds) for name, seconds in scoreboard.windows.items()},
     })
 
+def _window_dict(name: str, seconds: float) -> dict:
+    """Rankings of a sliding window, by points"""
+    return {
+        'seconds': seconds,
+        'country_ranking': [
+            wire.country_window_dict(country, totals['votes'], totals['points'])
+            for country, totals in scoreboard.top_countries_window(name, WINDOW_TOP)
+        ],
+        'user_ranking': [
+            wire.user_window_dict(user, totals['votes'], totals['points'])
+            for user, totals in scoreboard.top_users_window(name, WINDOW_TOP)
+        ],
+    }
+
+def add_report_events(report: dict, events: list[Event]) -> None:
+    """Adds events found after a vote report was generated, e.g. windowed milestones of the batch"""
+    report['events'].extend(_event_dict(event) for event in events)
+
 def gen_vote_report(vote: Vote, events: list[Event] = None) -> dict:
     """
-    Generates vote update report as dict for clients
+    Generates vote update report as dict for clients, see wire.Report for encoding it.
+    Built from the instances at hand without queries, datetimes are left to the encoder.
     :return:
     """
 
-    events = events or []
-    return to_dict({
+    return {
         'type': 'update',
-        'vote': model_to_dict(vote),
-        'events': [model_to_dict(event) for event in events]
-    })
+        'vote': _vote_dict(vote),
+        'events': [_event_dict(event) for event in events or []]
+    }
@@ -0,0 +1,264 @@
+import asyncio
+import datetime
+import logging
+import math
+import time
+from typing import Any, Awaitable, Callable
+
+from peewee import fn
+
+from config import INGEST_BATCH_SIZE, INGEST_MAX_LATENCY, INGEST_QUEUE_SIZE, LOG_SAMPLE_EVERY
+from db_executor import db_executor
+from dedupe import SeenIds
+from game import add_report_events, register_vote, gen_vote_report
+from journal import journal, JournalRecord
+from metrics import BATCH_SIZE, QUEUE_SECONDS, STAGE_SECONDS, Sampler
+from milestones import milestones
+from models import db, Event, Vote
+from recent import recent
+from resolver import resolver
+from scoreboard import scoreboard
+from snapshot import status_snapshot
+from wire import Report
+
+log = logging.getLogger(__name__)
+_vote_sample = Sampler(LOG_SAMPLE_EVERY)  # votes are logged at debug level, only every n-th one
+
+
+class IngestStats:
+    """
+    Throughput and backpressure counters of the ingestion pipeline
+    """
+
+    __slots__ = ('received', 'duplicates', 'votes', 'ignored', 'failed', 'batches', 'max_batch', 'queue_peak',
+                 'blocked_puts', 'blocked_seconds', 'wait_seconds', 'process_seconds', 'journal_errors', 'started')
+
+    def __init__(self) -> None:
+        self.received = 0  # chat messages put into the queue
+        self.duplicates = 0  # chat messages dropped because their id was seen before
+        self.votes = 0  # valid votes stored
+        self.ignored = 0  # messages that were not a vote
+        self.failed = 0  # messages lost in failed batches
+        self.batches = 0
+        self.max_batch = 0
+        self.queue_peak = 0  # highest observed queue depth
+        self.blocked_puts = 0  # puts that had to wait for free queue space
+        self.blocked_seconds = 0.0  # total time producers were held back
+        self.wait_seconds = 0.0  # total time messages spent in the queue
+        self.process_seconds = 0.0  # total time spent processing batches
+        self.journal_errors = 0  # stored batches that could not be journaled
+        self.started = time.monotonic()
+
+    def to_dict(self, queue_depth: int) -> dict:
+        processed = self.votes + self.ignored + self.failed
+        uptime = time.monotonic() - self.started
+        return {
+            'received': self.received,
+            'duplicates': self.duplicates,
+            'votes': self.votes,
+            'ignored': self.ignored,
+            'failed': self.failed,
+            'journal_errors': self.journal_errors,
+            'batches': self.batches,
+            'avg_batch': processed / self.batches if self.batches else 0,
+            'max_batch': self.max_batch,
+            'queue_depth': queue_depth,
+            'queue_peak': self.queue_peak,
+            'blocked_puts': self.blocked_puts,
+            'blocked_seconds': self.blocked_seconds,
+            'avg_wait_ms': 1000 * self.wait_seconds / processed if processed else 0,
+            'avg_batch_ms': 1000 * self.process_seconds / self.batches if self.batches else 0,
+            'messages_per_second': processed / uptime if uptime else 0,
+        }
+
+
+class IngestPipeline:
+    """
+    Bounded queue between the chat watcher and the database.
+    Messages are drained in micro-batches: a batch is processed once it holds `batch_size` messages,
+    or `max_latency` seconds after its first message arrived, whichever comes first.
+    Batches are processed one at a time on the database executor.
+    A full queue blocks `put`, which slows the chat watcher down instead of piling up tasks.
+    Chat items whose id was seen before (see dedupe.SeenIds) are dropped by `put`, before any database work.
+    """
+
+    def __init__(self, on_report: Callable[[Report], Awaitable[Any]], batch_size: int = INGEST_BATCH_SIZE,
+                 max_latency: float = INGEST_MAX_LATENCY, max_queue: int = INGEST_QUEUE_SIZE) -> None:
+        self.on_report = on_report
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.stats = IngestStats()
+        self.seen = SeenIds()
+        self._next_vote_id: int | None = None
+
+    async def put(self, item) -> bool:
+        """
+        Queues a chat item, waits while the queue is full.
+        :return: whether it was queued, False for an item seen before
+        """
+
+        if not self.seen.add(item.id):
+            self.stats.duplicates += 1
+            return False
+        entry = (time.monotonic(), item)
+        try:
+            self.queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            self.stats.blocked_puts += 1
+            await self.queue.put(entry)
+            self.stats.blocked_seconds += time.monotonic() - entry[0]
+        self.stats.received += 1
+        self.stats.queue_peak = max(self.stats.queue_peak, self.queue.qsize())
+        return True
+
+    async def _next_batch(self) -> list:
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.batch_size:
+            if self.queue.empty():
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            else:
+                batch.append(self.queue.get_nowait())
+        return batch
+
+    async def run(self) -> None:
+        while True:
+            batch = await self._next_batch()
+            now = time.monotonic()
+            self.stats.wait_seconds += sum(now - queued for queued, _ in batch)
+            for queued, _ in batch:
+                QUEUE_SECONDS.observe(now - queued)
+            BATCH_SIZE.observe(len(batch))
+            try:
+                # no overall timeout: a batch must not be retried while it may still be running,
+                # slow queries are aborted by the connection's read timeout instead
+                reports = await db_executor.run(self.process_batch, [item for _, item in batch], timeout=None)
+            except Exception as e:
+                self.stats.failed += len(batch)
+                log.exception('Exception while processing a batch of %d messages: %s', len(batch), e)
+                continue
+            finally:
+                self.stats.batches += 1
+                self.stats.max_batch = max(self.stats.max_batch, len(batch))
+                self.stats.process_seconds += time.monotonic() - now
+
+            for report in reports:
+                await self.on_report(report)
+
+    def allocate_vote_id(self) -> int:
+        """
+        Vote ids are assigned here instead of by the database, so a whole batch can be stored with one insert.
+        This process is the only one inserting votes.
+        """
+
+        if self._next_vote_id is None:
+            self._next_vote_id = (Vote.select(fn.MAX(Vote.vote_id)).scalar() or 0) + 1
+        vote_id = self._next_vote_id
+        self._next_vote_id += 1
+        return vote_id
+
+    def process_batch(self, items: list) -> list[Report]:
+        """
+        Turns a batch of chat items into votes with a single insert for all votes of the batch.
+        Countries are resolved in memory, users come from the user cache, which only queries uncached users
+        and writes new users and changed profiles.
+        :param items: pytchat chat items
+        :return: vote reports for clients, in chat order
+        """
+
+        start = time.perf_counter()
+        votes_in = []
+        for c in items:
+            country = resolver.resolve(c.message)
+            if country is not None:
+                votes_in.append((country, c))
+        ignored = len(items) - len(votes_in)
+        if not votes_in:
+            self.stats.ignored += ignored
+            STAGE_SECONDS.observe(time.perf_counter() - start, 'parse')
+            return []
+
+        # latest profile of every author in this batch
+        profiles = {}
+        for _, c in votes_in:
+            profiles[c.author.channelId] = {
+                'user_id': c.author.channelId,
+                'username': str(c.author.name),
+                'channel_url': str(c.author.channelUrl),
+                'image_url': str(c.author.imageUrl),
+                'is_mod': c.author.isChatModerator,
+            }
+        STAGE_SECONDS.observe(time.perf_counter() - start, 'parse')
+        reports = []
+        try:
+            with scoreboard.batch():
+                with db.atomic():
+                    with STAGE_SECONDS.time('user_upsert'):
+                        users = scoreboard.users.fetch(profiles)
+
+                    votes = []
+                    events = []
+                    vote_reports = {}  # vote id -> report
+                    for country, c in votes_in:
+                        user = users[c.author.channelId]
+                        vote = Vote(
+                            vote_id=self.allocate_vote_id(),
+                            user=user,
+                            country=country,
+                            vote_count=1,
+                            points=100 + math.floor(user.leveling or 0),
+                            timestamp=datetime.datetime.now(),
+                        )
+                        with STAGE_SECONDS.time('register_vote'):
+                            vote_events = register_vote(vote)
+                        report = vote_reports[vote.vote_id] = gen_vote_report(vote, vote_events)
+                        reports.append(report)
+                        events.extend(vote_events)
+                        votes.append(vote)
+                        if _vote_sample():
+                            log.debug('Vote %d by %s (%s) for %s: "%s"', vote.vote_id, user.username, user.user_id,
+                                      country.alpha2, c.message)
+                    with STAGE_SECONDS.time('milestones'):
+                        for vote_id, window_events in milestones.check_windows(votes).items():
+                            add_report_events(vote_reports[vote_id], window_events)
+                            events.extend(window_events)
+                    with STAGE_SECONDS.time('vote_insert'):
+                        Vote.insert_many([vote.__data__ for vote in votes]).execute()
+                    if events:
+                        with STAGE_SECONDS.time('event_insert'):
+                            Event.insert_many([event.__data__ for event in events]).execute()
+                    scoreboard.advance_checkpoint(votes[-1].vote_id)
+                if journal.is_open:
+                    # once stored, and before a snapshot can include the counters of this batch
+                    with STAGE_SECONDS.time('journal_append'):
+                        try:
+                            journal.append([JournalRecord.from_vote(vote) for vote in votes])
+                        except Exception as e:
+                            # the votes are stored anyway. Later votes are not journaled either, a journal with a gap
+                            # would restore wrong counters, so the next start finds it behind and recalculates instead.
+                            self.stats.journal_errors += 1
+                            log.error('Exception while journaling votes %d to %d, journal closed until the next '
+                                      'start: %s', votes[0].vote_id, votes[-1].vote_id, e)
+                            journal.close()
+        except Exception:
+            # the scoreboard rolled its counters back (see Scoreboard.batch), ids and milestone thresholds
+            # are found again from the database and the rolled back counters
+            self._next_vote_id = None
+            milestones.reset()
+            raise
+
+        self.stats.votes += len(votes)
+        self.stats.ignored += ignored  # once stored, `run` counts all messages of a failed batch as failed
+        recent.add(votes, events)
+        status_snapshot.invalidate()
+        reports = [Report(report) for report in reports]
+        for report in reports:
+            report.encode()  # the default format while still off the event loop
+        return reports
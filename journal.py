@@ -0,0 +1,341 @@
+"""
+Append-only journal of accepted votes with snapshots of the aggregates, for rebuilding the scoreboard on startup
+without aggregating the vote table (see Game and Scoreboard.restore).
+
+The journal is a memory-mapped file of fixed-width little endian records after a 64 byte header, preallocated in
+chunks and synced to disk in batches. Records are appended in vote id order, once their batch is stored.
+A snapshot (JSON, next to the journal) holds the country and user counters up to a journal position, so startup
+only replays the records after it.
+"""
+import asyncio
+import datetime
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from config import JOURNAL_PATH, JOURNAL_FSYNC_INTERVAL, JOURNAL_SNAPSHOT_INTERVAL
+from models import Vote
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'LVJOURN1'
+HEADER = struct.Struct('<8sI52x')  # magic, record size
+# vote_id, timestamp (µs since 1970, naive local time like the database), user_id, alpha2, flags,
+# vote_count, points, xp_gain, crc32 of everything before it
+RECORD = struct.Struct('<Qq24s2sBxIIdI')
+_BODY = struct.Struct(RECORD.format[:-1])  # everything but the checksum
+_CRC = struct.Struct('<I')
+GROW_RECORDS = 1 << 16  # records added to the file at once (4 MiB)
+
+REDACTED = 1  # stored, but not counted
+RETRACTION = 2  # takes a previously counted vote back out of the counters
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def retract(value: float, amount: float) -> float:
+    """
+    A float counter without a retracted amount. Rounded and never below 0, so taking back everything that was
+    added leaves exactly 0 instead of float residue (a leveling of -1e-17 floors to -1 and costs points).
+    """
+
+    return max(0.0, round(float(value) - float(amount), 9))
+
+
+class JournalRecord:
+    __slots__ = ('vote_id', 'timestamp', 'user_id', 'alpha2', 'flags', 'vote_count', 'points', 'xp_gain')
+
+    def __init__(self, vote_id: int, timestamp: datetime.datetime, user_id: str, alpha2: str, flags: int,
+                 vote_count: int, points: int, xp_gain: float) -> None:
+        self.vote_id = vote_id
+        self.timestamp = timestamp
+        self.user_id = user_id
+        self.alpha2 = alpha2
+        self.flags = flags
+        self.vote_count = vote_count
+        self.points = points
+        self.xp_gain = xp_gain
+
+    @classmethod
+    def from_vote(cls, vote: Vote, flags: int = 0) -> 'JournalRecord':
+        if vote.redacted:
+            flags |= REDACTED
+        return cls(vote.vote_id, vote.timestamp, vote.user_id, vote.country_id, flags,
+                   int(vote.vote_count or 0), int(vote.points or 0), float(vote.xp_gain or 0))
+
+    @classmethod
+    def retraction(cls, vote: Vote, vote_id: int) -> 'JournalRecord':
+        """
+        Takes a counted vote back out of the counters. Recorded under `vote_id`, the latest journaled vote,
+        because records are kept in vote id order.
+        """
+
+        return cls(vote_id, vote.timestamp, vote.user_id, vote.country_id, RETRACTION,
+                   int(vote.vote_count or 0), int(vote.points or 0), float(vote.xp_gain or 0))
+
+    @property
+    def sign(self) -> int:
+        """How the record changes the counters: 1 counts, -1 takes back, 0 leaves them alone"""
+        if self.flags & REDACTED:
+            return 0
+        return -1 if self.flags & RETRACTION else 1
+
+    def pack(self) -> bytes:
+        user_id = self.user_id.encode('utf-8')
+        if len(user_id) > 24:  # struct would silently cut it off
+            raise ValueError(f'User id {self.user_id!r} does not fit into a journal record')
+        body = _BODY.pack(self.vote_id, (self.timestamp - _EPOCH) // _MICROSECOND, user_id,
+                          self.alpha2.encode('ascii'), self.flags, self.vote_count, self.points, self.xp_gain)
+        return body + _CRC.pack(zlib.crc32(body))
+
+    @classmethod
+    def unpack(cls, data: bytes) -> 'JournalRecord | None':
+        """None for unwritten space or a torn write"""
+        vote_id, micros, user_id, alpha2, flags, vote_count, points, xp_gain, crc = RECORD.unpack(data)
+        if vote_id == 0 or crc != zlib.crc32(data[:_BODY.size]):
+            return None
+        return cls(vote_id, _EPOCH + micros * _MICROSECOND, user_id.rstrip(b'\0').decode('utf-8'),
+                   alpha2.decode('ascii'), flags, vote_count, points, xp_gain)
+
+
+class Recovery:
+    """Counters rebuilt from a snapshot and the journal records after it"""
+
+    __slots__ = ('countries', 'users', 'last_vote_id', 'replayed')
+
+    def __init__(self, countries: dict[str, list[int]], users: dict[str, list[float]], last_vote_id: int) -> None:
+        self.countries = countries  # alpha2 -> [votes, points]
+        self.users = users  # user_id -> [leveling, total_points, total_votes]
+        self.last_vote_id = last_vote_id
+        self.replayed = 0
+
+    def apply(self, record: JournalRecord) -> None:
+        """
+        Same arithmetic as Scoreboard.apply_vote and Scoreboard.retract_votes, so rebuilt counters match the ones
+        in memory exactly
+        """
+        sign = record.sign
+        if sign:
+            user = self.users.get(record.user_id)
+            if user is None:
+                user = self.users[record.user_id] = [0.0, 0.0, 0.0]
+            if sign > 0:
+                user[0] = float(user[0]) + float(record.xp_gain)
+                user[1] = float(user[1]) + float(record.points)
+                user[2] = float(user[2]) + float(record.vote_count)
+            else:  # like Scoreboard.retract_votes
+                user[0] = retract(user[0], record.xp_gain)
+                user[1] = retract(user[1], record.points)
+                user[2] = retract(user[2], record.vote_count)
+            country = self.countries.get(record.alpha2)
+            if country is None:
+                country = self.countries[record.alpha2] = [0, 0]
+            country[0] += sign * record.vote_count
+            country[1] += sign * record.points
+        self.last_vote_id = max(self.last_vote_id, record.vote_id)
+        self.replayed += 1
+
+
+class VoteJournal:
+    """
+    The journal file and its snapshot. `append` is called by the ingest pipeline with the votes of each stored
+    batch, `sync_periodically` and `snapshot_periodically` run next to it.
+    """
+
+    def __init__(self, path: str = JOURNAL_PATH, fsync_interval: float = JOURNAL_FSYNC_INTERVAL,
+                 snapshot_interval: float = JOURNAL_SNAPSHOT_INTERVAL) -> None:
+        self.path = path
+        self.snapshot_path = f'{path}.snapshot'
+        self.fsync_interval = fsync_interval
+        self.snapshot_interval = snapshot_interval
+        self.count = 0  # records written
+        self.synced = 0  # records known to be on disk
+        self.last_vote_id = 0
+        self._file = None
+        self._map: mmap.mmap | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    @property
+    def is_open(self) -> bool:
+        return self._map is not None
+
+    def _offset(self, index: int) -> int:
+        return HEADER.size + index * RECORD.size
+
+    def _capacity(self) -> int:
+        return (len(self._map) - HEADER.size) // RECORD.size
+
+    def _read(self, index: int) -> JournalRecord | None:
+        offset = self._offset(index)
+        return JournalRecord.unpack(self._map[offset:offset + RECORD.size])
+
+    def open(self, start: int = 0) -> None:
+        """
+        Opens or creates the journal and finds its end, scanning from record `start` (e.g. the snapshot position).
+        A torn record at the end is discarded and overwritten by the next append.
+        """
+
+        new = not os.path.exists(self.path) or os.path.getsize(self.path) < HEADER.size
+        self._file = open(self.path, 'w+b' if new else 'r+b')
+        if new:
+            self._file.write(HEADER.pack(MAGIC, RECORD.size))
+            self._file.truncate(self._offset(GROW_RECORDS))
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        magic, record_size = HEADER.unpack(self._map[:HEADER.size])
+        if magic != MAGIC or record_size != RECORD.size:
+            self.close()
+            raise ValueError(f'{self.path} is not a vote journal of this version')
+        index = min(start, self._capacity())
+        previous = self._read(index - 1) if index else None
+        if previous is None:
+            index = 0  # damaged before `start`, find the end the slow way
+        while index < self._capacity():
+            record = self._read(index)
+            if record is None:
+                break
+            previous = record
+            index += 1
+        self.count = self.synced = index
+        self.last_vote_id = previous.vote_id if previous else 0
+
+    def close(self) -> None:
+        if self._map is not None:
+            self.sync()
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def reset(self) -> None:
+        """Moves the journal and its snapshot aside and starts an empty journal, e.g. after the database was reset"""
+        self.close()
+        suffix = time.strftime('%Y%m%d-%H%M%S')
+        for path in (self.path, self.snapshot_path):
+            if os.path.exists(path):
+                os.replace(path, f'{path}.{suffix}')
+        self.open()
+
+    def append(self, records: list[JournalRecord]) -> None:
+        """Writes records to the mapped file, they reach the disk with the next sync"""
+        if not records:
+            return
+        with self._lock:
+            needed = self.count + len(records)
+            if needed > self._capacity():
+                self._map.flush()
+                self._map.close()
+                self._file.truncate(self._offset(needed + GROW_RECORDS))
+                self._map = mmap.mmap(self._file.fileno(), 0)
+            offset = self._offset(self.count)
+            self._map[offset:offset + RECORD.size * len(records)] = b''.join(record.pack() for record in records)
+            self.count = needed
+            self.last_vote_id = max(self.last_vote_id, records[-1].vote_id)
+
+    def sync(self) -> None:
+        with self._lock:
+            if self._map is None or self.synced == self.count:
+                return
+            count = self.count
+            self._map.flush()  # msync of the whole mapping, unchanged pages cost nothing
+            self.synced = count
+
+    def records(self, start: int = 0, end: int = None):
+        """Records by position, from `start` up to `end` (exclusive, defaults to the end of the journal)"""
+        for index in range(start, self.count if end is None else end):
+            record = self._read(index)
+            if record is not None:
+                yield record
+
+    def find(self, vote_id: int) -> int:
+        """Position of the first record with a vote id above `vote_id`, by binary search over the sorted ids"""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            record = self._read(middle)
+            if record is not None and record.vote_id <= vote_id:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # --- snapshots ---
+
+    def read_snapshot(self) -> dict | None:
+        try:
+            with open(self.snapshot_path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            log.warning('Ignoring unreadable journal snapshot %s: %s', self.snapshot_path, e)
+            return None
+
+    def write_snapshot(self, position: int, last_vote_id: int, countries: dict[str, list[int]],
+                       users: dict[str, list[float]]) -> None:
+        """
+        Stores the counters that include exactly the first `position` records, atomically replacing the old snapshot.
+        The journal is synced first, so a snapshot never refers to records that could be lost.
+        """
+
+        self.sync()
+        tmp = f'{self.snapshot_path}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'position': position, 'last_vote_id': last_vote_id, 'created': time.time(),
+                       'countries': countries, 'users': users}, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+
+    def recover(self) -> Recovery | None:
+        """
+        Counters of the snapshot plus the journal records after it, None without snapshot.
+        Opens the journal, scanning for its end from the snapshot position only.
+        """
+
+        snapshot = self.read_snapshot()
+        self.open(snapshot['position'] if snapshot else 0)
+        if snapshot is None or snapshot['position'] > self.count:
+            return None
+        recovery = Recovery(snapshot['countries'], snapshot['users'], snapshot['last_vote_id'])
+        for record in self.records(snapshot['position']):
+            recovery.apply(record)
+        return recovery
+
+    async def sync_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            try:
+                await asyncio.to_thread(self.sync)
+            except Exception as e:
+                log.error('Exception while syncing the vote journal: %s', e)
+
+    async def snapshot_periodically(self, take_snapshot) -> None:
+        """:param take_snapshot: blocking function writing a snapshot, e.g. Scoreboard.snapshot"""
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                await asyncio.to_thread(take_snapshot)
+            except Exception as e:
+                log.error('Exception while writing a journal snapshot: %s', e)
+
+    def stats(self) -> dict:
+        return {
+            'records': self.count,
+            'unsynced': self.count - self.synced,
+            'last_vote_id': self.last_vote_id,
+            'bytes': self._offset(self.count),
+        }
+
+
+journal = VoteJournal()
@@ -0,0 +1,86 @@
+from typing import Callable, Hashable, Iterator
+
+from sortedcontainers import SortedList
+
+
+class Leaderboard:
+    """
+    Records ranked by several numeric attributes at once, highest first, ties broken by record id.
+    Records are any objects with an id attribute and the ranked attributes, e.g. scoreboard.CountryScore.
+    Call `update` after changing a record: re-ranking costs O(log n) per ranking, so do top-K and rank queries.
+    """
+
+    def __init__(self, id_attr: str, metrics: tuple[str, ...]) -> None:
+        self.id_attr = id_attr
+        self.metrics = metrics
+        self.records: dict[Hashable, object] = {}
+        self._rankings: dict[str, SortedList] = {metric: SortedList() for metric in metrics}
+        self._keys: dict[Hashable, tuple] = {}  # record id -> sort keys it is currently ranked under, by metric
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __contains__(self, record_id: Hashable) -> bool:
+        return record_id in self.records
+
+    def get(self, record_id: Hashable):
+        return self.records.get(record_id)
+
+    def update(self, record) -> None:
+        """(Re)ranks a new or changed record"""
+        record_id = getattr(record, self.id_attr)
+        old_keys = self._keys.get(record_id)
+        new_keys = tuple((-(getattr(record, metric) or 0), record_id) for metric in self.metrics)
+        if old_keys == new_keys:
+            return
+        for metric, old_key, new_key in zip(self.metrics, old_keys or [None] * len(self.metrics), new_keys):
+            if old_key != new_key:
+                ranking = self._rankings[metric]
+                if old_key is not None:
+                    ranking.remove(old_key)
+                ranking.add(new_key)
+        self._keys[record_id] = new_keys
+        self.records[record_id] = record
+
+    def remove(self, record_id: Hashable) -> None:
+        keys = self._keys.pop(record_id, None)
+        if keys is None:
+            return
+        for metric, key in zip(self.metrics, keys):
+            self._rankings[metric].remove(key)
+        del self.records[record_id]
+
+    def clear(self) -> None:
+        self.records.clear()
+        self._keys.clear()
+        for ranking in self._rankings.values():
+            ranking.clear()
+
+    def iter_ranked(self, metric: str) -> Iterator:
+        """All records, best first"""
+        for _, record_id in self._rankings[metric]:
+            yield self.records[record_id]
+
+    def top(self, metric: str, k: int, where: Callable[[object], bool] = None) -> list:
+        """
+        The best k records by metric.
+        :param where: only records for which this is true, e.g. to skip blocked users
+        :return:
+        """
+
+        if where is None:
+            return [self.records[record_id] for _, record_id in self._rankings[metric].islice(0, k)]
+        top = []
+        for record in self.iter_ranked(metric):
+            if len(top) == k:
+                break
+            if where(record):
+                top.append(record)
+        return top
+
+    def rank(self, record_id: Hashable, metric: str) -> int | None:
+        """1-based position of a record by metric, regardless of filters, None for unknown records"""
+        keys = self._keys.get(record_id)
+        if keys is None:
+            return None
+        return self._rankings[metric].index(keys[self.metrics.index(metric)]) + 1
@@ -1,14 +1,33 @@
 import asyncio
+import logging
 
 from cli import CLIClient
+from config import LOG_LEVEL
 from game import Game
+from models import use_database
 from web_socket import WebsocketClient
 
+log = logging.getLogger(__name__)
+
+
+async def main(game: Game) -> None:
+    """Serves the websocket clients and the command line next to each other, until `quit` or the server fails"""
+    server = asyncio.create_task(WebsocketClient(game).run())  # Websocket for webpages
+    cli = asyncio.create_task(CLIClient(game).run())  # command line interface
+    try:
+        await asyncio.wait([server, cli], return_when=asyncio.FIRST_COMPLETED)
+        if cli.done() and isinstance(cli.exception(), EOFError):
+            log.info('No command line input, serving without the command line')
+            await server
+        for task in (server, cli):
+            if task.done():
+                task.result()  # raises what ended it
+    finally:
+        server.cancel()
+        cli.cancel()
+
 if __name__ == "__main__":
+    logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    use_database()
     with Game() as game:
-        ws_client = WebsocketClient(game)  # Websocket for webpages
-        cli_client = CLIClient(game)  # command line interface
-        asyncio.run(ws_client.run())
-
-        # asyncio.run(cli_client.run())
-        asyncio.create_task(cli_client.run())
+        asyncio.run(main(game))
@@ -1,12 +1,17 @@
+import time
+
 import pytchat
 
-# Replace with your YouTube livestream video ID
-video_id = "hTwVzwT4Yno"
+from config import VIDEO_IDS
 
-chat = pytchat.create(video_id=video_id)
+# Prints the live chats of the configured streams (VIDEO_IDS in .env)
+chats = {video_id: pytchat.create(video_id=video_id) for video_id in VIDEO_IDS}
 
 print("Listening to live chat...")
 
-while chat.is_alive():
-    for c in chat.get().sync_items():
-        print(f"{c.author.name}: {c.message}")
+while any(chat.is_alive() for chat in chats.values()):
+    for video_id, chat in chats.items():
+        if chat.is_alive():
+            for c in chat.get().sync_items():
+                print(f"[{video_id}] {c.author.name}: {c.message}")
+    time.sleep(0.3)
@@ -0,0 +1,187 @@
+"""
+In-process metrics in the Prometheus text format, served next to the websocket server on /metrics.
+Recording costs a lock and a few additions, values that already exist elsewhere (queue depth, pool usage, ...)
+are read through callbacks when scraped.
+"""
+import abc
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http import HTTPStatus
+from typing import Callable, Iterator
+from urllib.parse import urlsplit
+
+# seconds, from a single vote (microseconds) to a slow batch
+DEFAULT_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+
+def _labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(abc.ABC):
+    type = 'untyped'
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        REGISTRY.append(self)
+
+    @abc.abstractmethod
+    def samples(self) -> Iterator[str]:
+        """Sample lines in the text format, one per label values"""
+
+    def render(self) -> str:
+        return f'# HELP {self.name} {self.help}\n# TYPE {self.name} {self.type}\n' + ''.join(self.samples())
+
+
+class Counter(Metric):
+    """Monotonic count, optionally per label values"""
+
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, label_names)
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *label_values) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self) -> Iterator[str]:
+        for label_values, value in sorted(self._values.items()):
+            yield f'{self.name}{_labels(self.label_names, label_values)} {_number(value)}\n'
+
+
+class Histogram(Metric):
+    """Distribution of observed values, e.g. durations in seconds, optionally per label values"""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, label_names)
+        self.buckets = buckets
+        self._series: dict[tuple, list] = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, *label_values) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def totals(self) -> dict[tuple, tuple[int, float]]:
+        """label values -> (number of observations, sum of observed values)"""
+        with self._lock:
+            return {label_values: (sum(series[:-1]), series[-1]) for label_values, series in self._series.items()}
+
+    def samples(self) -> Iterator[str]:
+        for label_values, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield f'{self.name}_bucket{_labels(self.label_names + ("le",), label_values + (le,))} {cumulative}\n'
+            labels = _labels(self.label_names, label_values)
+            yield f'{self.name}_sum{labels} {_number(series[-1])}\n'
+            yield f'{self.name}_count{labels} {cumulative}\n'
+
+
+class Callback(Metric):
+    """Value read when scraped, for numbers that are kept elsewhere anyway"""
+
+    def __init__(self, name: str, help: str, func: Callable[[], float | dict[tuple, float]], type: str = 'gauge',
+                 label_names: tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, label_names)
+        self.func = func
+        self.type = type
+
+    def samples(self) -> Iterator[str]:
+        value = self.func()
+        values = value if isinstance(value, dict) else {(): value}
+        for label_values, value in values.items():
+            yield f'{self.name}{_labels(self.label_names, label_values)} {_number(value)}\n'
+
+
+REGISTRY: list[Metric] = []
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format"""
+    parts = []
+    for metric in REGISTRY:
+        try:
+            parts.append(metric.render())
+        except Exception as e:  # a broken callback must not hide the other metrics
+            logging.getLogger(__name__).warning('Could not collect %s: %s', metric.name, e)
+    return ''.join(parts)
+
+def process_request(connection, request):
+    """
+    websockets `process_request` hook: answers plain HTTP requests for /metrics,
+    every other request continues as websocket handshake
+    """
+
+    if urlsplit(request.path).path != '/metrics':
+        return None
+    response = connection.respond(HTTPStatus.OK, render())
+    del response.headers['Content-Type']
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+def unregister(*metrics: Metric) -> None:
+    for metric in metrics:
+        if metric in REGISTRY:
+            REGISTRY.remove(metric)
+
+
+class Sampler:
+    """True for every n-th call, e.g. to log only a sample of all votes: `if sampler(): log.debug(...)`"""
+
+    def __init__(self, every: int) -> None:
+        self.every = max(1, every)
+        self._calls = 0
+
+    def __call__(self) -> bool:
+        self._calls += 1
+        return (self._calls - 1) % self.every == 0
+
+
+# --- hot path metrics, recorded by the modules of the respective stage ---
+
+STAGE_SECONDS = Histogram(
+    'livevote_stage_seconds',
+    'Time spent per processing stage: parse, user_upsert, milestones, vote_insert, event_insert, journal_append '
+    'and flush per batch, register_vote per vote, serialize per report and wire format, broadcast per report',
+    ('stage',)
+)
+QUEUE_SECONDS = Histogram('livevote_ingest_queue_seconds', 'Time chat messages wait in the ingest queue')
+BATCH_SIZE = Histogram('livevote_ingest_batch_size', 'Chat messages per ingest batch',
+                       buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+REPORTS = Counter('livevote_reports_total', 'Reports sent to clients by type', ('type',))
+CHAT_POLL_SECONDS = Histogram('livevote_chat_poll_seconds', 'Time the chat producer thread spends per pytchat poll')
+CHAT_POLL_ITEMS = Histogram('livevote_chat_poll_items', 'Chat messages per pytchat poll',
+                            buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500))
+CHAT_LAG_SECONDS = Histogram('livevote_chat_lag_seconds',
+                             'Time polled chat messages wait until the event loop takes them from the producer thread')
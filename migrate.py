@@ -1,14 +1,88 @@
-from playhouse.migrate import SqliteMigrator, migrate
-from peewee import SqliteDatabase, FloatField
-from models import User, db
+"""
+Versioned schema migrations for databases created by older versions, run by Game on startup:
 
-migrator = SqliteMigrator(db)
+    python migrate.py
 
-# Add the column
-migrate(
-    migrator.add_column("user", "blocked_until", FloatField(null=True))
-)
+New databases get the current schema from create_tables, the migrations then only record the version.
+Every migration checks the schema before changing it, so it is safe to run against any database state.
+The current version is stored in the Setting table.
+"""
+import logging
+from typing import Callable
 
-# Update existing rows
-query = User.update(blocked_until=None).where(User.leveling.is_null(True))
-query.execute()
+from playhouse.migrate import SchemaMigrator, migrate
+
+from models import db, use_database, BaseModel, Event, User, Vote
+from models.settings import get_setting, set_setting
+
+log = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 'schema_version'
+
+
+def _has_column(model: type[BaseModel], column: str) -> bool:
+    return column in {c.name for c in db.get_columns(model._meta.table_name)}
+
+def _has_index(model: type[BaseModel], columns: list[str]) -> bool:
+    """Whether an index starts with these columns, so it serves the same queries"""
+    return any(index.columns[:len(columns)] == columns for index in db.get_indexes(model._meta.table_name))
+
+def _add_index(migrator: SchemaMigrator, model: type[BaseModel], columns: list[str]) -> list:
+    if _has_index(model, columns):
+        return []
+    return [migrator.add_index(model._meta.table_name, columns, False)]
+
+
+def add_blocked_until(migrator: SchemaMigrator) -> list:
+    """User blocks"""
+    if _has_column(User, 'blocked_until'):
+        return []
+    return [migrator.add_column(User._meta.table_name, 'blocked_until', User.blocked_until)]
+
+def add_history_indexes(migrator: SchemaMigrator) -> list:
+    """
+    Indexes of the remaining history queries, the latest votes and events are kept in memory (see recent.py):
+    - votes and events by time range (history, redaction of a time range)
+    - users by name (blocking from the CLI)
+    """
+    return (_add_index(migrator, Vote, ['timestamp'])
+            + _add_index(migrator, Event, ['timestamp'])
+            + _add_index(migrator, User, ['username']))
+
+
+# version -> migration, append only
+MIGRATIONS: dict[int, Callable[[SchemaMigrator], list]] = {
+    1: add_blocked_until,
+    2: add_history_indexes,
+}
+
+
+def get_schema_version() -> int:
+    return int(get_setting(SCHEMA_VERSION) or 0)
+
+def run_migrations() -> list[int]:
+    """
+    Applies all migrations newer than the stored schema version, in order.
+    :return: applied versions
+    """
+
+    version = get_schema_version()
+    migrator = SchemaMigrator.from_database(db.obj)
+    applied = []
+    for target in sorted(v for v in MIGRATIONS if v > version):
+        operations = MIGRATIONS[target](migrator)
+        with db.atomic():
+            migrate(*operations)
+            set_setting(SCHEMA_VERSION, str(target))
+        if operations:
+            log.info('Migrated schema to version %d: %s', target, MIGRATIONS[target].__name__)
+        applied.append(target)
+    return applied
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    use_database()
+    with db:
+        run_migrations()
+        print(f'Schema version {get_schema_version()}')
@@ -0,0 +1,219 @@
+"""
+Milestone events (user levels, country points, ...) from configurable rules, see MILESTONE_RULES.
+
+A rule watches one counter of users or countries, all time or in a sliding window of the scoreboard, and
+fires at the powers of its base from its minimum on (10, 100, 1000, ... for base 10). Every watched user or
+country has its next threshold cached, so the usual vote that crosses nothing costs one comparison per rule.
+Events get their ids here, so the ingest pipeline can insert the events of a batch with one statement.
+"""
+import datetime
+import logging
+from collections import OrderedDict
+from typing import Hashable, Iterable
+
+from peewee import fn
+
+from config import LEADERBOARD_WINDOWS, MILESTONE_RULES, USER_CACHE_SIZE
+from models import Event, Vote
+from scoreboard import scoreboard
+from windows import parse_windows
+
+log = logging.getLogger(__name__)
+
+# subject -> metric -> attribute of the counters (User or CountryScore)
+METRICS = {
+    'user': {'level': 'leveling', 'points': 'total_points', 'votes': 'total_votes'},
+    'country': {'points': 'points', 'votes': 'votes'},
+}
+WINDOW_METRICS = ('points', 'votes')
+# metric -> what a vote adds to it
+VOTE_DELTAS = {'level': 'xp_gain', 'points': 'points', 'votes': 'vote_count'}
+
+
+class MilestoneRule:
+    """
+    Fires `type` events when a counter reaches base ** p (p >= 0), leaving out powers below `minimum`.
+    Thresholds of a subject are re-armed once its counter fell below the previous threshold divided by the base
+    (redactions, or votes leaving the window), so a counter going back and forth around one threshold fires once.
+    The thresholds of the `max_size` least recently checked subjects are kept, others are derived again from the
+    counter without the vote when they are checked next.
+    """
+
+    def __init__(self, type: str, subject: str, metric: str, base: int, minimum: int = 1, window: str = None,
+                 max_size: int = USER_CACHE_SIZE) -> None:
+        if subject not in METRICS:
+            raise ValueError(f'Unknown milestone subject {subject!r}, expected one of {", ".join(METRICS)}')
+        if metric not in (WINDOW_METRICS if window else METRICS[subject]):
+            raise ValueError(f'Unknown milestone metric {subject}.{metric}' + (f'@{window}' if window else ''))
+        if base < 2:
+            raise ValueError(f'Milestone base of {type} must be at least 2')
+        self.type = type
+        self.subject = subject
+        self.metric = metric
+        self.attribute = METRICS[subject].get(metric)
+        self.delta = VOTE_DELTAS[metric]
+        self.base = base
+        self.minimum = minimum
+        self.window = window
+        self.first = 1
+        while self.first < minimum:
+            self.first *= base
+        self.max_size = max_size
+        # subject id -> (last threshold, next threshold), least recently checked first
+        self._bounds: OrderedDict[Hashable, tuple[float, float]] = OrderedDict()
+
+    def __repr__(self) -> str:
+        window = f'@{self.window}' if self.window else ''
+        return f'MilestoneRule({self.type}: {self.subject}.{self.metric}{window}, base {self.base} from {self.first})'
+
+    def bounds(self, value: float) -> tuple[float, float]:
+        """The highest threshold at or below `value` (0 below the first one) and the next one above it"""
+        last, threshold = 0, self.first
+        while threshold <= value:
+            last, threshold = threshold, threshold * self.base
+        return last, threshold
+
+    def crossed(self, id: Hashable, value: float, delta: float) -> list[int]:
+        """
+        Thresholds reached by a subject's counter since it was last checked.
+        :param value: current value of the counter
+        :param delta: what was added since the last check, to know where a subject seen for the first time came from
+        """
+
+        bounds = self._bounds.get(id)
+        if bounds is None:
+            bounds = self._bounds[id] = self.bounds(value - delta)
+            if len(self._bounds) > self.max_size:
+                self._bounds.popitem(last=False)
+        else:
+            self._bounds.move_to_end(id)
+        last, threshold = bounds
+        if value < threshold:
+            if value * self.base < last:
+                self._bounds[id] = self.bounds(value)
+            return []
+        milestones = []
+        while threshold <= value:
+            milestones.append(threshold)
+            threshold *= self.base
+        self._bounds[id] = (milestones[-1], threshold)
+        return milestones
+
+    def forget(self) -> None:
+        """Drops the cached thresholds, e.g. after the counters were rebuilt"""
+        self._bounds.clear()
+
+
+def parse_rules(value: str, windows: Iterable[str] = ()) -> list[MilestoneRule]:
+    """
+    Rules from a comma separated list of type:subject.metric[@window]:base[:minimum],
+    e.g. 'user_level_up:user.level:10,country_points_1h:country.points@1h:10:1000'
+    :param windows: names of the sliding windows of the scoreboard
+    """
+
+    rules = []
+    for spec in value.split(','):
+        if not spec.strip():
+            continue
+        parts = [part.strip() for part in spec.split(':')]
+        if len(parts) not in (3, 4) or '.' not in parts[1]:
+            raise ValueError(f'Invalid milestone rule {spec!r}, expected type:subject.metric[@window]:base[:minimum]')
+        counter, _, window = parts[1].partition('@')
+        if window and window not in windows:
+            raise ValueError(f'Milestone rule {spec!r} uses the unknown window {window!r}, see LEADERBOARD_WINDOWS')
+        subject, _, metric = counter.partition('.')
+        rules.append(MilestoneRule(parts[0], subject, metric, int(parts[2]), int(parts[3]) if len(parts) == 4 else 1,
+                                   window or None))
+    return rules
+
+
+class MilestoneEngine:
+    """
+    Checks the rules against the scoreboard counters. All time rules are checked per vote in `check_vote`, right
+    after the vote was applied. Windowed rules are checked once per batch in `check_windows`, reading the sliding
+    windows once for every user and country of the batch instead of once per vote.
+    Not thread safe, the ingest pipeline calls it under the scoreboard lock.
+    """
+
+    def __init__(self, rules: list[MilestoneRule]) -> None:
+        self.rules = [rule for rule in rules if not rule.window]
+        self.window_rules = [rule for rule in rules if rule.window]
+        self.fired = 0
+        self._next_event_id: int | None = None
+
+    def allocate_event_id(self) -> int:
+        """Like IngestPipeline.allocate_vote_id, this process is the only one inserting events"""
+        if self._next_event_id is None:
+            self._next_event_id = (Event.select(fn.MAX(Event.event_id)).scalar() or 0) + 1
+        event_id = self._next_event_id
+        self._next_event_id += 1
+        return event_id
+
+    def _events(self, rule: MilestoneRule, vote: Vote, milestones: list[int]) -> list[Event]:
+        self.fired += len(milestones)
+        now = datetime.datetime.now()
+        return [
+            Event(event_id=self.allocate_event_id(), type=rule.type, user=vote.user,
+                  country=vote.country if rule.subject == 'country' else None, milestone=milestone, timestamp=now)
+            for milestone in milestones
+        ]
+
+    def check_vote(self, vote: Vote, user, country_score) -> list[Event]:
+        """
+        Events of the all time rules crossed by a vote, not stored yet.
+        :param user: the user instance holding the counters, after the vote was applied (see Scoreboard.apply_vote)
+        :param country_score: the counters of the voted country, after the vote was applied
+        """
+
+        events = []
+        for rule in self.rules:
+            if rule.subject == 'user':
+                id, counters = user.user_id, user
+            else:
+                id, counters = country_score.alpha2, country_score
+            value = float(getattr(counters, rule.attribute) or 0)
+            milestones = rule.crossed(id, value, float(getattr(vote, rule.delta) or 0))
+            if milestones:
+                events.extend(self._events(rule, vote, milestones))
+        return events
+
+    def check_windows(self, votes: list[Vote]) -> dict[int, list[Event]]:
+        """
+        Events of the windowed rules reached with a batch of applied votes, not stored yet.
+        :return: vote id -> events, attributed to the last vote of the batch for the user or country
+        """
+
+        if not self.window_rules or not votes:
+            return {}
+        events: dict[int, list[Event]] = {}
+        for rule in self.window_rules:
+            latest: dict[str, Vote] = {}  # subject id -> last vote of the batch
+            deltas: dict[str, float] = {}
+            for vote in votes:
+                id = vote.user_id if rule.subject == 'user' else vote.country_id
+                latest[id] = vote
+                deltas[id] = deltas.get(id, 0) + float(getattr(vote, rule.delta) or 0)
+            windows = scoreboard.user_windows if rule.subject == 'user' else scoreboard.country_windows
+            window = windows[rule.window]
+            window.advance(votes[-1].timestamp.timestamp())
+            for id, vote in latest.items():
+                milestones = rule.crossed(id, window.get(id)[rule.metric], deltas[id])
+                if milestones:
+                    events.setdefault(vote.vote_id, []).extend(self._events(rule, vote, milestones))
+        return events
+
+    def reset(self) -> None:
+        """Forgets the cached thresholds of all rules and the next event id, e.g. after a batch was rolled back"""
+        for rule in (*self.rules, *self.window_rules):
+            rule.forget()
+        self._next_event_id = None
+
+    def stats(self) -> dict:
+        return {
+            'rules': len(self.rules) + len(self.window_rules),
+            'fired': self.fired,
+            'tracked': sum(len(rule._bounds) for rule in (*self.rules, *self.window_rules)),
+        }
+
+
+milestones = MilestoneEngine(parse_rules(MILESTONE_RULES, parse_windows(LEADERBOARD_WINDOWS)))
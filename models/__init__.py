@@ -1,22 +1,90 @@
 import json
 import datetime
-import os
 from typing import Any
-from dotenv import dotenv_values
 
+from playhouse.pool import PooledMySQLDatabase, PooledSqliteDatabase
 from playhouse.shortcuts import model_to_dict as _model_to_dict
 from peewee import *
+from peewee import Insert
+
+from config import (DB_BACKEND, DB_HOST, DB_NAME, DB_PASSWD, DB_PATH, DB_POOL_SIZE, DB_PORT, DB_QUERY_TIMEOUT,
+                    DB_USER)
+
+# table options of the mysql backend, emojis in user names need the full utf8mb4
+MYSQL_TABLE_SETTINGS = ['DEFAULT CHARSET=utf8mb4', 'COLLATE=utf8mb4_unicode_ci']
+# WAL lets readers (status reports) run while a batch is written, synchronous=normal only syncs at checkpoints
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'foreign_keys': 1,
+    'cache_size': -64 * 1024,  # KiB
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'memory',
+    'wal_autocheckpoint': 4000,  # pages
+}
+
+
+class SqliteWALDatabase(PooledSqliteDatabase):
+    """
+    Pooled SQLite database, shared by the db_executor threads.
+    Transactions take the write lock when they begin, so concurrent writers wait for each other (up to the busy
+    timeout) instead of failing when a read transaction tries to become a write transaction.
+    """
+
+    def begin(self, lock_type: str = None) -> None:
+        super().begin(lock_type or 'IMMEDIATE')
 
-db_config = dotenv_values()
-db = MySQLDatabase(
-    db_config['DB_NAME'],
-    user=db_config['DB_USER'],
-    password=db_config['DB_PASSWD'],
-    host=db_config['DB_HOST'],
-    port=int(db_config['DB_PORT']),
-    charset='utf8mb4',
-    use_unicode=True
-)
+
+def create_database(backend: str = DB_BACKEND, name: str = None) -> Database:
+    """
+    Database of the given backend, configured in config.py (.env or environment variables)
+    :param backend: "mysql" or "sqlite"
+    :param name: database name (mysql) or file (sqlite) instead of the configured one
+    :return:
+    """
+
+    if backend == 'sqlite':
+        return SqliteWALDatabase(
+            name or DB_PATH,
+            pragmas={**SQLITE_PRAGMAS, 'busy_timeout': DB_QUERY_TIMEOUT * 1000},  # waiting for the write lock
+            max_connections=DB_POOL_SIZE + 1,
+            stale_timeout=None,
+            timeout=DB_QUERY_TIMEOUT,  # waiting for a free connection
+            check_same_thread=False  # pooled connections move between the executor threads
+        )
+    if backend == 'mysql':
+        return PooledMySQLDatabase(
+            name or DB_NAME,
+            user=DB_USER,
+            password=DB_PASSWD,
+            host=DB_HOST,
+            port=DB_PORT,
+            charset='utf8mb4',
+            use_unicode=True,
+            max_connections=DB_POOL_SIZE + 1,
+            stale_timeout=300,
+            timeout=DB_QUERY_TIMEOUT,  # waiting for a free connection
+            read_timeout=DB_QUERY_TIMEOUT,
+            write_timeout=DB_QUERY_TIMEOUT
+        )
+    raise ValueError(f'Invalid database backend: {backend}. Must be one of {["mysql", "sqlite"]}')
+
+# all models and modules go through this proxy, see use_database
+db = DatabaseProxy()
+
+def use_database(database: Database = None) -> None:
+    """
+    Points all models at a database. Importing the models needs no database, entry points call this on startup,
+    before any connection is opened.
+    :param database: e.g. a local SQLite file for benchmarks, the configured database by default
+    :return:
+    """
+
+    if database is None:
+        database = create_database()
+    db.initialize(database)
+    for model in BaseModel.__subclasses__():
+        model._meta.table_settings = list(MYSQL_TABLE_SETTINGS) if isinstance(database, MySQLDatabase) else []
 
 def to_dict(model: Model | dict | list | tuple) -> dict:
     """
@@ -40,10 +108,48 @@ def to_dict(model: Model | dict | list | tuple) -> dict:
 
     return convert(model)
 
+def upsert(query: Insert, conflict_target: list[Field], preserve: list[Field] = None, update: dict = None,
+           increment: list[Field] = None) -> Insert:
+    """
+    Adds an "insert or update" clause to an insert query.
+    MySQL resolves conflicts on any unique key and refuses an explicit conflict target, other backends require one.
+    :param query: insert query, e.g. Model.insert_many(rows)
+    :param conflict_target: unique columns the conflict is detected on
+    :param preserve: columns that take the newly inserted value
+    :param update: explicit column -> value updates
+    :param increment: columns the newly inserted value is added to
+    :return:
+    """
+
+    update = dict(update or {})
+    if isinstance(db.obj, MySQLDatabase):
+        update.update({field: field + fn.VALUES(field) for field in increment or []})
+        return query.on_conflict(preserve=preserve, update=update or None)
+    update.update({field: field + getattr(EXCLUDED, field.column_name) for field in increment or []})
+    return query.on_conflict(conflict_target=conflict_target, preserve=preserve, update=update or None)
+
+def bulk_update(key: Field, rows: list[dict], fields: list[Field], increment: bool = False) -> int:
+    """
+    Updates many rows with a single UPDATE ... SET field = CASE key WHEN ... statement.
+    :param key: primary key field of the model, rows are matched on it
+    :param rows: dicts holding the key and new values by field name
+    :param fields: fields to update
+    :param increment: add the values to the current ones instead of replacing them
+    :return: number of updated rows
+    """
+
+    if not rows:
+        return 0
+    update = {}
+    for field in fields:
+        case = Case(key, [(row[key.name], row[field.name]) for row in rows], 0 if increment else field)
+        update[field] = field + case if increment else case
+    return key.model.update(update).where(key.in_([row[key.name] for row in rows])).execute()
+
 class BaseModel(Model):
     class Meta:
         database = db
-        table_settings = ['DEFAULT CHARSET=utf8mb4', 'COLLATE=utf8mb4_unicode_ci']
+        table_settings = []  # set by use_database
 
     def __iter__(self):
         for key, value in to_dict(self).items():
@@ -64,7 +170,7 @@ class CountryCache(BaseModel):
 class User(BaseModel):
     user_id = CharField(unique=True, primary_key=True)
     channel_url = CharField()
-    username = CharField()
+    username = CharField(index=True)
     image_url = CharField()
     is_mod = CharField(default=False)
 
@@ -80,6 +186,16 @@ class Country(BaseModel):
     name = CharField()
     cache = ForeignKeyField(CountryCache, backref='countries', on_delete='CASCADE', unique=True)
 
+class UserCountry(BaseModel):
+    """Votes and points of a user per country, maintained by the scoreboard"""
+    user = ForeignKeyField(User, backref='country_totals')
+    country = ForeignKeyField(Country, backref='user_totals', on_delete='CASCADE')
+    votes = IntegerField(default=0)
+    points = IntegerField(default=0)
+
+    class Meta:
+        primary_key = CompositeKey('user', 'country')
+
 class Event(BaseModel):
     event_id = AutoField()
     type = CharField() # e.g. "user_level_up", "country_points", "country_votes"
@@ -88,6 +204,11 @@ class Event(BaseModel):
     milestone = IntegerField()
     timestamp = DateTimeField(default=datetime.datetime.now)
 
+    class Meta:
+        indexes = (
+            (('timestamp',), False),
+        )
+
 class Vote(BaseModel):
     vote_id = AutoField()
     user = ForeignKeyField(User, backref="votes")
@@ -101,4 +222,5 @@ class Vote(BaseModel):
     class Meta:
         indexes = (
             (('user', 'country', 'timestamp'), False),
+            (('timestamp',), False),
         )
@@ -1,12 +1,25 @@
+import functools
+import json
+import os
 from typing import Literal
 
-import country_converter
-import pycountry
-from countryinfo import CountryInfo
-
 from errors import InvalidCountry
 from models import Country, CountryCache
 
+# generated by build_countries.py, so startup does not need pycountry, country_converter and countryinfo
+COUNTRY_TABLE_PATH = os.path.join(os.path.dirname(__file__), 'countries.json')
+
+
+@functools.cache
+def load_country_table() -> list[dict]:
+    """
+    Precomputed country data: alpha2, alpha3, short name, continent and alternative names of every country
+    :return:
+    """
+
+    with open(COUNTRY_TABLE_PATH, encoding='utf-8') as f:
+        return json.load(f)
+
 def get_or_create(query: str) -> Country:
     info = get_country_data(query)
     if not info:
@@ -37,6 +50,15 @@ def get_or_create(query: str) -> Country:
     return country
 
 def get_country_data(query: str) -> dict | None:
+    # the precomputed table covers codes and short names without loading the heavy libraries
+    for info in load_country_table():
+        if query.upper() in (info['alpha2'], info['alpha3']) or query.lower() == info['name'].lower():
+            return info
+
+    import country_converter
+    import pycountry
+    from countryinfo import CountryInfo
+
     country = (
         pycountry.countries.get(alpha_2=query.upper())
         or pycountry.countries.get(alpha_3=query.upper())
@@ -1,12 +1,12 @@
 from typing import Optional
 
-from models import Setting
+from models import Setting, upsert
 
 
 def set_setting(key: str, value: str):
-    Setting.insert(key=key, value=value).on_conflict(
+    upsert(
+        Setting.insert(key=key, value=value),
         conflict_target=[Setting.key],
-        preserve=[],
         update={Setting.value: value}
     ).execute()
 
@@ -14,5 +14,5 @@ def get_setting(key: str) -> Optional[str]:
     try:
         setting = Setting.get(Setting.key == key)
         return setting.value
-    except Setting.table_exists():
+    except Setting.DoesNotExist:
         return None
@@ -1,9 +1,9 @@
 import datetime
 from typing import Literal
 
-from peewee import DoesNotExist, fn
+from peewee import DoesNotExist
 
-from models import User, Country, Vote, to_dict
+from models import User, Country, UserCountry, to_dict
 
 
 def get_top_users(order_key: Literal['leveling', 'total_points', 'total_votes'] = 'leveling', limit: int = 20):
@@ -25,7 +25,7 @@ def get_top_users(order_key: Literal['leveling', 'total_points', 'total_votes']
 
     return [
         user for user in User.select()
-        .where(User.blocked_until.is_null() or datetime.datetime.now() > User.blocked_until)
+        .where(User.blocked_until.is_null() | (User.blocked_until < datetime.datetime.now()))
         .order_by(key_to_val[order_key].desc())
         .limit(limit)
     ]
@@ -39,39 +39,61 @@ def get_user(user_id: str = None, user_name: str = None) -> User | None:
         return None
 
 def get_top_user_country(user: User) -> Country | None:
-    query = (
-        Vote
-        .select(Vote.country, fn.SUM(Vote.vote_count).alias("total_votes"))
-        .where((Vote.user == user) & (Vote.redacted == False))
-        .group_by(Vote.country)
-        .order_by(fn.SUM(Vote.vote_count).desc())
-        .limit(1)
-    )
-    result = query.first()
-    return result.country or None
+    return get_top_user_countries([user.user_id]).get(user.user_id)
 
-def rank_users() -> list:
+def get_top_user_countries(user_ids: list[str]) -> dict[str, Country]:
+    """
+    Favourite country (most votes) of each user, from the maintained per user and country totals.
+    A single query, independent of how many votes the users have cast.
+    :param user_ids:
+    :return: user_id -> Country, users without votes are missing
+    """
+
+    top: dict[str, UserCountry] = {}
+    query = (UserCountry
+             .select(UserCountry, Country)
+             .join(Country)
+             .where((UserCountry.user.in_(user_ids)) & (UserCountry.votes > 0)))
+    for uc in query:
+        best = top.get(uc.user_id)
+        if best is None or uc.votes > best.votes:
+            top[uc.user_id] = uc
+    return {user_id: uc.country for user_id, uc in top.items()}
+
+def rank_users(top_users: list[User] = None, top_countries: dict[str, Country] = None) -> list:
     """
     Ranking of top users. As opposed to  get_top_users, this function includes top countries.
+    :param top_users: ranked users, e.g. from the scoreboard, get_top_users by default
+    :param top_countries: user_id -> favourite country, e.g. from the scoreboard, get_top_user_countries by default
     :return:
     """
 
     user_ranking = list()
-    for user in get_top_users():
+    top_users = get_top_users() if top_users is None else top_users
+    if top_countries is None:
+        top_countries = get_top_user_countries([user.user_id for user in top_users])
+    for user in top_users:
         user_dict = to_dict(user)
-        user_dict['top_country'] = get_top_user_country(user).alpha2
+        top_country = top_countries.get(user.user_id)
+        user_dict['top_country'] = top_country.alpha2 if top_country else None
         user_ranking.append(user_dict)
     return user_ranking
 
-def block_user(user_id: str = None, user_name: str = None, block_duration_seconds: int | bool = None) -> bool:
+def block_user(user_id: str = None, user_name: str = None, block_duration_seconds: int | bool = None) -> User | None:
+    """
+    Blocks a user for a number of seconds, for 5 years with None or True, or removes the block with False.
+    :return: the updated user, None if the user does not exist
+    """
+
     user = get_user(user_id, user_name)
     if user is None:
-        print('User not found!')
-        return False
+        return None
     if block_duration_seconds is False:  # remove all blocks
         user.blocked_until = None
-    elif block_duration_seconds is None or block_duration_seconds is True:  # infinite duration
-        block_duration_seconds = 60 * 60 * 24 * 365 * 5  # 5 years
-        user.blocked_until = (datetime.datetime.now() + datetime.timedelta(seconds=block_duration_seconds)).replace(tzinfo=datetime.timezone.utc)
-    user.save()
-    return True
+    else:
+        if block_duration_seconds is None or block_duration_seconds is True:  # infinite duration
+            block_duration_seconds = 60 * 60 * 24 * 365 * 5  # 5 years
+        # naive local time like every other timestamp, blocks are compared against datetime.now()
+        user.blocked_until = datetime.datetime.now() + datetime.timedelta(seconds=block_duration_seconds)
+    user.save(only=[User.blocked_until])  # counters are owned by the scoreboard
+    return user
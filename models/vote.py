@@ -1,10 +1,16 @@
-from models import Vote
+from models import Country, User, Vote
 
 
 def get_latest_votes(limit: int = 20) -> list[Vote]:
+    """
+    Latest votes that are not redacted, newest first, with users and countries.
+    Vote ids grow with time, so this walks the primary key backwards instead of sorting by timestamp.
+    """
+
     return [
-        vote for vote in Vote.select()
+        vote for vote in Vote.select(Vote, User, Country)
+        .join(User).switch(Vote).join(Country)
         .where(Vote.redacted == False)
-        .order_by(Vote.timestamp.desc())
+        .order_by(Vote.vote_id.desc())
         .limit(limit)
     ]
@@ -0,0 +1,56 @@
+"""
+Moderation of votes a user already cast, see blocklist.py for blocking the votes to come.
+"""
+import datetime
+import logging
+
+from journal import journal, JournalRecord
+from models import db, User, Vote
+from recent import recent
+from scoreboard import scoreboard
+from snapshot import status_snapshot
+
+log = logging.getLogger(__name__)
+
+
+def redact_votes(user: User, since: datetime.datetime = None, until: datetime.datetime = None) -> int:
+    """
+    Redacts the votes a user cast in a time range with one UPDATE and takes exactly these votes back out of the
+    country, user and window counters (see Scoreboard.retract_votes), instead of recalculating all counters.
+    The vote journal gets a retraction record per vote, so restoring from it gives the same counters.
+    :param since: start of the range (inclusive), the first vote by default
+    :param until: end of the range (exclusive), now by default
+    :return: number of redacted votes
+    """
+
+    condition = (Vote.user == user.user_id) & (Vote.redacted == False)
+    if since is not None:
+        condition &= Vote.timestamp >= since
+    if until is not None:
+        condition &= Vote.timestamp < until
+    with scoreboard.batch():  # no votes are stored meanwhile, the selected votes are exactly the updated ones
+        with db.atomic():
+            votes = list(Vote.select(Vote.vote_id, Vote.user, Vote.country, Vote.timestamp, Vote.vote_count,
+                                     Vote.points, Vote.xp_gain)
+                         .where(condition)
+                         .order_by(Vote.vote_id))
+            if not votes:
+                return 0
+            Vote.update(redacted=True).where(condition & (Vote.vote_id <= votes[-1].vote_id)).execute()
+            scoreboard.retract_votes(user, votes)
+        if journal.is_open:
+            vote_id = max(journal.last_vote_id, votes[-1].vote_id)
+            try:
+                journal.append([JournalRecord.retraction(vote, vote_id) for vote in votes])
+                journal.sync()
+            except Exception as e:
+                # the redaction is stored, a journal without it would restore wrong counters
+                log.error('Exception while journaling a redaction, journal closed until the next start: %s', e)
+                journal.close()
+    # retracted counters are written right away, the checkpoint does not cover votes that were already flushed
+    scoreboard.flush()
+    recent.load()  # without the redacted votes
+    status_snapshot.invalidate()
+    log.info('Redacted %d votes of %s (%s)', len(votes), user.username, user.user_id)
+    return len(votes)
+
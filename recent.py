@@ -0,0 +1,49 @@
+import threading
+from collections import deque
+
+from config import RECENT_SIZE
+from models import Event, Vote
+from models.event import get_latest_events
+from models.vote import get_latest_votes
+
+
+class RecentActivity:
+    """
+    Fixed-size buffers of the latest votes and events, filled as they are stored and seeded from the database
+    on startup, so status reports never query the vote and event history.
+    """
+
+    def __init__(self, size: int = RECENT_SIZE) -> None:
+        self.size = size
+        self._votes: deque[Vote] = deque(maxlen=size)
+        self._events: deque[Event] = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        """Seeds the buffers with the latest stored votes and events"""
+        votes = get_latest_votes(self.size)
+        events = get_latest_events(self.size)
+        with self._lock:
+            self._votes.clear()
+            self._votes.extend(reversed(votes))
+            self._events.clear()
+            self._events.extend(reversed(events))
+
+    def add(self, votes: list[Vote], events: list[Event]) -> None:
+        """Adds stored votes and events, oldest first. Redacted votes are skipped."""
+        with self._lock:
+            self._votes.extend(vote for vote in votes if not vote.redacted)
+            self._events.extend(events)
+
+    def votes(self) -> list[Vote]:
+        """Latest votes, newest first"""
+        with self._lock:
+            return list(reversed(self._votes))
+
+    def events(self) -> list[Event]:
+        """Latest events, newest first"""
+        with self._lock:
+            return list(reversed(self._events))
+
+
+recent = RecentActivity()
@@ -1,7 +1,9 @@
-from models import db, Country, CountryCache, Event, User, Vote, Setting
+from models import db, use_database, Country, CountryCache, Event, User, UserCountry, Vote, Setting
+
+use_database()
 
 # Drop all tables (if they exist)
-db.drop_tables([Vote, User, CountryCache, Event, Country, Setting])
+db.drop_tables([Vote, UserCountry, User, CountryCache, Event, Country, Setting])
 
 # Recreate tables
-db.create_tables([CountryCache, Country, Event, User, Vote, Setting])
\ No newline at end of file
+db.create_tables([CountryCache, Country, Event, User, UserCountry, Vote, Setting])
\ No newline at end of file
@@ -0,0 +1,87 @@
+import json
+import os
+import re
+
+from config import COUNTRY_ALIASES_PATH
+from models import Country
+from models.country import load_country_table
+
+_REGIONAL_INDICATOR_A = 0x1F1E6
+_NON_WORD = re.compile(r'[\W_]+')
+
+
+def normalize(text: str) -> str:
+    """Lower case, punctuation and repeated whitespace collapsed into single spaces"""
+    return _NON_WORD.sub(' ', text.casefold()).strip()
+
+def flag_emoji(alpha2: str) -> str:
+    """Regional indicator pair of a country, e.g. "DE" -> 🇩🇪"""
+    return ''.join(chr(_REGIONAL_INDICATOR_A + ord(c) - ord('A')) for c in alpha2.upper())
+
+
+class CountryResolver:
+    """
+    Maps chat messages to countries without database access.
+    Built once at startup from the Country table, the precomputed names of models/countries.json
+    and the configured aliases.
+
+    A message resolves to a country if, in this order
+    - it starts with the country's flag emoji
+    - the whole message is a name, alias, alpha-3 or alpha-2 code of the country
+    - its first word is a name, alias or alpha-2 code of the country
+    - its first two characters are the alpha-2 code of the country (original voting syntax, e.g. "DE!!!")
+    """
+
+    def __init__(self) -> None:
+        self._flags: dict[str, Country] = {}
+        self._alpha2: dict[str, Country] = {}
+        self._words: dict[str, Country] = {}  # keys matching the first word or the whole message
+        self._messages: dict[str, Country] = {}  # keys only matching the whole message
+
+    def load(self, aliases_path: str = COUNTRY_ALIASES_PATH) -> None:
+        countries = {country.alpha2: country for country in Country.select()}
+        names = {info['alpha2']: info.get('names', []) for info in load_country_table()}
+
+        flags, alpha2s, words, messages = {}, {}, {}, {}
+        for alpha2, country in countries.items():
+            flags[flag_emoji(alpha2)] = country
+            alpha2s[alpha2] = country
+            words[alpha2.lower()] = country
+            messages[country.alpha3.lower()] = country
+            for name in [country.name, *names.get(alpha2, [])]:
+                words.setdefault(normalize(name), country)
+        if aliases_path and os.path.exists(aliases_path):
+            with open(aliases_path, encoding='utf-8') as f:
+                for alias, alpha2 in json.load(f).items():
+                    if alpha2.upper() in countries:
+                        words[normalize(alias)] = countries[alpha2.upper()]
+        messages.update(words)  # names and aliases win over an equal alpha-3 code
+
+        self._flags, self._alpha2, self._words, self._messages = flags, alpha2s, words, messages
+
+    def resolve(self, message: str) -> Country | None:
+        """
+        Country a chat message votes for, None for regular chatter
+        :param message:
+        :return:
+        """
+
+        msg = message.strip()
+        if len(msg) < 2:
+            return None
+        country = self._flags.get(msg[:2])
+        if country is not None:
+            return country
+        text = normalize(msg)
+        country = self._messages.get(text)
+        if country is None and ' ' in text:
+            country = self._words.get(text.split(' ', 1)[0])
+        if country is None:
+            country = self._alpha2.get(msg[:2].upper())
+        return country
+
+    def __len__(self) -> int:
+        return len(self._alpha2)
+
+
+resolver = CountryResolver()
@@ -0,0 +1,559 @@
+import asyncio
+import datetime
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterable, Iterator
+
+from peewee import chunked
+
+from cache import get_checkpoint, set_checkpoint
+from config import FLUSH_INTERVAL, FLUSH_BATCH_SIZE, LEADERBOARD_WINDOWS, WINDOW_BUCKETS
+from db_executor import db_executor
+from journal import journal, retract, JournalRecord, Recovery
+from leaderboard import Leaderboard
+from metrics import STAGE_SECONDS
+from models import db, upsert, bulk_update, Country, CountryCache, User, UserCountry, Vote
+from user_cache import UserCache
+from windows import SlidingWindow, parse_windows
+
+log = logging.getLogger(__name__)
+
+
+class CountryScore:
+    __slots__ = ('alpha2', 'votes', 'points')
+
+    def __init__(self, alpha2: str, votes: int = 0, points: int = 0) -> None:
+        self.alpha2 = alpha2
+        self.votes = votes
+        self.points = points
+
+
+class UserScore:
+    __slots__ = ('user_id', 'leveling', 'total_points', 'total_votes', 'blocked_until')
+
+    def __init__(self, user_id: str, leveling: float = 0, total_points: float = 0, total_votes: float = 0,
+                 blocked_until: datetime.datetime | None = None) -> None:
+        self.user_id = user_id
+        self.leveling = leveling
+        self.total_points = total_points
+        self.total_votes = total_votes
+        self.blocked_until = blocked_until
+
+    @property
+    def blocked(self) -> bool:
+        return self.blocked_until is not None and not (datetime.datetime.now() > self.blocked_until)
+
+
+class _BatchUndo:
+    """Values changed by a running batch (see Scoreboard.batch), as they were before it"""
+
+    __slots__ = ('users', 'countries', 'user_countries', 'windows', 'checkpoint')
+
+    def __init__(self, checkpoint: tuple[int, bool]) -> None:
+        self.users: dict[str, tuple] = {}  # user_id -> (user, leveling, total_points, total_votes, latest_vote, dirty)
+        self.countries: dict[str, tuple] = {}  # alpha2 -> (score, votes, points, dirty)
+        self.user_countries: dict[tuple[str, str], list[int] | None] = {}  # (user_id, alpha2) -> delta
+        self.windows: list[tuple[str, str, float, int, int]] = []  # additions, (user_id, alpha2, time, votes, points)
+        self.checkpoint = checkpoint
+
+
+class Scoreboard:
+    """
+    Authoritative in-memory counters of countries (CountryCache) and users.
+    User counters live on the User instances of the user cache, which keeps users with unflushed counters.
+    Per user and country totals (UserCountry) are not kept in memory, only their changes since the last flush.
+    Votes are applied in memory, changed rows are written back to the database in batches by `flush`.
+    While the scoreboard is running, it is the only writer of these counter columns.
+    Countries and all users are also ranked in memory (see leaderboard.Leaderboard), so rankings need no sorting
+    queries. Sliding windows (see windows.SlidingWindow) rank countries and users by their recent votes and points.
+    Every flush also stores the recalc checkpoint (see cache.recalc_cache): the highest stored vote whose
+    counters are included, so votes that were stored but never flushed are added on the next start.
+    """
+
+    def __init__(self) -> None:
+        self.countries: dict[str, CountryScore] = {}
+        self.country_info: dict[str, Country] = {}  # names of ranked countries
+        self.country_board = Leaderboard('alpha2', ('points', 'votes'))
+        self.user_board = Leaderboard('user_id', ('leveling', 'total_points', 'total_votes'))
+        self.windows = parse_windows(LEADERBOARD_WINDOWS)  # name -> seconds
+        self.country_windows = {name: SlidingWindow(seconds, WINDOW_BUCKETS, ('points', 'votes'))
+                                for name, seconds in self.windows.items()}
+        self.user_windows = {name: SlidingWindow(seconds, WINDOW_BUCKETS, ('points', 'votes'), dtype='int32')
+                             for name, seconds in self.windows.items()}
+        self._dirty_countries: set[str] = set()
+        self._dirty_users: set[str] = set()
+        self._flushing_users: set[str] = set()
+        self._user_country_deltas: dict[tuple[str, str], list[int]] = {}  # (user_id, alpha2) -> [votes, points]
+        self.users = UserCache(pinned=lambda user_id: user_id in self._dirty_users or user_id in self._flushing_users)
+        self.checkpoint: int = 0
+        self._checkpoint_dirty = False
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()  # one flush at a time
+        self._undo: _BatchUndo | None = None  # while a batch is running
+
+    def load(self) -> None:
+        """
+        (Re)loads country counters and the rankings from the database.
+        User instances are loaded lazily with their first vote, the ranking keeps a compact record of every user.
+        """
+
+        with self._lock:
+            self.countries = {
+                cc.alpha2: CountryScore(cc.alpha2, cc.votes or 0, cc.points or 0)
+                for cc in CountryCache.select()
+            }
+            self.country_info = {country.alpha2: country for country in Country.select()}
+            self.country_board.clear()
+            for score in self.countries.values():
+                self.country_board.update(score)
+            self.user_board.clear()
+            query = User.select(User.user_id, User.leveling, User.total_points, User.total_votes, User.blocked_until)
+            for row in query.tuples().iterator():
+                self.user_board.update(UserScore(*row))
+            self.users.clear()
+            self._dirty_countries.clear()
+            self._dirty_users.clear()
+            self._user_country_deltas.clear()
+            self.checkpoint = get_checkpoint() or 0
+            self._checkpoint_dirty = False
+            self._load_windows()
+
+    def restore(self, recovery: Recovery, tail: Iterable[JournalRecord]) -> None:
+        """
+        Loads counters rebuilt from the vote journal (see journal.VoteJournal.recover) instead of the stored ones.
+        The stored counters lack the votes after the stored checkpoint (`tail`), their countries and users are marked
+        as changed with the rebuilt counters, so the next flush catches the database up.
+        """
+
+        with self._lock:
+            self.countries = {
+                alpha2: CountryScore(alpha2, votes, points) for alpha2, (votes, points) in recovery.countries.items()
+            }
+            self.country_info = {country.alpha2: country for country in Country.select()}
+            self.country_board.clear()
+            for score in self.countries.values():
+                self.country_board.update(score)
+            blocked = dict(User.select(User.user_id, User.blocked_until)
+                           .where(User.blocked_until.is_null(False)).tuples())
+            self.user_board.clear()
+            for user_id, (leveling, total_points, total_votes) in recovery.users.items():
+                self.user_board.update(UserScore(user_id, leveling, total_points, total_votes, blocked.get(user_id)))
+            self.users.clear()
+            self._dirty_countries.clear()
+            self._dirty_users.clear()
+            self._user_country_deltas.clear()
+
+            latest_votes: dict[str, datetime.datetime | None] = {}
+            for record in tail:
+                sign = record.sign
+                if not sign:
+                    continue
+                if sign > 0:
+                    latest = latest_votes.get(record.user_id)
+                    latest_votes[record.user_id] = record.timestamp if latest is None else max(latest, record.timestamp)
+                else:
+                    latest_votes.setdefault(record.user_id, None)
+                self._dirty_countries.add(record.alpha2)
+                delta = self._user_country_deltas.setdefault((record.user_id, record.alpha2), [0, 0])
+                delta[0] += sign * record.vote_count
+                delta[1] += sign * record.points
+            for user_ids in chunked(latest_votes, FLUSH_BATCH_SIZE):
+                for user in User.select().where(User.user_id.in_(user_ids)):
+                    user.leveling, user.total_points, user.total_votes = recovery.users[user.user_id]
+                    latest = latest_votes[user.user_id]
+                    if latest is not None and (user.latest_vote is None or user.latest_vote < latest):
+                        user.latest_vote = latest
+                    self._dirty_users.add(user.user_id)
+                    self.users.add(user)
+            self.checkpoint = get_checkpoint() or 0
+            self._checkpoint_dirty = False
+            self.advance_checkpoint(recovery.last_vote_id)
+            self._load_windows()
+
+    def _load_windows(self) -> None:
+        """Fills the sliding windows with the stored votes of the longest window, using the timestamp index"""
+        if not self.windows:
+            return
+        since = datetime.datetime.fromtimestamp(time.time() - max(self.windows.values()))
+        query = (Vote
+                 .select(Vote.user, Vote.country, Vote.vote_count, Vote.points, Vote.timestamp)
+                 .where((Vote.timestamp >= since) & (Vote.redacted == False))
+                 .order_by(Vote.timestamp))
+        for window in (*self.country_windows.values(), *self.user_windows.values()):
+            window.reset()
+        for user_id, alpha2, vote_count, points, timestamp in query.tuples().iterator():
+            self._add_to_windows(user_id, alpha2, timestamp.timestamp(), int(vote_count or 0), int(points or 0))
+
+    def snapshot(self) -> None:
+        """Writes the current counters as journal snapshot, see journal.VoteJournal"""
+        with self._lock:
+            # votes are journaled while holding the lock, so the counters include exactly the first `position` records
+            position, last_vote_id = journal.count, journal.last_vote_id
+            countries = {score.alpha2: [score.votes, score.points] for score in self.countries.values()}
+            users = {
+                record.user_id: [float(record.leveling or 0), float(record.total_points or 0),
+                                 float(record.total_votes or 0)]
+                for record in self.user_board.records.values()
+            }
+        journal.write_snapshot(position, last_vote_id, countries, users)
+
+    def country(self, alpha2: str) -> CountryScore:
+        score = self.countries.get(alpha2)
+        if score is None:
+            with self._lock:
+                score = self.countries[alpha2] = CountryScore(alpha2)
+                self.country_board.update(score)
+        return score
+
+    def user(self, user: User) -> User:
+        """
+        The instance holding the current counters of a user. Instances loaded elsewhere may be outdated.
+        """
+
+        with self._lock:
+            return self.users.add(user)
+
+    def _remember(self, user: User, country_score: CountryScore) -> None:
+        """Keeps the counters a running batch is about to change, so they can be rolled back"""
+        undo = self._undo
+        if undo is None:
+            return
+        if user.user_id not in undo.users:
+            undo.users[user.user_id] = (user, user.leveling, user.total_points, user.total_votes, user.latest_vote,
+                                        user.user_id in self._dirty_users)
+        if country_score.alpha2 not in undo.countries:
+            undo.countries[country_score.alpha2] = (country_score, country_score.votes, country_score.points,
+                                                    country_score.alpha2 in self._dirty_countries)
+        key = (user.user_id, country_score.alpha2)
+        if key not in undo.user_countries:
+            delta = self._user_country_deltas.get(key)
+            undo.user_countries[key] = None if delta is None else list(delta)
+
+    def _add_to_windows(self, user_id: str, alpha2: str, timestamp: float, votes: int, points: int) -> None:
+        if self._undo is not None:
+            self._undo.windows.append((user_id, alpha2, timestamp, votes, points))
+        for window in self.country_windows.values():
+            window.add(alpha2, timestamp, points, votes)
+        for window in self.user_windows.values():
+            window.add(user_id, timestamp, points, votes)
+
+    def apply_vote(self, vote: Vote) -> tuple[User, CountryScore]:
+        """
+        Adds a vote to the counters of its user and country in O(1), without touching the database.
+        :param vote: vote with its user instance attached
+        :return: the updated scores
+        """
+
+        with self._lock:
+            user = self.user(vote.user)
+            country_score = self.country(vote.country_id)
+            self._remember(user, country_score)
+            user.latest_vote = vote.timestamp
+            user.leveling = float(user.leveling or 0) + float(vote.xp_gain or 0)
+            user.total_votes = float(user.total_votes or 0) + float(vote.vote_count or 0)
+            user.total_points = float(user.total_points or 0) + float(vote.points or 0)
+            country_score.votes += int(vote.vote_count or 0)
+            country_score.points += int(vote.points or 0)
+            delta = self._user_country_deltas.get((user.user_id, country_score.alpha2))
+            if delta is None:
+                delta = self._user_country_deltas[(user.user_id, country_score.alpha2)] = [0, 0]
+            delta[0] += int(vote.vote_count or 0)
+            delta[1] += int(vote.points or 0)
+            self._add_to_windows(user.user_id, country_score.alpha2, vote.timestamp.timestamp(),
+                                 int(vote.vote_count or 0), int(vote.points or 0))
+            self.country_board.update(country_score)
+            self._rank_user(user)
+            self._dirty_users.add(user.user_id)
+            self._dirty_countries.add(country_score.alpha2)
+        return user, country_score
+
+    def retract_votes(self, user: User, votes: list[Vote]) -> None:
+        """
+        Takes counted votes of a user back out of the counters, e.g. after they were redacted. The reverse
+        of `apply_vote`, also for the sliding windows, so no recalculation is needed. User counters are rounded
+        (see journal.retract), taking back all votes of a user leaves them at exactly 0.
+        :param user: the user of the votes, a stored instance if it is not cached
+        :param votes: stored votes that were counted, in vote id order
+        """
+
+        with self._lock:
+            user = self.user(user)
+            for vote in votes:
+                country_score = self.country(vote.country_id)
+                self._remember(user, country_score)
+                user.leveling = retract(user.leveling or 0, vote.xp_gain or 0)
+                user.total_votes = retract(user.total_votes or 0, vote.vote_count or 0)
+                user.total_points = retract(user.total_points or 0, vote.points or 0)
+                country_score.votes -= int(vote.vote_count or 0)
+                country_score.points -= int(vote.points or 0)
+                delta = self._user_country_deltas.setdefault((user.user_id, country_score.alpha2), [0, 0])
+                delta[0] -= int(vote.vote_count or 0)
+                delta[1] -= int(vote.points or 0)
+                self._add_to_windows(user.user_id, country_score.alpha2, vote.timestamp.timestamp(),
+                                     -int(vote.vote_count or 0), -int(vote.points or 0))
+                self.country_board.update(country_score)
+                self._dirty_countries.add(country_score.alpha2)
+            self._rank_user(user)
+            self._dirty_users.add(user.user_id)
+
+    def _rank_user(self, user: User) -> None:
+        record = self.user_board.get(user.user_id)
+        if record is None:
+            record = UserScore(user.user_id)
+        record.leveling = user.leveling
+        record.total_points = user.total_points
+        record.total_votes = user.total_votes
+        record.blocked_until = user.blocked_until
+        self.user_board.update(record)
+
+    def set_blocked(self, user_id: str, blocked_until: datetime.datetime | None) -> None:
+        """Applies a (removed) block that was already stored, to the cached user and the user ranking"""
+        with self._lock:
+            user = self.users.get(user_id)
+            if user is not None:
+                user.blocked_until = blocked_until
+            record = self.user_board.get(user_id)
+            if record is not None:
+                record.blocked_until = blocked_until
+
+    def top_countries(self, k: int = None, by: str = 'points') -> list[tuple[Country, CountryScore]]:
+        """Best countries with their counters, all of them by default"""
+        with self._lock:
+            scores = self.country_board.top(by, k if k is not None else len(self.country_board),
+                                            where=lambda score: score.alpha2 in self.country_info)
+            return [(self.country_info[score.alpha2], score) for score in scores]
+
+    def top_users(self, k: int = 20, by: str = 'leveling') -> list[User]:
+        """
+        Best users that are not blocked. Costs at most one query, for users that are not cached.
+        :return: User instances with current counters
+        """
+
+        with self._lock:
+            user_ids = [record.user_id for record in self.user_board.top(by, k, where=lambda r: not r.blocked)]
+        users = self._get_users(user_ids)
+        return [users[user_id] for user_id in user_ids if user_id in users]
+
+    def top_user_countries(self, user_ids: list[str]) -> dict[str, Country]:
+        """
+        Favourite country (most votes) of each user, from the stored per user and country totals plus the changes
+        that are not flushed yet. One query and no writes, so it never waits for a flush or the write lock.
+        Changes that are being flushed right now are missing until the flush committed.
+        :return: user_id -> Country, users without votes are missing
+        """
+
+        query = (UserCountry
+                 .select(UserCountry.user, UserCountry.country, UserCountry.votes)
+                 .where(UserCountry.user.in_(user_ids)))
+        totals = {(user_id, alpha2): votes for user_id, alpha2, votes in query.tuples()}
+        wanted = set(user_ids)
+        with self._lock:
+            for key, (votes, _) in self._user_country_deltas.items():
+                if key[0] in wanted:
+                    totals[key] = totals.get(key, 0) + votes
+        top: dict[str, tuple[int, str]] = {}  # user_id -> (votes, alpha2)
+        for (user_id, alpha2), votes in totals.items():
+            if votes > 0 and (user_id not in top or votes > top[user_id][0]):
+                top[user_id] = (votes, alpha2)
+        return {user_id: self.country_info[alpha2] for user_id, (_, alpha2) in top.items()
+                if alpha2 in self.country_info}
+
+    def _get_users(self, user_ids: list[str]) -> dict[str, User]:
+        """User instances with current counters, costs one query for users that are not cached"""
+        with self._lock:
+            users = {user_id: self.users.get(user_id) for user_id in user_ids}
+        missing = [user_id for user_id, user in users.items() if user is None]
+        if missing:
+            # uncached users have no unflushed counters, so their rows are up to date
+            users.update({user.user_id: user for user in User.select().where(User.user_id.in_(missing))})
+        return {user_id: user for user_id, user in users.items() if user is not None}
+
+    def top_countries_window(self, window: str, k: int, by: str = 'points') -> list[tuple[Country, dict[str, int]]]:
+        """
+        Best countries by their votes or points within a sliding window (see LEADERBOARD_WINDOWS)
+        :return: countries with their windowed counters, {'points': ..., 'votes': ...}
+        """
+
+        with self._lock:
+            top = self.country_windows[window].top(by, k, time.time(), where=lambda alpha2: alpha2 in self.country_info)
+            return [(self.country_info[alpha2], totals) for alpha2, totals in top]
+
+    def top_users_window(self, window: str, k: int, by: str = 'points') -> list[tuple[User, dict[str, int]]]:
+        """
+        Best users that are not blocked, by their votes or points within a sliding window.
+        Costs at most one query, for users that are not cached.
+        :return: users with their windowed counters, {'points': ..., 'votes': ...}
+        """
+
+        def unblocked(user_id: str) -> bool:
+            record = self.user_board.get(user_id)
+            return record is None or not record.blocked
+
+        with self._lock:
+            top = self.user_windows[window].top(by, k, time.time(), where=unblocked)
+        users = self._get_users([user_id for user_id, _ in top])
+        return [(users[user_id], totals) for user_id, totals in top if user_id in users]
+
+    def windows_version(self, now: float = None) -> tuple[int, ...]:
+        """Changes whenever a window moves on to its next bucket, even without votes"""
+        now = time.time() if now is None else now
+        return tuple(window.bucket(now) for window in self.country_windows.values())
+
+    def country_rank(self, alpha2: str, by: str = 'points') -> int | None:
+        with self._lock:
+            return self.country_board.rank(alpha2, by)
+
+    def user_rank(self, user_id: str, by: str = 'leveling') -> int | None:
+        """Position among all users, blocked users included"""
+        with self._lock:
+            return self.user_board.rank(user_id, by)
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """
+        Holds flushes off while a batch of votes is applied and stored, so a flush never writes counters
+        that include votes of a batch without also moving the checkpoint past it.
+        If the batch raises, e.g. because its transaction was rolled back, the counters, windows and checkpoint
+        are rolled back as well, so memory never counts votes that were not stored, and users inserted by the batch
+        are dropped from the user cache (see UserCache.rollback).
+            with scoreboard.batch():
+                with db.atomic():
+                    register and store votes...
+                    scoreboard.advance_checkpoint(last_vote_id)
+        """
+
+        with self._lock:
+            if self._undo is not None:  # nested, the outermost batch rolls back
+                yield
+                return
+            self._undo = _BatchUndo((self.checkpoint, self._checkpoint_dirty))
+            self.users.begin()
+            try:
+                yield
+            except BaseException:
+                undo, self._undo = self._undo, None
+                self._rollback(undo)
+                raise
+            finally:
+                self._undo = None
+                self.users.end()
+
+    def _rollback(self, undo: _BatchUndo) -> None:
+        for user_id, alpha2, timestamp, votes, points in reversed(undo.windows):
+            self._add_to_windows(user_id, alpha2, timestamp, -votes, -points)
+        for key, delta in undo.user_countries.items():
+            if delta is None:
+                self._user_country_deltas.pop(key, None)
+            else:
+                self._user_country_deltas[key] = delta
+        for score, votes, points, dirty in undo.countries.values():
+            score.votes, score.points = votes, points
+            self.country_board.update(score)
+            if not dirty:
+                self._dirty_countries.discard(score.alpha2)
+        for user, leveling, total_points, total_votes, latest_vote, dirty in undo.users.values():
+            user.leveling, user.total_points, user.total_votes, user.latest_vote = \
+                leveling, total_points, total_votes, latest_vote
+            self._rank_user(user)
+            if not dirty:
+                self._dirty_users.discard(user.user_id)
+        for user_id in self.users.rollback():
+            # inserted by the batch, so not stored and not ranked before it
+            self._dirty_users.discard(user_id)
+            self.user_board.remove(user_id)
+        self.checkpoint, self._checkpoint_dirty = undo.checkpoint
+        log.warning('Rolled back the counters of %d users and %d countries of a failed batch',
+                    len(undo.users), len(undo.countries))
+
+    def advance_checkpoint(self, vote_id: int) -> None:
+        with self._lock:
+            if vote_id > self.checkpoint:
+                self.checkpoint = vote_id
+                self._checkpoint_dirty = True
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self._dirty_countries or self._dirty_users or self._user_country_deltas or self._checkpoint_dirty)
+
+    def flush(self) -> int:
+        """
+        Writes all changed counters to the database, using one statement per batch of rows.
+        Rows stay marked as changed if writing fails, so the next flush retries them.
+        :return: number of written rows
+        """
+
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self) -> int:
+        with self._lock:
+            country_rows = [
+                {'alpha2': s.alpha2, 'votes': s.votes, 'points': s.points}
+                for s in map(self.countries.__getitem__, self._dirty_countries)
+            ]
+            user_rows = [
+                {'user_id': u.user_id, 'leveling': u.leveling, 'total_votes': u.total_votes,
+                 'total_points': u.total_points, 'latest_vote': u.latest_vote}
+                for u in map(self.users.__getitem__, self._dirty_users)
+            ]
+            user_country_deltas, self._user_country_deltas = self._user_country_deltas, {}
+            checkpoint = self.checkpoint if self._checkpoint_dirty else None
+            dirty_countries, self._dirty_countries = self._dirty_countries, set()
+            dirty_users, self._dirty_users = self._dirty_users, set()
+            self._flushing_users = dirty_users  # stay cached until written
+            self._checkpoint_dirty = False
+
+        if not country_rows and not user_rows and not user_country_deltas and checkpoint is None:
+            return 0
+        start = time.perf_counter()
+        try:
+            with db.atomic():
+                for batch in chunked(country_rows, FLUSH_BATCH_SIZE):
+                    upsert(
+                        CountryCache.insert_many(batch),
+                        conflict_target=[CountryCache.alpha2],
+                        preserve=[CountryCache.votes, CountryCache.points]
+                    ).execute()
+                for batch in chunked(user_rows, FLUSH_BATCH_SIZE):
+                    # users always exist already, so a single UPDATE ... CASE covers the whole batch
+                    bulk_update(User.user_id, batch,
+                                [User.leveling, User.total_votes, User.total_points, User.latest_vote])
+                user_country_rows = [
+                    {'user': user_id, 'country': alpha2, 'votes': votes, 'points': points}
+                    for (user_id, alpha2), (votes, points) in user_country_deltas.items()
+                ]
+                for batch in chunked(user_country_rows, FLUSH_BATCH_SIZE):
+                    upsert(
+                        UserCountry.insert_many(batch),
+                        conflict_target=[UserCountry.user, UserCountry.country],
+                        increment=[UserCountry.votes, UserCountry.points]
+                    ).execute()
+                if checkpoint is not None:
+                    set_checkpoint(checkpoint)
+        except Exception:
+            with self._lock:
+                self._dirty_countries |= dirty_countries
+                self._dirty_users |= dirty_users
+                for key, (votes, points) in user_country_deltas.items():
+                    delta = self._user_country_deltas.setdefault(key, [0, 0])
+                    delta[0] += votes
+                    delta[1] += points
+                self._checkpoint_dirty = self._checkpoint_dirty or checkpoint is not None
+            raise
+        finally:
+            self._flushing_users = set()
+            STAGE_SECONDS.observe(time.perf_counter() - start, 'flush')
+        return len(country_rows) + len(user_rows) + len(user_country_deltas)
+
+    async def flush_periodically(self, interval: float = FLUSH_INTERVAL) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await db_executor.run(self.flush)
+            except Exception as e:
+                log.error('Exception while flushing scoreboard: %s. Retrying in %s seconds...', e, interval)
+
+
+scoreboard = Scoreboard()
@@ -0,0 +1,56 @@
+import threading
+
+from game import gen_status_report
+from scoreboard import scoreboard
+from wire import Report
+
+
+class StatusSnapshot:
+    """
+    Status report shared by all clients, encoded once per wire format.
+    Every change of the underlying state bumps `version`, the report is only rebuilt when it is requested
+    after such a change, or after a sliding window moved on. Serving an up-to-date snapshot costs no queries.
+    """
+
+    def __init__(self) -> None:
+        self.version = 0
+        self._built_version = -1
+        self._built_windows: tuple[int, ...] = ()
+        self._report: Report | None = None
+        self._lock = threading.Lock()
+
+    def invalidate(self) -> None:
+        """Marks the snapshot as outdated, call after anything shown in the status report changed"""
+        self.version += 1
+
+    @property
+    def fresh(self) -> bool:
+        return self._built_version == self.version and self._built_windows == scoreboard.windows_version()
+
+    def current(self) -> Report | None:
+        """The snapshot if it is up to date, without blocking"""
+        return self._report if self.fresh else None
+
+    def get(self) -> Report:
+        """
+        The snapshot, rebuilt first if it is outdated. Blocking, run it on the database executor.
+        :return:
+        """
+
+        with self._lock:
+            if not self.fresh:
+                version = self.version  # changes during the rebuild leave the snapshot outdated
+                windows = scoreboard.windows_version()
+                report = Report(gen_status_report())
+                report.encode()  # the default format off the event loop, most clients use it
+                self._report = report
+                self._built_version = version
+                self._built_windows = windows
+            return self._report
+
+    def report(self) -> dict:
+        """The snapshot as dict, rebuilt first if it is outdated. Blocking."""
+        return self.get().body
+
+
+status_snapshot = StatusSnapshot()
@@ -0,0 +1,80 @@
+import asyncio
+from collections import deque
+from typing import Callable
+
+from config import TICK_MS, TICK_MAX_VOTES
+from wire import Report
+
+
+class UpdateCoalescer:
+    """
+    Merges the vote updates of a tick into a single `tick` report, so clients get a fixed number of frames
+    per second no matter how busy the chat is. A tick report carries the new totals and the change of every
+    voted country, the latest votes and all milestone events of the tick:
+        {'type': 'tick', 'vote_count': 42,
+         'countries': [{'alpha2': 'DE', 'votes': 120, 'points': 12500, 'delta_votes': 3, 'delta_points': 310}],
+         'votes': [vote, ...], 'events': [event, ...]}
+    """
+
+    def __init__(self, send: Callable[[Report], None], interval: float = TICK_MS / 1000,
+                 max_votes: int = TICK_MAX_VOTES) -> None:
+        self.send = send
+        self.interval = interval
+        self._countries: dict[str, dict] = {}
+        self._votes: deque[dict] = deque(maxlen=max_votes)
+        self._events: list[dict] = []
+        self._vote_count = 0
+        self.ticks = 0
+        self.merged = 0  # updates merged into ticks
+
+    def add(self, report: Report) -> None:
+        vote = report.body['vote']
+        cache = vote['country']['cache']
+        country = self._countries.get(cache['alpha2'])
+        if country is None:
+            country = self._countries[cache['alpha2']] = {'alpha2': cache['alpha2'], 'delta_votes': 0, 'delta_points': 0}
+        country['votes'] = cache['votes']
+        country['points'] = cache['points']
+        country['delta_votes'] += vote['vote_count']
+        country['delta_points'] += vote['points']
+        self._votes.append(vote)
+        self._events.extend(report.body['events'])
+        self._vote_count += 1
+
+    def frame(self) -> Report | None:
+        """Takes the updates collected since the last frame, None if there are none"""
+        if not self._vote_count:
+            return None
+        report = Report({
+            'type': 'tick',
+            'vote_count': self._vote_count,
+            'countries': list(self._countries.values()),
+            'votes': list(self._votes),
+            'events': self._events,
+        })
+        self.ticks += 1
+        self.merged += self._vote_count
+        self._countries = {}
+        self._votes.clear()
+        self._events = []
+        self._vote_count = 0
+        return report
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            next_tick += self.interval
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+            next_tick = max(next_tick, loop.time() - self.interval)  # no bursts of ticks after a stall
+            report = self.frame()
+            if report is not None:
+                self.send(report)
+
+    def stats(self) -> dict:
+        return {
+            'interval_ms': self.interval * 1000,
+            'ticks': self.ticks,
+            'merged_updates': self.merged,
+            'pending': self._vote_count,
+        }
@@ -0,0 +1,155 @@
+from collections import OrderedDict
+from typing import Callable
+
+from config import USER_CACHE_SIZE
+from models import bulk_update, User
+
+PROFILE_FIELDS = [User.username, User.channel_url, User.image_url, User.is_mod]
+
+
+class UserCache:
+    """
+    Least recently used User instances by channel id, holding the current profile and counters of each user.
+    Profiles are only written to the database when a field actually changed, new users are inserted in batches.
+    Users for which `pinned` is true (e.g. unflushed counters) are never evicted.
+    Between `begin` and `end`, new users and profile changes are remembered, so `rollback` can drop them again
+    when the transaction that wrote them is rolled back (see Scoreboard.batch).
+    """
+
+    def __init__(self, max_size: int = USER_CACHE_SIZE, pinned: Callable[[str], bool] = lambda user_id: False) -> None:
+        self.max_size = max_size
+        self.pinned = pinned
+        self._users: OrderedDict[str, User] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.inserted = 0  # new users written
+        self.updated = 0  # profile changes written
+        self.evicted = 0
+        self._undo: list[tuple[str, User, dict | None]] | None = None  # (user_id, user, old profile or None if new)
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._users
+
+    def __getitem__(self, user_id: str) -> User:
+        return self._users[user_id]
+
+    def get(self, user_id: str) -> User | None:
+        """Cached user without loading it from the database"""
+        return self._users.get(user_id)
+
+    def add(self, user: User) -> User:
+        """
+        Caches a user instance, unless an instance for the same user is cached already.
+        :return: the cached instance
+        """
+
+        cached = self._users.get(user.user_id)
+        if cached is not None:
+            self._users.move_to_end(user.user_id)
+            return cached
+        self._users[user.user_id] = user
+        self._evict()
+        return user
+
+    def clear(self) -> None:
+        self._users.clear()
+
+    def begin(self) -> None:
+        self._undo = []
+
+    def end(self) -> None:
+        self._undo = None
+
+    def rollback(self) -> list[str]:
+        """
+        Undoes the changes since `begin`: new users are dropped from the cache, changed profiles are reverted.
+        :return: ids of the dropped users
+        """
+
+        dropped = []
+        for user_id, user, profile in reversed(self._undo or []):
+            if profile is None:
+                if self._users.get(user_id) is user:
+                    del self._users[user_id]
+                    dropped.append(user_id)
+            else:
+                for name, value in profile.items():
+                    setattr(user, name, value)
+        self._undo = [] if self._undo is not None else None
+        return dropped
+
+    def fetch(self, profiles: dict[str, dict]) -> dict[str, User]:
+        """
+        Users for a batch of chat authors, with their profiles brought up to date.
+        Costs at most one select for uncached users, one insert for new users and one update for changed profiles.
+        :param profiles: user_id -> latest profile (user_id, username, channel_url, image_url, is_mod)
+        :return: user_id -> cached User instance
+        """
+
+        users = {}
+        missing = []
+        for user_id in profiles:
+            user = self._users.get(user_id)
+            if user is None:
+                missing.append(user_id)
+            else:
+                self._users.move_to_end(user_id)
+                users[user_id] = user
+        self.hits += len(users)
+        self.misses += len(missing)
+
+        if missing:
+            users.update({user.user_id: user for user in User.select().where(User.user_id.in_(missing))})
+        new_profiles = [profile for user_id, profile in profiles.items() if user_id not in users]
+        if new_profiles:
+            User.insert_many(new_profiles).execute()
+            users.update({profile['user_id']: User(**profile) for profile in new_profiles})
+            self.inserted += len(new_profiles)
+            if self._undo is not None:
+                self._undo.extend((profile['user_id'], users[profile['user_id']], None) for profile in new_profiles)
+
+        changed = []
+        for user_id, profile in profiles.items():
+            user = users[user_id]
+            if any(field.db_value(getattr(user, field.name)) != field.db_value(profile[field.name])
+                   for field in PROFILE_FIELDS):
+                if self._undo is not None:
+                    old_profile = {field.name: getattr(user, field.name) for field in PROFILE_FIELDS}
+                    self._undo.append((user_id, user, old_profile))
+                for field in PROFILE_FIELDS:
+                    setattr(user, field.name, profile[field.name])
+                changed.append(profile)
+        if changed:
+            bulk_update(User.user_id, changed, PROFILE_FIELDS)
+            self.updated += len(changed)
+
+        for user_id in missing:
+            users[user_id] = self.add(users[user_id])
+        return users
+
+    def _evict(self) -> None:
+        skipped = 0
+        while len(self._users) > self.max_size and skipped < len(self._users):
+            user_id = next(iter(self._users))
+            if self.pinned(user_id):
+                self._users.move_to_end(user_id)
+                skipped += 1
+                continue
+            del self._users[user_id]
+            self.evicted += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._users),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0,
+            'inserted': self.inserted,
+            'updated': self.updated,
+            'evicted': self.evicted,
+        }
@@ -1,130 +1,184 @@
 import asyncio
-import json
-import math
+import logging
+
 import websockets
-import pytchat
-import datetime
 
-from peewee import DoesNotExist
+from broadcast import Broadcaster
+from chat_source import ChatSource, ChatWatcher, PytchatSource
+from config import FANOUT_METRICS_PORT, FANOUT_WORKERS, TICK_MS, VIDEO_IDS
+import metrics
+from db_executor import db_executor
+from fanout import FanoutPublisher, start_workers
+from game import Game
+from ingest import IngestPipeline
+from journal import journal
+from milestones import milestones
+from scoreboard import scoreboard
+from snapshot import status_snapshot
+from ticker import UpdateCoalescer
+from models import db
+from wire import Report, WireFormat
+
+log = logging.getLogger(__name__)
 
-from game import Game, gen_status_report, register_vote, gen_vote_report
-from models import User, Vote, Country
-from playhouse.shortcuts import model_to_dict
+HOST = '0.0.0.0'
+PORT = 6789
 
 
 class WebsocketClient:
-    def __init__(self, game: Game):
+    def __init__(self, game: Game, fanout_workers: int = FANOUT_WORKERS):
         self.game = game
-        self.clients = set()
-
-    async def notify_clients(self, report: dict) -> None:
-        if self.clients:
-            msg = json.dumps(report, ensure_ascii=False)  # Important for emojis!
-            disconnected = set()
-            for client in self.clients:
-                try:
-                    await client.send(msg)
-                except:
-                    disconnected.add(client)
-            self.clients.difference_update(disconnected)
+        self.fanout_workers = fanout_workers
+        # with fanout workers, reports are published to the worker processes, which serve the clients
+        self.broadcaster = FanoutPublisher() if fanout_workers else Broadcaster()
+        self.pipeline = IngestPipeline(self.notify_clients)
+        # merges vote updates into one frame per tick, off with TICK_MS=0
+        self.coalescer = UpdateCoalescer(self.broadcaster.broadcast) if TICK_MS > 0 else None
+        self.watchers: list[ChatWatcher] = []  # one per chat source
+        self.metrics = self._register_metrics()
+
+    def _register_metrics(self) -> list[metrics.Metric]:
+        """Numbers kept by the components anyway, read when /metrics is scraped"""
+        stats = self.pipeline.stats
+        return [
+            metrics.Callback('livevote_messages_total', 'Chat messages by outcome', lambda: {
+                ('vote',): stats.votes, ('ignored',): stats.ignored, ('failed',): stats.failed,
+                ('duplicate',): stats.duplicates,
+            }, type='counter', label_names=('outcome',)),
+            metrics.Callback('livevote_ingest_queue_depth', 'Chat messages waiting in the ingest queue',
+                             self.pipeline.queue.qsize),
+            metrics.Callback('livevote_ingest_blocked_seconds_total', 'Time the chat watcher was held back',
+                             lambda: stats.blocked_seconds, type='counter'),
+            metrics.Callback('livevote_clients', 'Connected websocket clients (fanout workers with FANOUT_WORKERS)',
+                             lambda: len(self.broadcaster)),
+            metrics.Callback('livevote_client_queued_messages', 'Messages waiting in client send buffers',
+                             lambda: self.broadcaster.stats().get('queued', 0)),
+            metrics.Callback('livevote_client_max_lag_seconds', 'Age of the oldest unsent client message',
+                             lambda: self.broadcaster.stats().get('max_lag_seconds', 0)),
+            metrics.Callback('livevote_client_dropped_messages', 'Messages dropped for slow connected clients',
+                             lambda: self.broadcaster.stats().get('dropped', 0)),
+            metrics.Callback('livevote_fanout_buffered_bytes', 'Published bytes not yet sent to fanout workers',
+                             lambda: self.broadcaster.stats().get('buffered_bytes', 0)),
+            metrics.Callback('livevote_db_executor_busy', 'Database worker threads running a call',
+                             lambda: db_executor.busy),
+            metrics.Callback('livevote_db_executor_workers', 'Database worker threads', lambda: db_executor.workers),
+            metrics.Callback('livevote_db_pool_connections', 'Pooled database connections by state', lambda: {
+                ('in_use',): len(getattr(db.obj, '_in_use', ())), ('idle',): len(getattr(db.obj, '_connections', ())),
+            }, label_names=('state',)),
+            metrics.Callback('livevote_user_cache_lookups_total', 'User cache lookups by result', lambda: {
+                ('hit',): scoreboard.users.hits, ('miss',): scoreboard.users.misses,
+            }, type='counter', label_names=('result',)),
+            metrics.Callback('livevote_user_cache_size', 'Users held in memory', lambda: len(scoreboard.users)),
+            metrics.Callback('livevote_scoreboard_dirty', 'Whether counters are waiting to be flushed',
+                             lambda: int(scoreboard.dirty)),
+            metrics.Callback('livevote_chat_items_total', 'Chat messages received per chat source', lambda: {
+                (watcher.source.name,): watcher.items for watcher in self.watchers
+            }, type='counter', label_names=('source',)),
+            metrics.Callback('livevote_chat_source_healthy', 'Whether a chat source is running and live', lambda: {
+                (watcher.source.name,): int(watcher.healthy) for watcher in self.watchers
+            }, label_names=('source',)),
+            metrics.Callback('livevote_chat_poll_interval_seconds', 'Current poll interval per chat source', lambda: {
+                (watcher.source.name,): watcher.source.stats()['interval']
+                for watcher in self.watchers if 'interval' in watcher.source.stats()
+            }, label_names=('source',)),
+            metrics.Callback('livevote_journal_records', 'Votes in the vote journal', lambda: journal.count),
+            metrics.Callback('livevote_journal_unsynced_records', 'Journaled votes not yet synced to disk',
+                             lambda: journal.count - journal.synced),
+            metrics.Callback('livevote_milestone_events_total', 'Milestone events fired',
+                             lambda: milestones.fired, type='counter'),
+        ]
+
+    def process_request(self, connection, request):
+        """Answers plain HTTP requests for /metrics, every other request continues as websocket handshake"""
+        return metrics.process_request(connection, request)
+
+    async def notify_clients(self, report: Report | dict) -> None:
+        """Queues a report for all clients, encoded once per wire format. Status reports replace queued updates."""
+        if self.broadcaster:
+            if isinstance(report, dict):
+                report = Report(report)
+            if self.coalescer is not None and report.type == 'update':
+                self.coalescer.add(report)
+                return
+            self.broadcaster.broadcast(report, replace=report.type == 'status')
 
     async def handler(self, websocket):
-        self.clients.add(websocket)
+        # e.g. ws://host:6789/?schema=2&encoding=msgpack, see wire.py
+        # updates are queued but not sent while the snapshot is built, it includes them and replaces them,
+        # so the status report is always the first message of a client
+        channel = self.broadcaster.register(websocket, WireFormat.from_path(websocket.request.path), start=False)
         try:
-            report = gen_status_report()
-            await websocket.send(json.dumps(report, ensure_ascii=False))
+            report = status_snapshot.current() or await db_executor.run(status_snapshot.get)
+            channel.offer(report.encode(channel.wire_format), replace=True)
+            channel.start()
             await websocket.wait_closed()
         finally:
-            self.clients.remove(websocket)
-
-    async def _process_message(self, c):
-        msg = c.message.strip()
-        if len(msg) < 2:
-            return
+            self.broadcaster.unregister(websocket)
 
-        alpha2 = msg[:2].upper()
-        try:
-            country = Country.get(alpha2=alpha2)
-        except DoesNotExist:
-            print(f'{alpha2} is not a valid country code.')
-            return
-
-        # Force username to Python str and log for debugging
-        username = str(c.author.name)
-        print(f"Received username: {repr(username)}")
-
-        user, created = User.get_or_create(
-            user_id=c.author.channelId,
-            defaults={
-                "username": username,
-                "channel_url": c.author.channelUrl,
-                "image_url": c.author.imageUrl,
-                "is_mod": c.author.isChatModerator,
-            }
-        )
-
-        if not created:
-            # Update values, force str, and log
-            user.username = str(c.author.name)
-            user.channel_url = str(c.author.channelUrl)
-            user.image_url = str(c.author.imageUrl)
-            user.is_mod = c.author.isChatModerator
-            print(f"Saving user: id={user.user_id}, username={repr(user.username)}")
-            user.save()
-        else:
-            print(f"Created user: id={user.user_id}, username={repr(user.username)}")
+    async def process_message(self, c) -> bool:
+        """Queues a chat message for the ingestion pipeline, waits while the pipeline is saturated"""
+        return await self.pipeline.put(c)
 
-        vote = Vote.create(
-            user=user,
-            country=country,
-            vote_count=1,
-            points=100 + math.floor(user.leveling),
-            timestamp=datetime.datetime.now(),
-        )
+    async def chat_watcher(self, source: ChatSource):
+        """Feeds the messages of a chat source into the ingestion pipeline, until the source ends"""
+        watcher = ChatWatcher(source, self.process_message)
+        self.watchers.append(watcher)
+        await watcher.run()
 
-        events = register_vote(vote)
-        await self.notify_clients(gen_vote_report(vote, events))
-
-    async def process_message(self, c, timeout=5):
-        """Does not fry everything if processing fails"""
-        try:
-            await asyncio.wait_for(self._process_message(c), timeout=timeout)
-        except asyncio.TimeoutError:
-            print(f"ERROR: Processing message '{c.message}' by {c.author.name} timed out after {timeout} seconds.")
-            return
-        except Exception as e:
-            print(f"Exception while processing message '{c.message}': {e}")
-            return
-        print(f'Successfully evaluated {c.message} by {c.author.name}')
-
-    async def chat_watcher(self, video_id):
-        """Robustly watches chat, restarts pytchat session if it dies, with logging and auto-retry."""
+    async def periodic_status_report(self):
         while True:
+            await asyncio.sleep(60)
             try:
-                print("Creating new pytchat session...")
-                chat = pytchat.create(video_id=video_id)
-                while chat.is_alive():
-                    for c in chat.get().sync_items():
-                        asyncio.create_task(self.process_message(c, timeout=5))
-                    await asyncio.sleep(0.3)
-                print("Chat session is no longer alive, restarting in 2 seconds...")
-                await asyncio.sleep(2)
+                report = status_snapshot.current() or await db_executor.run(status_snapshot.get)
             except Exception as e:
-                print(f"Exception in chat_watcher: {e}. Restarting in 10 seconds...")
-                await asyncio.sleep(10)
+                log.error("Exception while generating status report: %s", e)
+                continue
+            self.broadcaster.broadcast(report, replace=True)
 
-    async def periodic_status_report(self):
+    async def publish_status(self, interval: float = 1.0):
+        """Keeps the status snapshot of the fanout workers up to date, rebuilding it at most once per interval"""
         while True:
-            await asyncio.sleep(60)
-            report = gen_status_report()
-            await self.notify_clients(report)
-
-    async def run(self):
-        video_id = "hTwVzwT4Yno"
-        server = await websockets.serve(self.handler, "0.0.0.0", 6789)
+            await asyncio.sleep(interval)
+            if not self.broadcaster:
+                continue
+            try:
+                report = status_snapshot.current() or await db_executor.run(status_snapshot.get)
+            except Exception as e:
+                log.error("Exception while generating status report: %s", e)
+                continue
+            self.broadcaster.publish_status(report)
+
+    async def reject(self, websocket):
+        await websocket.close(1008, f'clients are served on port {PORT}')
+
+    async def run(self, sources: list[ChatSource] = None):
+        """:param sources: chat sources that all count towards the game, the chats of VIDEO_IDS by default"""
+        sources = sources or [PytchatSource(video_id) for video_id in VIDEO_IDS]
+        if self.fanout_workers:
+            await self.broadcaster.start()
+            self.broadcaster.publish_status(await db_executor.run(status_snapshot.get))
+            start_workers(self.fanout_workers, HOST, PORT, self.broadcaster.path)
+            asyncio.create_task(self.publish_status())
+            # metrics of this process on http://host:6790/metrics, workers serve their own on port 6789
+            server = await websockets.serve(self.reject, HOST, FANOUT_METRICS_PORT,
+                                            process_request=self.process_request)
+        else:
+            # metrics on http://host:6789/metrics
+            server = await websockets.serve(self.handler, HOST, PORT, process_request=self.process_request)
 
         asyncio.create_task(self.periodic_status_report())
-        await asyncio.gather(
-            self.chat_watcher(video_id),
-            server.wait_closed(),
-        )
\ No newline at end of file
+        asyncio.create_task(scoreboard.flush_periodically())
+        asyncio.create_task(self.pipeline.run())
+        if journal.is_open:
+            asyncio.create_task(journal.sync_periodically())
+            asyncio.create_task(journal.snapshot_periodically(scoreboard.snapshot))
+        if self.coalescer is not None:
+            asyncio.create_task(self.coalescer.run())
+        try:
+            await asyncio.gather(
+                *(self.chat_watcher(source) for source in sources),
+                server.wait_closed(),
+            )
+        finally:
+            if self.fanout_workers:
+                self.broadcaster.close()  # and removes the socket
\ No newline at end of file
@@ -0,0 +1,163 @@
+import re
+from typing import Callable, Hashable
+
+import numpy as np
+
+PENDING_LIMIT = 4096  # buffered additions before they are folded into the arrays anyway
+_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_duration(value: str) -> float:
+    """Seconds of a duration like 30s, 5m, 1h or 1d (plain numbers are seconds)"""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([smhd]?)\s*', value)
+    if match is None:
+        raise ValueError(f'Invalid duration: {value!r}')
+    return float(match.group(1)) * _UNITS[match.group(2) or 's']
+
+def parse_windows(value: str) -> dict[str, float]:
+    """Window names (as configured, e.g. '5m') -> seconds, from a comma separated list of durations"""
+    return {name.strip(): parse_duration(name) for name in value.split(',') if name.strip()}
+
+
+class SlidingWindow:
+    """
+    Sums of some metrics per id (country, user, ...) over the last `seconds`, e.g. points of the last hour.
+    Every id has a row of `buckets` time buckets in a circular NumPy array, and a running total per metric.
+    Adding costs O(1) (values are buffered and folded into the arrays in one vectorized step before they are
+    read), moving to a new bucket clears the expired one for all ids at once, so old votes expire
+    without being looked at again. Ranking is a partial sort of the totals, its cost only depends on the number
+    of ids active in the window, not on the number of votes.
+    Windows are exact to one bucket: a vote expires between `seconds - seconds / buckets` and `seconds` after it.
+    Not thread safe, the scoreboard calls it under its lock.
+    """
+
+    def __init__(self, seconds: float, buckets: int, metrics: tuple[str, ...], dtype=np.int64,
+                 capacity: int = 64) -> None:
+        self.seconds = seconds
+        self.buckets = buckets
+        self.bucket_seconds = seconds / buckets
+        self.metrics = metrics
+        self._data = np.zeros((len(metrics), capacity, buckets), dtype)
+        self._totals = np.zeros((len(metrics), capacity), dtype)
+        self._rows: dict[Hashable, int] = {}  # id -> row
+        self._ids: list[Hashable | None] = [None] * capacity  # row -> id
+        self._free: list[int] = list(reversed(range(capacity)))
+        self._bucket: int | None = None  # number of the newest bucket, counted from the epoch
+        self._pending: list[tuple] = []  # (row, slot, *values) not yet in the arrays
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def reset(self) -> None:
+        """Forgets all ids and values"""
+        self._data.fill(0)
+        self._totals.fill(0)
+        self._rows.clear()
+        self._ids = [None] * len(self._ids)
+        self._free = list(reversed(range(len(self._ids))))
+        self._bucket = None
+        self._pending.clear()
+
+    def bucket(self, timestamp: float) -> int:
+        return int(timestamp // self.bucket_seconds)
+
+    def advance(self, now: float) -> None:
+        """Moves the window forward to `now`, clearing the buckets that fall out of it. Never moves back."""
+        bucket = self.bucket(now)
+        if self._bucket is not None and bucket <= self._bucket:
+            return
+        self._apply()
+        if self._bucket is None or bucket >= self._bucket + self.buckets:
+            self._data.fill(0)
+            self._totals.fill(0)
+        elif bucket > self._bucket:
+            for expired in range(self._bucket + 1, bucket + 1):
+                slot = expired % self.buckets
+                self._totals -= self._data[:, :, slot]
+                self._data[:, :, slot] = 0
+        self._bucket = bucket
+
+    def add(self, id: Hashable, timestamp: float, *values: int) -> None:
+        """
+        Adds values (one per metric) at a point in time, negative values take them back.
+        Values older than the window are ignored.
+        """
+
+        self.advance(timestamp)
+        bucket = self.bucket(timestamp)
+        if bucket <= self._bucket - self.buckets:
+            return
+        row = self._rows.get(id)
+        if row is None:
+            row = self._allocate(id)
+        self._pending.append((row, bucket % self.buckets, *values))
+        if len(self._pending) >= PENDING_LIMIT:
+            self._apply()
+
+    def _apply(self) -> None:
+        """Adds the buffered values to the arrays"""
+        if not self._pending:
+            return
+        pending = np.array(self._pending, dtype=np.int64)
+        self._pending.clear()
+        rows, slots = pending[:, 0], pending[:, 1]
+        for metric in range(len(self.metrics)):
+            np.add.at(self._data[metric], (rows, slots), pending[:, 2 + metric])
+            np.add.at(self._totals[metric], rows, pending[:, 2 + metric])
+
+    def _allocate(self, id: Hashable) -> int:
+        if not self._free:
+            self._apply()
+            # rows of ids without anything left in the window are reused before growing
+            idle = np.flatnonzero(~self._totals.any(axis=0))
+            for row in idle.tolist():
+                del self._rows[self._ids[row]]
+                self._ids[row] = None
+            self._free = idle.tolist()[::-1]
+            if len(self._free) < len(self._ids) // 4:
+                self._grow()
+        row = self._free.pop()
+        self._rows[id] = row
+        self._ids[row] = id
+        return row
+
+    def _grow(self) -> None:
+        capacity = len(self._ids)
+        self._data = np.concatenate([self._data, np.zeros_like(self._data)], axis=1)
+        self._totals = np.concatenate([self._totals, np.zeros_like(self._totals)], axis=1)
+        self._ids.extend([None] * capacity)
+        self._free = list(reversed(range(capacity, 2 * capacity))) + self._free
+
+    def get(self, id: Hashable) -> dict[str, int]:
+        self._apply()
+        row = self._rows.get(id)
+        return {metric: int(self._totals[m, row]) if row is not None else 0 for m, metric in enumerate(self.metrics)}
+
+    def top(self, metric: str, k: int, now: float, where: Callable[[Hashable], bool] = None) \
+            -> list[tuple[Hashable, dict[str, int]]]:
+        """
+        The k ids with the highest windowed total of a metric, ties in a stable but arbitrary order.
+        :param where: only ids for which this is true, e.g. to skip blocked users
+        :return: (id, {metric: windowed total}) pairs, best first, ids without anything in the window are left out
+        """
+
+        self.advance(now)
+        self._apply()
+        if k <= 0:
+            return []
+        totals = self._totals[self.metrics.index(metric)]
+        candidates = np.flatnonzero(totals > 0)
+        wanted = k
+        while True:
+            if wanted < len(candidates):
+                best = candidates[np.argpartition(-totals[candidates], wanted - 1)[:wanted]]
+            else:
+                best = candidates
+            best = best[np.lexsort((best, -totals[best]))]
+            ids = [self._ids[row] for row in best.tolist()]
+            top = [(id, row) for id, row in zip(ids, best.tolist()) if where is None or where(id)]
+            if len(top) >= k or len(best) == len(candidates):
+                break
+            wanted *= 2  # filtered out too many, look further down
+        return [(id, {name: int(self._totals[m, row]) for m, name in enumerate(self.metrics)})
+                for id, row in top[:k]]
@@ -0,0 +1,218 @@
+"""
+Wire formats of the reports sent to websocket clients.
+
+Clients pick a format in the query string of the websocket URL, e.g. ws://host:6789/?schema=2&encoding=msgpack
+- schema 1 (default): the original reports with full user, country and cache records
+- schema 2: compact reports with short keys, only the fields the overlay displays, timestamps in epoch milliseconds
+- encoding json (default, text frames) or msgpack (binary frames)
+"""
+import datetime
+import json
+import time
+from typing import Any, NamedTuple
+from urllib.parse import urlsplit, parse_qs
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional, clients asking for it get JSON
+    msgpack = None
+
+from metrics import STAGE_SECONDS
+from models import User, Country, Vote, Event
+
+SCHEMAS = (1, 2)
+ENCODINGS = ('json', 'msgpack')
+
+
+class WireFormat(NamedTuple):
+    schema: int = 1
+    encoding: str = 'json'
+
+    @property
+    def text(self) -> bool:
+        return self.encoding == 'json'
+
+    @classmethod
+    def from_path(cls, path: str) -> 'WireFormat':
+        """Format requested in the query string of a websocket request path, unknown values fall back to defaults"""
+        query = parse_qs(urlsplit(path).query)
+        schema = query.get('schema', ['1'])[0]
+        encoding = query.get('encoding', ['json'])[0].lower()
+        return cls(
+            int(schema) if schema.isdigit() and int(schema) in SCHEMAS else 1,
+            encoding if encoding in ENCODINGS and (encoding != 'msgpack' or msgpack) else 'json',
+        )
+
+
+DEFAULT_FORMAT = WireFormat()
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError(f'Cannot serialize {type(value).__name__}')
+
+def _ms(value: datetime.datetime | str | None) -> int | None:
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    return int(value.timestamp() * 1000)
+
+
+# --- schema 1 serializers, flat functions instead of the recursive models.to_dict ---
+
+def user_dict(user: User) -> dict:
+    return {
+        'user_id': user.user_id,
+        'channel_url': user.channel_url,
+        'username': user.username,
+        'image_url': user.image_url,
+        'is_mod': user.is_mod,
+        'leveling': user.leveling,
+        'total_votes': user.total_votes,
+        'total_points': user.total_points,
+        'blocked_until': user.blocked_until,
+        'latest_vote': user.latest_vote,
+    }
+
+def country_dict(country: Country, votes: int, points: int) -> dict:
+    return {
+        'alpha2': country.alpha2,
+        'alpha3': country.alpha3,
+        'name': country.name,
+        'cache': {'alpha2': country.alpha2, 'votes': votes, 'points': points},
+    }
+
+def country_window_dict(country: Country, votes: int, points: int) -> dict:
+    """Country in a sliding window ranking, with its counters within the window"""
+    return {'alpha2': country.alpha2, 'name': country.name, 'votes': votes, 'points': points}
+
+def user_window_dict(user: User, votes: int, points: int) -> dict:
+    """User in a sliding window ranking, with their counters within the window"""
+    return {'user_id': user.user_id, 'username': user.username, 'image_url': user.image_url,
+            'votes': votes, 'points': points}
+
+def vote_dict(vote: Vote, user: dict, country: dict) -> dict:
+    return {
+        'vote_id': vote.vote_id,
+        'user': user,
+        'country': country,
+        'vote_count': vote.vote_count,
+        'points': vote.points,
+        'xp_gain': vote.xp_gain,
+        'redacted': vote.redacted,
+        'timestamp': vote.timestamp,
+    }
+
+def event_dict(event: Event, user: dict | None, country: dict | None) -> dict:
+    return {
+        'event_id': event.event_id,
+        'type': event.type,
+        'user': user,
+        'country': country,
+        'milestone': event.milestone,
+        'timestamp': event.timestamp,
+    }
+
+
+# --- schema 2, derived from schema 1 reports ---
+
+def _compact_vote(vote: dict) -> dict:
+    user = vote['user']
+    return {
+        'id': vote['vote_id'],
+        'u': user['user_id'],
+        'n': user['username'],
+        'img': user['image_url'],
+        'c': vote['country']['alpha2'],
+        'p': vote['points'],
+        'ts': _ms(vote['timestamp']),
+    }
+
+def _compact_event(event: dict) -> dict:
+    return {
+        'id': event['event_id'],
+        'k': event['type'],
+        'u': event['user']['user_id'] if event['user'] else None,
+        'n': event['user']['username'] if event['user'] else None,
+        'c': event['country']['alpha2'] if event['country'] else None,
+        'm': event['milestone'],
+        'ts': _ms(event['timestamp']),
+    }
+
+def _compact_update(report: dict) -> dict:
+    vote = report['vote']
+    cache = vote['country']['cache']
+    return {
+        't': 'u',
+        'vote': _compact_vote(vote),
+        'ul': vote['user']['leveling'],  # new level of the voter
+        'cv': cache['votes'],  # new totals of the voted country
+        'cp': cache['points'],
+        'events': [_compact_event(event) for event in report['events']],
+    }
+
+def _compact_tick(report: dict) -> dict:
+    return {
+        't': 'k',
+        'n': report['vote_count'],
+        # [alpha2, votes, points, votes gained, points gained]
+        'countries': [[c['alpha2'], c['votes'], c['points'], c['delta_votes'], c['delta_points']]
+                      for c in report['countries']],
+        'votes': [_compact_vote(vote) for vote in report['votes']],
+        'events': [_compact_event(event) for event in report['events']],
+    }
+
+def _compact_status(report: dict) -> dict:
+    return {
+        't': 's',
+        # [alpha2, name, votes, points], ranked by points
+        'countries': [[c['alpha2'], c['name'], c['cache']['votes'], c['cache']['points']]
+                      for c in report['country_ranking']],
+        # [user_id, username, image_url, leveling, total_points, total_votes, top country]
+        'users': [[u['user_id'], u['username'], u['image_url'], u['leveling'], u['total_points'],
+                   u['total_votes'], u['top_country']] for u in report['user_ranking']],
+        'votes': [_compact_vote(vote) for vote in report['latest_votes']],
+        'events': [_compact_event(event) for event in report['latest_events']],
+        # window -> seconds, [alpha2, votes, points], [user_id, username, image_url, votes, points], by points
+        'w': {name: {'s': window['seconds'],
+                     'countries': [[c['alpha2'], c['votes'], c['points']] for c in window['country_ranking']],
+                     'users': [[u['user_id'], u['username'], u['image_url'], u['votes'], u['points']]
+                               for u in window['user_ranking']]}
+              for name, window in report.get('windows', {}).items()},
+    }
+
+_COMPACT = {'update': _compact_update, 'tick': _compact_tick, 'status': _compact_status}
+
+
+class Report:
+    """
+    A report for clients, encoded at most once per wire format no matter how many clients receive it.
+    The body is a schema 1 report, datetimes may be left unconverted.
+    """
+
+    __slots__ = ('body', '_encoded')
+
+    def __init__(self, body: dict) -> None:
+        self.body = body
+        self._encoded: dict[WireFormat, bytes] = {}
+
+    @property
+    def type(self) -> str:
+        return self.body['type']
+
+    def encode(self, wire_format: WireFormat = DEFAULT_FORMAT) -> bytes:
+        data = self._encoded.get(wire_format)
+        if data is None:
+            start = time.perf_counter()
+            body = self.body if wire_format.schema == 1 else _COMPACT[self.type](self.body)
+            if wire_format.encoding == 'msgpack':
+                data = msgpack.packb(body, default=_default)
+            elif wire_format.schema == 1:
+                data = json.dumps(body, ensure_ascii=False, default=_default).encode('utf-8')  # Important for emojis!
+            else:
+                data = json.dumps(body, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            self._encoded[wire_format] = data
+            STAGE_SECONDS.observe(time.perf_counter() - start, 'serialize')
+        return data